@@ -0,0 +1,190 @@
+"""
+Load benchmark for the hub's login and token refresh path.
+
+Simulated users log in through `RefreshingAuthenticator` against a local
+OIDC stand-in (see `oidc_standin.py`), then keep making requests for
+`--duration` seconds. Like the hub, a request calls `refresh_user` once
+`auth_refresh_age` has passed since the user's last refresh. With a
+`--refresh-lifetime` shorter than the duration, users also run into expired
+refresh tokens.
+
+Reports p50/p99 latency per phase, `refresh_user` outcomes, token endpoint
+requests and the hub event loop lag.
+
+    python benchmarks/auth_load.py --users 2000 --duration 120 \\
+        --access-lifetime 60 --auth-refresh-age 45 --latency 0.05
+    python benchmarks/auth_load.py --users 2000 --proactive
+"""
+import argparse
+import asyncio
+import base64
+import json
+import random
+import secrets
+import time
+import uuid
+from collections import Counter
+
+from oidc_standin import OIDCStandIn, add_arguments, endpoints, start_in_thread
+from refresh_event_loop import percentile, ticker
+
+from djlabhub.auth import RefreshingAuthenticator
+
+
+class FakeHandler:
+    """What `authenticate` needs from the OAuth callback handler."""
+
+    def __init__(self, code: str):
+        self.code = code
+        # the login handler's state cookie, which carries the PKCE code verifier
+        # that oauthenticator 17 sends with the code
+        self.state = base64.urlsafe_b64encode(json.dumps({
+            "state_id": uuid.uuid4().hex,
+            "code_verifier": secrets.token_urlsafe(43),
+        }).encode()).decode()
+
+    def get_argument(self, name, default=None):
+        return {"code": self.code, "state": self.state}.get(name, default)
+
+    def get_state_cookie(self):
+        return self.state
+
+    def get_state_url(self):
+        return self.state
+
+
+class FakeUser:
+    """The parts of `jupyterhub.user.User` the authenticator relies on."""
+
+    active = True
+
+    def __init__(self, name: str):
+        self.name = name
+        self.auth_state = None
+        self._auth_refreshed = 0.0
+
+    async def get_auth_state(self):
+        return dict(self.auth_state) if self.auth_state else None
+
+    async def save_auth_state(self, auth_state):
+        self.auth_state = dict(auth_state)
+
+
+class Phase:
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies = []
+        self.outcomes = Counter()
+
+    def report(self):
+        if not self.latencies:
+            return
+        print(
+            f"{self.name:<10} n={len(self.latencies):<7} "
+            f"p50={percentile(self.latencies, 50) * 1000:7.1f} ms  "
+            f"p99={percentile(self.latencies, 99) * 1000:7.1f} ms  "
+            + "  ".join(f"{k}={v}" for k, v in sorted(self.outcomes.items()))
+        )
+
+
+async def login(authenticator, standin, user, phase, limit):
+    async with limit:
+        start = time.perf_counter()
+        code = standin.authorize(user.name)
+        auth = await authenticator.get_authenticated_user(FakeHandler(code), None)
+        phase.latencies.append(time.perf_counter() - start)
+        phase.outcomes["ok" if auth else "failed"] += 1
+        if auth:
+            await user.save_auth_state(auth["auth_state"])
+            user._auth_refreshed = time.monotonic()
+
+
+async def browse(authenticator, user, phase, deadline, request_interval):
+    while time.monotonic() < deadline:
+        await asyncio.sleep(random.expovariate(1 / request_interval))
+        if user.auth_state is None:
+            # logged out by an expired refresh token
+            return
+        if time.monotonic() - user._auth_refreshed < authenticator.auth_refresh_age:
+            continue
+        start = time.perf_counter()
+        result = await authenticator.refresh_user(user)
+        phase.latencies.append(time.perf_counter() - start)
+        if isinstance(result, dict):
+            await user.save_auth_state(result["auth_state"])
+            phase.outcomes["refreshed"] += 1
+        elif result:
+            phase.outcomes["kept"] += 1
+        else:
+            phase.outcomes["logged_out"] += 1
+            user.auth_state = None
+            continue
+        user._auth_refreshed = time.monotonic()
+
+
+async def main(args):
+    standin = OIDCStandIn(
+        realm=args.realm,
+        access_lifetime=args.access_lifetime,
+        refresh_lifetime=args.refresh_lifetime,
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        error_rate=args.error_rate,
+    )
+    issuer = start_in_thread(standin)
+    users = [FakeUser(f"user{i}") for i in range(args.users)]
+    authenticator = RefreshingAuthenticator(
+        client_id="djlabhub",
+        client_secret="secret",
+        oauth_callback_url="http://127.0.0.1:8000/hub/oauth_callback",
+        username_claim="preferred_username",
+        enable_auth_state=True,
+        allow_all=True,
+        auth_refresh_age=args.auth_refresh_age,
+        token_max_clients=args.max_clients,
+        proactive_refresh=args.proactive,
+        **endpoints(issuer),
+    )
+    authenticator.refresh_scheduler.users = lambda: users
+
+    lags, done = [], asyncio.Event()
+    tick = asyncio.create_task(ticker(args.interval, lags, done))
+
+    logins = Phase("login")
+    limit = asyncio.Semaphore(args.login_concurrency)
+    start = time.perf_counter()
+    await asyncio.gather(*(login(authenticator, standin, u, logins, limit) for u in users))
+    print(f"logged in {len(users)} users in {time.perf_counter() - start:.1f}s")
+
+    refreshes = Phase("refresh")
+    deadline = time.monotonic() + args.duration
+    await asyncio.gather(
+        *(browse(authenticator, u, refreshes, deadline, args.request_interval) for u in users)
+    )
+    done.set()
+    await tick
+    authenticator.refresh_scheduler.stop()
+
+    logins.report()
+    refreshes.report()
+    print(f"token endpoint requests: {standin.requests}")
+    if lags:
+        print(
+            f"loop lag p50={percentile(lags, 50) * 1000:.1f} ms  "
+            f"p99={percentile(lags, 99) * 1000:.1f} ms  max={max(lags) * 1000:.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=60, help="seconds of browsing after login")
+    parser.add_argument("--request-interval", type=float, default=5, help="mean seconds between a user's requests")
+    parser.add_argument("--auth-refresh-age", type=int, default=45)
+    parser.add_argument("--login-concurrency", type=int, default=100)
+    parser.add_argument("--max-clients", type=int, default=20)
+    parser.add_argument("--interval", type=float, default=0.01, help="loop lag ticker interval (s)")
+    parser.add_argument("--proactive", action="store_true", help="enable the background refresh scheduler")
+    add_arguments(parser)
+    parser.set_defaults(access_lifetime=60)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,90 @@
+"""
+Compare Docker API calls through DockerSpawner's executor with AsyncDockerClient.
+
+`--calls` inspect calls are issued at once, as many polling and spawning
+users would, against the containers (or, without containers, the images)
+on the local Docker daemon. Each call's latency, the total throughput and
+the event-loop lag measured by a ticker coroutine are reported.
+
+    python benchmarks/docker_api.py --calls 2000 --client threads
+    python benchmarks/docker_api.py --calls 2000 --client async
+
+`--client threads` is DockerSpawner's path: docker-py on a single-thread
+executor (`--threads` to widen it).
+"""
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import docker
+from refresh_event_loop import percentile, ticker
+
+from djlabhub.docker_api import AsyncDockerClient
+
+
+async def main(args):
+    client = docker.APIClient(base_url="unix://" + args.socket, version="auto")
+    targets = [("inspect_container", c["Id"]) for c in client.containers(all=True)]
+    if not targets:
+        targets = [("inspect_image", i["Id"]) for i in client.images()]
+    if not targets:
+        raise SystemExit("No containers or images to inspect on %s" % args.socket)
+
+    if args.client == "async":
+        async_client = AsyncDockerClient(
+            args.socket,
+            version=client.api_version,
+            max_connections=args.max_connections,
+            max_pipeline=args.max_pipeline,
+            max_concurrency=args.max_concurrency,
+        )
+
+        def call(method, *a):
+            return getattr(async_client, method)(*a)
+
+    else:
+        executor = ThreadPoolExecutor(args.threads)
+
+        def call(method, *a):
+            return asyncio.wrap_future(executor.submit(getattr(client, method), *a))
+
+    latencies = []
+
+    async def timed(method, target):
+        start = time.perf_counter()
+        await call(method, target)
+        latencies.append(time.perf_counter() - start)
+
+    lags, done = [], asyncio.Event()
+    tick = asyncio.create_task(ticker(args.interval, lags, done))
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(timed(*targets[i % len(targets)]) for i in range(args.calls))
+    )
+    elapsed = time.perf_counter() - start
+    done.set()
+    await tick
+    if args.client == "async":
+        await async_client.close()
+
+    print(f"client:             {args.client}")
+    print(f"calls:              {args.calls} in {elapsed:.2f}s ({args.calls / elapsed:.0f}/s)")
+    print(f"call latency p50:   {percentile(latencies, 50) * 1000:.1f} ms")
+    print(f"call latency p99:   {percentile(latencies, 99) * 1000:.1f} ms")
+    if lags:
+        print(f"loop lag p99:       {percentile(lags, 99) * 1000:.1f} ms")
+        print(f"loop lag max:       {max(lags) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--client", choices=["threads", "async"], default="async")
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--socket", default="/var/run/docker.sock")
+    parser.add_argument("--threads", type=int, default=1, help="executor threads")
+    parser.add_argument("--max-connections", type=int, default=8)
+    parser.add_argument("--max-pipeline", type=int, default=8)
+    parser.add_argument("--max-concurrency", type=int, default=64)
+    parser.add_argument("--interval", type=float, default=0.01, help="ticker interval (s)")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,343 @@
+"""
+Local stand-in for a Docker daemon's Engine API, for offline benchmarks.
+
+Serves the subset of the API the hub's spawner, warm pool and placement
+scheduler use: `/info`, `/version`, image list and inspect, and container
+create, inspect, list, start, stop, rename, remove, archive upload and
+one-shot stats. Containers do not run anything; a started container is
+"running" until stopped, and reports a memory usage of `--usage` times its
+memory limit. Pulling an image takes `--pull-latency` seconds.
+
+    python benchmarks/docker_standin.py --port 2375 --cpus 16 --mem 64G \\
+        --image datajoint/djlabhub:singleuser-4.0.2-py3.10
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+from tornado import web
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+
+UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_bytes(value: str) -> int:
+    if value[-1].upper() in UNITS:
+        return int(float(value[:-1]) * UNITS[value[-1].upper()])
+    return int(value)
+
+
+class DockerStandIn:
+    """Daemon state shared by the request handlers."""
+
+    def __init__(
+        self,
+        name: str = "standin",
+        cpus: int = 8,
+        mem: int = 32 << 30,
+        images=(),
+        latency: float = 0.0,
+        pull_latency: float = 5.0,
+        usage: float = 0.5,
+    ):
+        self.name = name
+        self.cpus = cpus
+        self.mem = mem
+        self.images = {self._tag(image): "sha256:" + uuid.uuid4().hex for image in images}
+        self.latency = latency
+        self.pull_latency = pull_latency
+        self.usage = usage
+        # id -> container, as returned by inspect
+        self.containers = {}
+        self.url = None
+
+    @staticmethod
+    def _tag(image: str) -> str:
+        return image if ":" in image.split("/")[-1] else image + ":latest"
+
+    def find(self, ref: str):
+        ref = ref.lstrip("/")
+        for container in self.containers.values():
+            if container["Id"].startswith(ref) or container["Name"] == "/" + ref:
+                return container
+        raise web.HTTPError(404, reason="No such container: %s" % ref)
+
+    def create(self, name: str, config: dict) -> dict:
+        image = self._tag(config["Image"])
+        if image not in self.images:
+            raise web.HTTPError(404, reason="No such image: %s" % image)
+        if name and any(c["Name"] == "/" + name for c in self.containers.values()):
+            raise web.HTTPError(409, reason="Conflict. The container name /%s is already in use" % name)
+        container_id = uuid.uuid4().hex + uuid.uuid4().hex
+        self.containers[container_id] = {
+            "Id": container_id,
+            "Name": "/" + (name or container_id[:12]),
+            "Created": datetime.now(timezone.utc).isoformat(),
+            "Image": self.images[image],
+            "Config": {
+                "Image": config["Image"],
+                "Labels": config.get("Labels") or {},
+                "Env": config.get("Env") or [],
+                "Cmd": config.get("Cmd"),
+            },
+            "HostConfig": config.get("HostConfig") or {},
+            "State": {
+                "Status": "created", "Running": False, "ExitCode": 0, "Error": "",
+                "StartedAt": "0001-01-01T00:00:00Z", "FinishedAt": "0001-01-01T00:00:00Z",
+            },
+            "NetworkSettings": {
+                "IPAddress": "", "Ports": {},
+                "Networks": {
+                    network: {"IPAddress": "10.%i.%i.%i" % tuple(random.randrange(1, 255) for _ in range(3))}
+                    for network in [(config.get("HostConfig") or {}).get("NetworkMode") or "bridge"]
+                },
+            },
+        }
+        return self.containers[container_id]
+
+    def summary(self, container: dict) -> dict:
+        return {
+            "Id": container["Id"],
+            "Names": [container["Name"]],
+            "Image": container["Config"]["Image"],
+            "Labels": container["Config"]["Labels"],
+            "State": container["State"]["Status"],
+            "Status": "Up" if container["State"]["Running"] else "Exited (0)",
+        }
+
+
+class BaseHandler(web.RequestHandler):
+    @property
+    def daemon(self) -> DockerStandIn:
+        return self.settings["standin"]
+
+    async def prepare(self):
+        if self.daemon.latency:
+            await asyncio.sleep(self.daemon.latency)
+
+    def write_json(self, data, status=200):
+        self.set_status(status)
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps(data))
+
+    def write_error(self, status_code, **kwargs):
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps({"message": self._reason}))
+
+    def filters(self) -> dict:
+        return json.loads(self.get_argument("filters", "{}"))
+
+
+class InfoHandler(BaseHandler):
+    def get(self):
+        d = self.daemon
+        running = sum(1 for c in d.containers.values() if c["State"]["Running"])
+        self.write_json({
+            "Name": d.name, "NCPU": d.cpus, "MemTotal": d.mem,
+            "Containers": len(d.containers), "ContainersRunning": running,
+            "Images": len(d.images),
+        })
+
+
+class VersionHandler(BaseHandler):
+    def get(self):
+        self.write_json({"ApiVersion": "1.41", "MinAPIVersion": "1.12", "Version": "standin"})
+
+
+class PingHandler(BaseHandler):
+    def get(self):
+        self.finish("OK")
+
+
+class ImagesHandler(BaseHandler):
+    def get(self):
+        self.write_json([
+            {"Id": image_id, "RepoTags": [tag], "Size": 1 << 30}
+            for tag, image_id in self.daemon.images.items()
+        ])
+
+
+class ImageHandler(BaseHandler):
+    def get(self, name):
+        tag = self.daemon._tag(name)
+        if tag not in self.daemon.images:
+            raise web.HTTPError(404, reason="No such image: %s" % name)
+        self.write_json({
+            "Id": self.daemon.images[tag], "RepoTags": [tag], "RepoDigests": [],
+            "Size": 1 << 30, "Config": {"Cmd": ["start-notebook.sh"], "Labels": {}},
+        })
+
+
+class PullHandler(BaseHandler):
+    async def post(self):
+        image = self.get_argument("fromImage") + ":" + self.get_argument("tag", "latest")
+        await asyncio.sleep(self.daemon.pull_latency)
+        self.daemon.images.setdefault(image, "sha256:" + uuid.uuid4().hex)
+        self.write_json({"status": "Downloaded newer image for %s" % image})
+
+
+class ContainersHandler(BaseHandler):
+    def get(self):
+        filters = self.filters()
+        show_all = self.get_argument("all", "0") not in ("0", "false")
+        result = []
+        for container in self.daemon.containers.values():
+            if not show_all and not container["State"]["Running"]:
+                continue
+            labels = container["Config"]["Labels"]
+            if not all(
+                (label.partition("=")[0] in labels)
+                and (not label.partition("=")[2] or labels[label.partition("=")[0]] == label.partition("=")[2])
+                for label in filters.get("label", [])
+            ):
+                continue
+            if filters.get("name") and not any(
+                re.search(pattern, container["Name"]) for pattern in filters["name"]
+            ):
+                continue
+            if filters.get("status") and container["State"]["Status"] not in filters["status"]:
+                continue
+            result.append(self.daemon.summary(container))
+        self.write_json(result)
+
+
+class CreateHandler(BaseHandler):
+    def post(self):
+        container = self.daemon.create(self.get_argument("name", ""), json.loads(self.request.body))
+        self.write_json({"Id": container["Id"], "Warnings": []}, status=201)
+
+
+class ContainerHandler(BaseHandler):
+    def get(self, ref):
+        self.write_json(self.daemon.find(ref))
+
+    def delete(self, ref):
+        container = self.daemon.find(ref)
+        if container["State"]["Running"] and self.get_argument("force", "0") in ("0", "false"):
+            raise web.HTTPError(409, reason="You cannot remove a running container")
+        del self.daemon.containers[container["Id"]]
+        self.set_status(204)
+        self.finish()
+
+
+class ActionHandler(BaseHandler):
+    def post(self, ref, action):
+        container = self.daemon.find(ref)
+        state = container["State"]
+        now = datetime.now(timezone.utc).isoformat()
+        if action == "start":
+            if state["Running"]:
+                self.set_status(304)
+                return self.finish()
+            state.update(Status="running", Running=True, StartedAt=now)
+        elif action == "stop":
+            if not state["Running"]:
+                self.set_status(304)
+                return self.finish()
+            state.update(Status="exited", Running=False, FinishedAt=now)
+        elif action == "rename":
+            container["Name"] = "/" + self.get_argument("name")
+        else:
+            raise web.HTTPError(404, reason="Unsupported action %s" % action)
+        self.set_status(204)
+        self.finish()
+
+
+class ArchiveHandler(BaseHandler):
+    def put(self, ref):
+        self.daemon.find(ref)
+        self.finish()
+
+
+class StatsHandler(BaseHandler):
+    def get(self, ref):
+        container = self.daemon.find(ref)
+        limit = container["HostConfig"].get("Memory") or (2 << 30)
+        usage = int(limit * self.daemon.usage * random.uniform(0.8, 1.2)) if container["State"]["Running"] else 0
+        self.write_json({
+            "read": time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "memory_stats": {"usage": usage, "limit": limit},
+            "cpu_stats": {"cpu_usage": {"total_usage": 0}, "online_cpus": self.daemon.cpus},
+        })
+
+
+def make_app(standin: DockerStandIn) -> web.Application:
+    version = r"(?:/v[0-9.]+)?"
+    return web.Application(
+        [
+            (version + r"/_ping", PingHandler),
+            (version + r"/info", InfoHandler),
+            (version + r"/version", VersionHandler),
+            (version + r"/images/json", ImagesHandler),
+            (version + r"/images/create", PullHandler),
+            (version + r"/images/(.+)/json", ImageHandler),
+            (version + r"/containers/json", ContainersHandler),
+            (version + r"/containers/create", CreateHandler),
+            (version + r"/containers/([^/]+)/json", ContainerHandler),
+            (version + r"/containers/([^/]+)/(start|stop|rename)", ActionHandler),
+            (version + r"/containers/([^/]+)/archive", ArchiveHandler),
+            (version + r"/containers/([^/]+)/stats", StatsHandler),
+            (version + r"/containers/([^/]+)", ContainerHandler),
+        ],
+        standin=standin,
+    )
+
+
+def start_in_thread(standin: DockerStandIn, host: str = "127.0.0.1", port: int = 0) -> str:
+    """
+    Serve `standin` from a thread with its own event loop and return its
+    `tcp://` URL.
+    """
+    ready = threading.Event()
+
+    def run():
+        async def serve():
+            sockets = bind_sockets(port, host)
+            bound = sockets[0].getsockname()[1]
+            standin.url = f"tcp://{host}:{bound}"
+            HTTPServer(make_app(standin)).add_sockets(sockets)
+            ready.set()
+            await asyncio.Event().wait()
+
+        asyncio.run(serve())
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+    return standin.url
+
+
+async def main(args):
+    standin = DockerStandIn(
+        name=args.name,
+        cpus=args.cpus,
+        mem=parse_bytes(args.mem),
+        images=args.image,
+        latency=args.latency,
+        pull_latency=args.pull_latency,
+        usage=args.usage,
+    )
+    sockets = bind_sockets(args.port, args.host)
+    HTTPServer(make_app(standin)).add_sockets(sockets)
+    print(f"Serving Docker stand-in {args.name} on tcp://{args.host}:{args.port}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2375)
+    parser.add_argument("--name", default="standin")
+    parser.add_argument("--cpus", type=int, default=8)
+    parser.add_argument("--mem", default="32G")
+    parser.add_argument("--image", action="append", default=[], help="image present on the host, repeatable")
+    parser.add_argument("--latency", type=float, default=0.0, help="API latency (s)")
+    parser.add_argument("--pull-latency", type=float, default=5.0, help="image pull time (s)")
+    parser.add_argument("--usage", type=float, default=0.5, help="memory usage as a fraction of the limit")
+    asyncio.run(main(parser.parse_args()))
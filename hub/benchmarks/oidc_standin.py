@@ -0,0 +1,263 @@
+"""
+Local stand-in for the Keycloak realm used by the hub, for offline benchmarks.
+
+Serves Keycloak's OpenID Connect paths under
+`/realms/<realm>/protocol/openid-connect/`: `auth`, `token`, `userinfo` and
+`certs`. Access tokens are RS256 JWTs whose key is published in `certs`;
+refresh tokens are HS256 JWTs signed with a private secret, as Keycloak does.
+Refresh tokens rotate: each one can be exchanged only once.
+
+Latency and error rate of the token endpoint are configurable, so the
+authenticator can be measured against a slow or failing issuer.
+
+    python benchmarks/oidc_standin.py --port 8080 --access-lifetime 60
+    OAUTH2_ISSUER_URL=http://<host>:8080/realms/datajoint docker compose up
+"""
+import argparse
+import asyncio
+import json
+import random
+import secrets
+import threading
+import time
+import uuid
+from typing import Optional
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt.algorithms import RSAAlgorithm
+from tornado import web
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+
+PREFIX = "/realms/{realm}/protocol/openid-connect"
+
+
+class OIDCStandIn:
+    """Token issuer state shared by the request handlers."""
+
+    def __init__(
+        self,
+        realm: str = "datajoint",
+        access_lifetime: int = 300,
+        refresh_lifetime: int = 1800,
+        latency: float = 0.0,
+        latency_jitter: float = 0.0,
+        error_rate: float = 0.0,
+    ):
+        self.realm = realm
+        self.access_lifetime = access_lifetime
+        self.refresh_lifetime = refresh_lifetime
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.issuer = None
+        self.kid = uuid.uuid4().hex
+        self._key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self._secret = secrets.token_bytes(32)
+        # authorization code -> username
+        self._codes = {}
+        # refresh token jti that have been exchanged already
+        self._used = set()
+        self.requests = 0
+
+    @property
+    def jwks(self) -> dict:
+        jwk = json.loads(RSAAlgorithm.to_jwk(self._key.public_key()))
+        jwk.update(kid=self.kid, use="sig", alg="RS256")
+        return {"keys": [jwk]}
+
+    def issue(self, username: str, access_lifetime: Optional[int] = None) -> dict:
+        """Return a token response for `username`, as `token` would."""
+        now = int(time.time())
+        access_lifetime = self.access_lifetime if access_lifetime is None else access_lifetime
+        claims = dict(iss=self.issuer, sub=username, preferred_username=username, iat=now)
+        access = jwt.encode(
+            dict(claims, exp=now + access_lifetime, typ="Bearer", jti=uuid.uuid4().hex),
+            self._key,
+            algorithm="RS256",
+            headers={"kid": self.kid},
+        )
+        refresh = jwt.encode(
+            dict(claims, exp=now + self.refresh_lifetime, typ="Refresh", jti=uuid.uuid4().hex),
+            self._secret,
+            algorithm="HS256",
+        )
+        return dict(
+            access_token=access,
+            refresh_token=refresh,
+            id_token=access,
+            token_type="Bearer",
+            expires_in=access_lifetime,
+            refresh_expires_in=self.refresh_lifetime,
+            scope="openid",
+        )
+
+    def authorize(self, username: str) -> str:
+        code = secrets.token_urlsafe(16)
+        self._codes[code] = username
+        return code
+
+    def redeem_code(self, code: str) -> Optional[str]:
+        return self._codes.pop(code, None)
+
+    def redeem_refresh(self, token: str) -> Optional[str]:
+        try:
+            claims = jwt.decode(token, self._secret, algorithms=["HS256"])
+        except jwt.InvalidTokenError:
+            return None
+        if claims["jti"] in self._used:
+            return None
+        self._used.add(claims["jti"])
+        return claims["preferred_username"]
+
+    def username_for_access(self, token: str) -> Optional[str]:
+        try:
+            claims = jwt.decode(token, self._key.public_key(), algorithms=["RS256"])
+        except jwt.InvalidTokenError:
+            return None
+        return claims["preferred_username"]
+
+
+class BaseHandler(web.RequestHandler):
+    @property
+    def standin(self) -> OIDCStandIn:
+        return self.settings["standin"]
+
+    def oauth_error(self, status: int, error: str):
+        self.set_status(status)
+        self.finish(dict(error=error))
+
+
+class AuthorizeHandler(BaseHandler):
+    def get(self):
+        # no login form, the username comes from `login_hint` or is made up
+        username = self.get_argument("login_hint", None) or f"user{random.randrange(10**6)}"
+        code = self.standin.authorize(username)
+        state = self.get_argument("state", "")
+        self.redirect(f"{self.get_argument('redirect_uri')}?code={code}&state={state}")
+
+
+class TokenHandler(BaseHandler):
+    async def post(self):
+        standin = self.standin
+        standin.requests += 1
+        delay = standin.latency + random.uniform(0, standin.latency_jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if random.random() < standin.error_rate:
+            return self.oauth_error(503, "temporarily_unavailable")
+
+        grant_type = self.get_body_argument("grant_type")
+        if grant_type == "authorization_code":
+            username = standin.redeem_code(self.get_body_argument("code"))
+        elif grant_type == "refresh_token":
+            username = standin.redeem_refresh(self.get_body_argument("refresh_token"))
+        else:
+            return self.oauth_error(400, "unsupported_grant_type")
+        if username is None:
+            return self.oauth_error(400, "invalid_grant")
+        self.finish(standin.issue(username))
+
+
+class UserInfoHandler(BaseHandler):
+    def get(self):
+        auth = self.request.headers.get("Authorization", "")
+        username = self.standin.username_for_access(auth.partition(" ")[2])
+        if username is None:
+            return self.oauth_error(401, "invalid_token")
+        self.finish(
+            dict(
+                sub=username,
+                preferred_username=username,
+                email=f"{username}@example.com",
+                groups=["students"],
+            )
+        )
+
+
+class CertsHandler(BaseHandler):
+    def get(self):
+        self.set_header("Cache-Control", "max-age=300")
+        self.finish(self.standin.jwks)
+
+
+def make_app(standin: OIDCStandIn) -> web.Application:
+    prefix = PREFIX.format(realm=standin.realm)
+    return web.Application(
+        [
+            (prefix + "/auth", AuthorizeHandler),
+            (prefix + "/token", TokenHandler),
+            (prefix + "/userinfo", UserInfoHandler),
+            (prefix + "/certs", CertsHandler),
+        ],
+        standin=standin,
+    )
+
+
+def start_in_thread(standin: OIDCStandIn, host: str = "127.0.0.1", port: int = 0) -> str:
+    """
+    Serve `standin` from a thread with its own event loop and return its
+    realm URL. Keeping it off the benchmarked loop means that a blocked hub
+    loop cannot stall the issuer it is waiting on.
+    """
+    ready = threading.Event()
+
+    def run():
+        async def serve():
+            sockets = bind_sockets(port, host)
+            bound = sockets[0].getsockname()[1]
+            standin.issuer = f"http://{host}:{bound}/realms/{standin.realm}"
+            HTTPServer(make_app(standin)).add_sockets(sockets)
+            ready.set()
+            await asyncio.Event().wait()
+
+        asyncio.run(serve())
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+    return standin.issuer
+
+
+def endpoints(issuer: str) -> dict:
+    """GenericOAuthenticator settings pointing at a realm URL."""
+    base = issuer + "/protocol/openid-connect"
+    return dict(
+        authorize_url=base + "/auth",
+        token_url=base + "/token",
+        userdata_url=base + "/userinfo",
+    )
+
+
+async def main(args):
+    standin = OIDCStandIn(
+        realm=args.realm,
+        access_lifetime=args.access_lifetime,
+        refresh_lifetime=args.refresh_lifetime,
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        error_rate=args.error_rate,
+    )
+    sockets = bind_sockets(args.port, args.host)
+    standin.issuer = f"http://{args.public_host or args.host}:{args.port}/realms/{args.realm}"
+    HTTPServer(make_app(standin)).add_sockets(sockets)
+    print(f"Serving realm {standin.issuer}")
+    await asyncio.Event().wait()
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--realm", default="datajoint")
+    parser.add_argument("--access-lifetime", type=int, default=300, help="seconds")
+    parser.add_argument("--refresh-lifetime", type=int, default=1800, help="seconds")
+    parser.add_argument("--latency", type=float, default=0.0, help="token endpoint latency (s)")
+    parser.add_argument("--latency-jitter", type=float, default=0.0, help="extra random latency (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of 503 responses")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--public-host", help="host name the hub uses to reach the stand-in")
+    parser.add_argument("--port", type=int, default=8080)
+    add_arguments(parser)
+    asyncio.run(main(parser.parse_args()))
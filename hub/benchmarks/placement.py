@@ -0,0 +1,116 @@
+"""
+Place spawns across several Docker hosts with the hub's placement scheduler.
+
+Starts `--hosts` Docker stand-ins (`benchmarks/docker_standin.py`) of
+alternating sizes, with the image cached on every other host, and places and
+starts `--spawns` containers on them as DJLabSpawner would. Each host's
+allocation and memory in use are reported, along with how many spawns found
+their image cached and how many were refused for lack of capacity. A second
+scheduler then recovers every allocation from container labels, as a
+restarted hub does.
+
+    python benchmarks/placement.py --hosts 4 --spawns 200 --usage 0.6
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from docker_standin import DockerStandIn, start_in_thread
+from refresh_event_loop import percentile
+
+from djlabhub.placement import NoCapacity, PlacementScheduler
+
+IMAGE = "datajoint/djlabhub:singleuser-4.0.2-py3.10"
+
+
+async def spawn(scheduler, key, cpu, mem, latencies, outcomes):
+    start = time.perf_counter()
+    try:
+        host = await scheduler.place(key, IMAGE, cpu, mem)
+    except NoCapacity:
+        outcomes["refused"] += 1
+        return
+    outcomes["cached" if host.has_image(IMAGE) else "pulled"] += 1
+    latencies.append(time.perf_counter() - start)
+    try:
+        if not host.has_image(IMAGE):
+            await host.docker("pull", IMAGE)
+            host.images.add(IMAGE)
+        container = await host.docker(
+            "create_container",
+            IMAGE,
+            name=key,
+            labels=scheduler.labels(host, cpu, mem),
+            host_config=host.client.create_host_config(mem_limit=mem, nano_cpus=int(cpu * 1e9)),
+        )
+        scheduler.placed(host, key, container["Id"])
+        await host.docker("start", container["Id"])
+    finally:
+        scheduler.cancel(host, key)
+
+
+def report(scheduler):
+    for host in scheduler.hosts.values():
+        print(
+            f"  {host.name}: {len(host.allocations):4d} containers"
+            f"  cpu {host.allocated_cpu:6.1f}/{host.cpu:<5.0f}"
+            f"  mem {host.allocated_mem / 2**30:6.1f}/{host.mem / 2**30:<5.0f}GB"
+            f"  in use {host.used_mem / 2**30:6.1f}GB"
+        )
+
+
+async def main(args):
+    standins = [
+        DockerStandIn(
+            name=f"host{i}",
+            cpus=args.cpus * (2 if i % 2 else 1),
+            mem=(args.mem << 30) * (2 if i % 2 else 1),
+            images=[IMAGE] if i % 2 == 0 else [],
+            latency=args.latency,
+            pull_latency=args.pull_latency,
+            usage=args.usage,
+        )
+        for i in range(args.hosts)
+    ]
+    hosts = {standin.name: {"url": start_in_thread(standin)} for standin in standins}
+
+    scheduler = PlacementScheduler(hosts, refresh_interval=args.refresh_interval)
+    sizes = [(0.5, 1 << 30), (1, 2 << 30), (2, 4 << 30)]
+    latencies = []
+    outcomes = {"cached": 0, "pulled": 0, "refused": 0}
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        spawn(scheduler, f"jupyter-user{i}", *random.choice(sizes), latencies, outcomes)
+        for i in range(args.spawns)
+    ))
+    elapsed = time.perf_counter() - start
+
+    print(f"spawns:             {args.spawns} in {elapsed:.2f}s")
+    print(f"image cached:       {outcomes['cached']}")
+    print(f"image pulled:       {outcomes['pulled']}")
+    print(f"no capacity:        {outcomes['refused']}")
+    if latencies:
+        print(f"placement p50:      {percentile(latencies, 50) * 1000:.1f} ms")
+        print(f"placement p99:      {percentile(latencies, 99) * 1000:.1f} ms")
+    await scheduler.refresh(force=True)
+    print("allocation:")
+    report(scheduler)
+
+    recovered = PlacementScheduler(hosts)
+    await recovered.refresh(force=True)
+    print("recovered from labels:")
+    report(recovered)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--hosts", type=int, default=4)
+    parser.add_argument("--spawns", type=int, default=200)
+    parser.add_argument("--cpus", type=int, default=16, help="CPUs of the smaller hosts")
+    parser.add_argument("--mem", type=int, default=64, help="memory (GB) of the smaller hosts")
+    parser.add_argument("--usage", type=float, default=0.5, help="memory usage as a fraction of the limit")
+    parser.add_argument("--latency", type=float, default=0.005, help="Docker API latency (s)")
+    parser.add_argument("--pull-latency", type=float, default=2.0, help="image pull time (s)")
+    parser.add_argument("--refresh-interval", type=float, default=5.0)
+    asyncio.run(main(parser.parse_args()))
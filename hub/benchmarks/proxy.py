@@ -0,0 +1,283 @@
+"""
+Compare configurable-http-proxy (`DJLabProxy`) with Traefik (`DJLabTraefikProxy`).
+
+Each proxy is started by its JupyterHub proxy class, as the hub starts it,
+and given `--routes` user routes at once, as after a hub restart, all
+pointing at a local backend. Then:
+
+- requests: `--connections` keep-alive connections, spread over
+  `--workers` processes, request random user routes for `--duration`
+  seconds; requests per second and p50/p99 latency
+- websocket fan-out: `--websockets` connections through the proxy each
+  receive `--messages` messages of `--size` bytes, which the backend sends
+  to all of them at once; messages per second and p50/p99 delivery latency
+
+The backend and the clients are the same for both proxies. For Traefik, a
+new proxy instance, as a restarted hub would, then reads the routes back
+from the routes file.
+
+Needs `configurable-http-proxy` and `traefik` on the PATH:
+
+    npm install -g configurable-http-proxy
+    python -m jupyterhub_traefik_proxy.install --output=/usr/local/bin
+    python benchmarks/proxy.py --routes 2000 --connections 64 --websockets 500
+"""
+import argparse
+import asyncio
+import inspect
+import json
+import multiprocessing
+import os
+import random
+import re
+import socket
+import tempfile
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+
+from refresh_event_loop import percentile
+from tornado import web, websocket
+from tornado.httpclient import AsyncHTTPClient
+
+from djlabhub.proxy import DJLabProxy
+from djlabhub.traefik import DJLabTraefikProxy
+
+CONTENT_LENGTH = re.compile(rb"content-length:\s*(\d+)", re.IGNORECASE)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class Ping(web.RequestHandler):
+    def get(self, path):
+        self.finish(b"pong")
+
+
+class FanOut(websocket.WebSocketHandler):
+    sockets: set = set()
+
+    def open(self, path):
+        self.sockets.add(self)
+
+    def on_close(self):
+        self.sockets.discard(self)
+
+
+class Broadcast(web.RequestHandler):
+    async def post(self):
+        connections = int(self.get_argument("connections"))
+        messages = int(self.get_argument("messages"))
+        padding = "x" * int(self.get_argument("size"))
+        deadline = time.monotonic() + 60
+        while len(FanOut.sockets) < connections:
+            if time.monotonic() > deadline:
+                raise web.HTTPError(504, "%d of %d websockets connected", len(FanOut.sockets), connections)
+            await asyncio.sleep(0.05)
+        for _ in range(messages):
+            message = json.dumps({"sent": time.time(), "padding": padding})
+            for sock in list(FanOut.sockets):
+                sock.write_message(message)
+            await asyncio.sleep(0)
+        self.finish()
+
+
+def serve_backend(port: int):
+    async def serve():
+        web.Application([
+            (r"/fanout", Broadcast),
+            (r"(.*)/ws", FanOut),
+            (r"(.*)", Ping),
+        ]).listen(port, "127.0.0.1")
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+async def _requests(port, paths, connections, duration):
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def client():
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            try:
+                while time.perf_counter() < deadline:
+                    path = random.choice(paths) + "ping"
+                    start = time.perf_counter()
+                    writer.write(f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n\r\n".encode())
+                    head = await reader.readuntil(b"\r\n\r\n")
+                    length = CONTENT_LENGTH.search(head)
+                    await reader.readexactly(int(length.group(1)) if length else 0)
+                    if head.split(b" ", 2)[1] != b"200":
+                        errors += 1
+                    latencies.append(time.perf_counter() - start)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                # closed by the proxy: reconnect
+                errors += 1
+            finally:
+                writer.close()
+
+    await asyncio.gather(*(client() for _ in range(connections)))
+    return latencies, errors
+
+
+def run_requests(port, paths, connections, duration):
+    return asyncio.run(_requests(port, paths, connections, duration))
+
+
+async def _websockets(port, paths, connections, messages, timeout):
+    start = time.perf_counter()
+    conns = await asyncio.gather(*(
+        websocket.websocket_connect(f"ws://127.0.0.1:{port}{random.choice(paths)}ws")
+        for _ in range(connections)
+    ))
+    connect_seconds = time.perf_counter() - start
+    latencies = []
+
+    async def receive(conn):
+        for _ in range(messages):
+            message = await conn.read_message()
+            if message is None:
+                break
+            latencies.append(time.time() - json.loads(message)["sent"])
+        conn.close()
+
+    await asyncio.wait_for(asyncio.gather(*(receive(conn) for conn in conns)), timeout)
+    return latencies, connect_seconds
+
+
+def run_websockets(port, paths, connections, messages, timeout):
+    return asyncio.run(_websockets(port, paths, connections, messages, timeout))
+
+
+def split(total, parts):
+    return [n for n in (total // parts + (i < total % parts) for i in range(parts)) if n]
+
+
+def make_proxy(kind, args, backend, tmp):
+    public_url = f"http://127.0.0.1:{free_port()}"
+    if kind == "chp":
+        proxy = DJLabProxy(
+            public_url=public_url,
+            api_url=f"http://127.0.0.1:{free_port()}",
+            auth_token=uuid.uuid4().hex,
+            command=[args.chp_command],
+            pid_file=os.path.join(tmp, "chp.pid"),
+            log_level="warn",
+            should_start=True,
+        )
+        # what ConfigurableHTTPProxy.start needs from the hub
+        proxy.app = SimpleNamespace(subdomain_host="", internal_ssl=False)
+        proxy.hub = SimpleNamespace(url=f"{backend}/hub/")
+        return proxy
+    return DJLabTraefikProxy(
+        public_url=public_url,
+        traefik_api_url=f"http://127.0.0.1:{free_port()}",
+        traefik_api_username="benchmark",
+        traefik_api_password=uuid.uuid4().hex,
+        static_config_file=os.path.join(tmp, "traefik.toml"),
+        dynamic_config_file=os.path.join(tmp, "rules.toml"),
+        traefik_log_level="ERROR",
+        concurrency=args.route_concurrency,
+        should_start=True,
+    )
+
+
+async def bench(kind, args, backend, pool):
+    loop = asyncio.get_running_loop()
+    with tempfile.TemporaryDirectory() as tmp:
+        proxy = make_proxy(kind, args, backend, tmp)
+        await proxy.start()
+        try:
+            paths = [f"/user/u{i}/" for i in range(args.routes)]
+            start = time.perf_counter()
+            await asyncio.gather(*(
+                proxy.add_route(path, backend, {"user": f"u{i}"}) for i, path in enumerate(paths)
+            ))
+            route_seconds = time.perf_counter() - start
+            port = int(proxy.public_url.rsplit(":", 1)[1].rstrip("/"))
+
+            results = await asyncio.gather(*(
+                loop.run_in_executor(pool, run_requests, port, paths, n, args.duration)
+                for n in split(args.connections, args.workers)
+            ))
+            latencies = [latency for result in results for latency in result[0]]
+            errors = sum(result[1] for result in results)
+
+            start = time.perf_counter()
+            fan_out = asyncio.gather(*(
+                loop.run_in_executor(pool, run_websockets, port, paths, n, args.messages, args.timeout)
+                for n in split(args.websockets, args.workers)
+            ))
+            await AsyncHTTPClient().fetch(
+                f"{backend}/fanout?connections={args.websockets}&messages={args.messages}&size={args.size}",
+                method="POST",
+                body=b"",
+                request_timeout=args.timeout,
+            )
+            results = await fan_out
+            fan_out_seconds = time.perf_counter() - start
+            deliveries = [latency for result in results for latency in result[0]]
+            connect_seconds = max(result[1] for result in results)
+
+            print(f"{kind}:")
+            print(f"  routes:           {args.routes} added in {route_seconds:.2f}s"
+                  f" ({args.routes / route_seconds:.0f}/s)")
+            print(f"  requests:         {len(latencies) / args.duration:.0f}/s, {errors} errors")
+            print(f"  request p50:      {percentile(latencies, 50) * 1000:.2f} ms")
+            print(f"  request p99:      {percentile(latencies, 99) * 1000:.2f} ms")
+            print(f"  websockets:       {args.websockets} connected in {connect_seconds:.2f}s")
+            print(f"  fan-out:          {len(deliveries)} of {args.websockets * args.messages} messages,"
+                  f" {len(deliveries) / fan_out_seconds:.0f}/s")
+            if deliveries:
+                print(f"  delivery p50:     {percentile(deliveries, 50) * 1000:.2f} ms")
+                print(f"  delivery p99:     {percentile(deliveries, 99) * 1000:.2f} ms")
+
+            if kind == "traefik":
+                start = time.perf_counter()
+                # same routes file
+                restarted = make_proxy(kind, args, backend, tmp)
+                routes = await restarted.get_all_routes()
+                print(f"  after restart:    {len(routes)} routes read back in"
+                      f" {time.perf_counter() - start:.2f}s")
+        finally:
+            stopped = proxy.stop()
+            if inspect.isawaitable(stopped):
+                await stopped
+
+
+async def main(args):
+    context = multiprocessing.get_context("spawn")
+    port = free_port()
+    backend = context.Process(target=serve_backend, args=(port,), daemon=True)
+    backend.start()
+    await asyncio.sleep(1)
+    try:
+        with ProcessPoolExecutor(args.workers, mp_context=context) as pool:
+            for kind in args.proxy:
+                await bench(kind, args, f"http://127.0.0.1:{port}", pool)
+    finally:
+        backend.terminate()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--proxy", nargs="+", choices=["chp", "traefik"], default=["chp", "traefik"])
+    parser.add_argument("--routes", type=int, default=2000)
+    parser.add_argument("--route-concurrency", type=int, default=64, help="DJLabTraefikProxy.concurrency")
+    parser.add_argument("--connections", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of requests")
+    parser.add_argument("--websockets", type=int, default=500)
+    parser.add_argument("--messages", type=int, default=100, help="messages to every websocket")
+    parser.add_argument("--size", type=int, default=256, help="message size (bytes)")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--chp-command", default="configurable-http-proxy")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,109 @@
+"""
+Measure hub event-loop latency while many users refresh their tokens at once.
+
+A local OIDC stand-in (see `oidc_standin.py`) answers every refresh after
+`--latency` seconds, and `--users` fake users whose access tokens are due for refresh all call
+`RefreshingAuthenticator.refresh_user` concurrently. A ticker coroutine
+records how late the event loop wakes it up, which is what every other hub
+request (proxy routes, spawns) would experience.
+
+    python benchmarks/refresh_event_loop.py --users 1000 --latency 0.05
+    python benchmarks/refresh_event_loop.py --users 1000 --blocking
+
+`--blocking` runs the previous `urllib.request.urlopen` implementation for
+comparison.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from urllib import parse, request
+
+from oidc_standin import OIDCStandIn, endpoints, start_in_thread
+
+from djlabhub.auth import RefreshingAuthenticator
+
+
+class FakeUser:
+    def __init__(self, name: str, standin: OIDCStandIn):
+        self.name = name
+        # already expired, so that every user refreshes
+        tokens = standin.issue(name, access_lifetime=0)
+        self.auth_state = dict(
+            access_token=tokens["access_token"], refresh_token=tokens["refresh_token"]
+        )
+
+    async def get_auth_state(self):
+        return dict(self.auth_state)
+
+
+class BlockingAuthenticator(RefreshingAuthenticator):
+    """The synchronous implementation that predates the shared client."""
+
+    async def _refresh_token(self, refresh_token):
+        values = dict(
+            grant_type="refresh_token",
+            client_id=self.client_id,
+            client_secret=self.client_secret,
+            refresh_token=refresh_token,
+        )
+        data = parse.urlencode(values).encode("ascii")
+        with request.urlopen(request.Request(self.token_url, data)) as response:
+            data = json.loads(response.read())
+            return (data.get("access_token"), data.get("refresh_token"))
+
+
+async def ticker(interval: float, lags: list, done: asyncio.Event):
+    while not done.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def main(args):
+    standin = OIDCStandIn(latency=args.latency)
+    issuer = start_in_thread(standin)
+    cls = BlockingAuthenticator if args.blocking else RefreshingAuthenticator
+    authenticator = cls(
+        client_id="djlabhub",
+        client_secret="secret",
+        auth_refresh_age=60,
+        token_max_clients=args.max_clients,
+        **endpoints(issuer),
+    )
+    users = [FakeUser(f"user{i}", standin) for i in range(args.users)]
+
+    lags, done = [], asyncio.Event()
+    tick = asyncio.create_task(ticker(args.interval, lags, done))
+    start = time.perf_counter()
+    results = await asyncio.gather(*(authenticator.refresh_user(u) for u in users))
+    elapsed = time.perf_counter() - start
+    done.set()
+    await tick
+
+    refreshed = sum(1 for r in results if isinstance(r, dict))
+    print(f"implementation:     {'blocking' if args.blocking else 'async'}")
+    print(f"refreshed:          {refreshed}/{len(users)} in {elapsed:.2f}s")
+    if lags:
+        print(f"loop lag p50:       {percentile(lags, 50) * 1000:.1f} ms")
+        print(f"loop lag p99:       {percentile(lags, 99) * 1000:.1f} ms")
+        print(f"loop lag max:       {max(lags) * 1000:.1f} ms")
+        print(f"loop lag mean:      {statistics.mean(lags) * 1000:.1f} ms")
+    else:
+        print("loop lag:           ticker never ran, the loop was blocked throughout")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.05, help="token endpoint latency (s)")
+    parser.add_argument("--max-clients", type=int, default=20)
+    parser.add_argument("--interval", type=float, default=0.01, help="ticker interval (s)")
+    parser.add_argument("--blocking", action="store_true")
+    asyncio.run(main(parser.parse_args()))
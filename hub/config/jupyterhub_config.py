@@ -1,14 +1,9 @@
 import os
 import pwd
-import json
-import jwt
-import time
-from packaging import version
-from oauthenticator.generic import GenericOAuthenticator
-from traitlets import Tuple, Dict
+import sys
 from traitlets.config import Config
-from urllib import request, parse
-from urllib.error import HTTPError
+from djlabhub.auth import RefreshingAuthenticator
+from djlabhub import activity, credentials, readiness, spawn_timing
 
 c = Config() if "c" not in locals() else c
 
@@ -40,63 +35,6 @@ user = [u for u in pwd.getpwall() if u.pw_uid == os.getuid()][0]
 # c.JupyterHub.authenticator_class = "jupyterhub.auth.DummyAuthenticator"
 
 
-class RefreshingAuthenticator(GenericOAuthenticator):
-    """Custom Authenticator that refreshes OAuth tokens when needed."""
-
-    def _refresh_token(self, refresh_token: str) -> Tuple:
-        values = dict(
-            grant_type = 'refresh_token',
-            client_id = self.client_id,
-            client_secret = self.client_secret,
-            refresh_token = refresh_token
-        )
-        data = parse.urlencode(values).encode('ascii')
-
-        req = request.Request(self.token_url, data)
-        with request.urlopen(req) as response:
-            data = json.loads(response.read())
-            return (data.get('access_token', None), data.get('refresh_token', None))
-
-    def _decode_token(self, token: str) -> Dict:
-        if version.parse(jwt.__version__).major >= 2:
-            kw = dict(options=dict(verify_signature=False))
-        else:
-            kw = dict(verify=False)
-        return jwt.decode(token, algorithms='RS256', **kw)
-
-    async def refresh_user(self, user, handler=None):
-        """
-        Refresh user's OAuth tokens. This is called when user info is requested
-        and has passed more than "auth_refresh_age" seconds.
-        """
-        self.log.info('Refreshing OAuth tokens for user %s' % user.name)
-        try:
-            auth_state = await user.get_auth_state()
-            decoded_access_token = self._decode_token(auth_state['access_token'])
-            decoded_refresh_token = self._decode_token(auth_state['refresh_token'])
-            diff_access = decoded_access_token['exp'] - time.time()
-            # If we request the offline_access scope, our refresh token won't have expiration
-            diff_refresh = (decoded_refresh_token['exp'] - time.time()) if 'exp' in decoded_refresh_token else 0
-            if diff_access > self.auth_refresh_age:
-                # Access token is still valid and will stay until next refresh
-                return True
-            elif diff_refresh < 0:
-                # Refresh token not valid, need to re-authenticate again
-                return False
-            else:
-                # We need to refresh access token (which will also refresh the refresh token)
-                access_token, refresh_token = self._refresh_token(auth_state['refresh_token'])
-                auth_state['access_token'] = access_token
-                auth_state['refresh_token'] = refresh_token
-                self.log.debug('User %s OAuth tokens refreshed' % user.name)
-                return {'auth_state': auth_state}
-        except HTTPError as e:
-            self.log.error("Failure calling the renew endpoint: %s (code: %s)" % (e.read(), e.code))
-        except Exception:
-            self.log.error("Failed to refresh the OAuth tokens", exc_info=True)
-        return False
-
-
 ## TODO - callback_url needs to enable ssl
 c.JupyterHub.ssl_key = '/etc/letsencrypt/live/fakeservices.datajoint.io/privkey.pem'
 c.JupyterHub.ssl_cert = '/etc/letsencrypt/live/fakeservices.datajoint.io/fullchain.pem'
@@ -104,15 +42,43 @@ c.JupyterHub.authenticator_class = RefreshingAuthenticator
 c.GenericOAuthenticator.client_id = os.getenv("OAUTH2_CLIENT_ID")
 c.GenericOAuthenticator.client_secret = os.getenv("OAUTH2_CLIENT_SECRET")
 c.GenericOAuthenticator.oauth_callback_url = "https://127.0.0.1:8000/hub/oauth_callback"
-c.GenericOAuthenticator.authorize_url = "https://keycloak-qa.datajoint.io/realms/datajoint/protocol/openid-connect/auth"
-c.GenericOAuthenticator.token_url = "https://keycloak-qa.datajoint.io/realms/datajoint/protocol/openid-connect/token"
-c.GenericOAuthenticator.userdata_url = "https://keycloak-qa.datajoint.io/realms/datajoint/protocol/openid-connect/userinfo"
+# Keycloak realm, or a local stand-in (hub/benchmarks/oidc_standin.py) for offline testing
+oauth2_issuer_url = os.getenv("OAUTH2_ISSUER_URL", "https://keycloak-qa.datajoint.io/realms/datajoint")
+c.GenericOAuthenticator.authorize_url = f"{oauth2_issuer_url}/protocol/openid-connect/auth"
+c.GenericOAuthenticator.token_url = f"{oauth2_issuer_url}/protocol/openid-connect/token"
+c.GenericOAuthenticator.userdata_url = f"{oauth2_issuer_url}/protocol/openid-connect/userinfo"
 c.GenericOAuthenticator.login_service = "Datajoint"
 c.GenericOAuthenticator.username_claim = "preferred_username"
 c.GenericOAuthenticator.enable_auth_state = True
 c.GenericOAuthenticator.scope = ["openid"]
 c.GenericOAuthenticator.claim_groups_key = "groups"
 c.GenericOAuthenticator.admin_groups = ["datajoint"]
+# Store only what the singleuser servers read from auth_state; None stores the full OAuth response
+c.RefreshingAuthenticator.auth_state_fields = ["access_token", "refresh_token", "expires_at", "username"]
+# Decrypted auth_state kept in memory, for refresh_user and for the hub's own reads (users API)
+c.RefreshingAuthenticator.auth_state_cache_size = 1024
+c.RefreshingAuthenticator.auth_state_cache_ttl = 300
+c.RefreshingAuthenticator.cache_hub_auth_state_reads = True
+# Token endpoint client used by RefreshingAuthenticator.refresh_user
+c.RefreshingAuthenticator.token_request_timeout = 10
+c.RefreshingAuthenticator.token_connect_timeout = 5
+c.RefreshingAuthenticator.token_max_clients = 20
+# Concurrent refresh_user calls for a user share one refresh, reused for a few seconds
+c.RefreshingAuthenticator.refresh_result_ttl = 5
+# Access tokens are verified against the realm's JWKS (.../protocol/openid-connect/certs by default)
+c.RefreshingAuthenticator.verify_token_signature = True
+c.RefreshingAuthenticator.token_claims_cache_size = 4096
+# Refresh tokens of users with running servers in the background, before they expire
+c.RefreshingAuthenticator.proactive_refresh = True
+c.RefreshScheduler.margin = 60
+c.RefreshScheduler.jitter = 30
+c.RefreshScheduler.rate_limit = 10
+# Shed refreshes while the token endpoint is failing; still-valid tokens keep being served
+c.CircuitBreaker.window = 60
+c.CircuitBreaker.failure_rate = 0.5
+c.CircuitBreaker.min_calls = 10
+c.CircuitBreaker.backoff_base = 5
+c.CircuitBreaker.backoff_max = 300
 
 # If your authenticator needs extra configurations, set them in the pre-spawn hook
 def pre_spawn_hook(authenticator, spawner, auth_state):
@@ -139,7 +105,27 @@ c.KeyCloakAuthenticator.pre_spawn_hook = pre_spawn_hook
 #    - localprocess: jupyterhub.spawner.LocalProcessSpawner
 #    - simple: jupyterhub.spawner.SimpleLocalProcessSpawner
 #  Default: 'jupyterhub.spawner.LocalProcessSpawner'
-c.JupyterHub.spawner_class = "dockerspawner.DockerSpawner"
+c.JupyterHub.spawner_class = "djlabhub.spawner.DJLabSpawner"
+
+# Caps the route updates in flight to the proxy, e.g. after a hub restart
+c.JupyterHub.proxy_class = "djlabhub.proxy.DJLabProxy"
+c.DJLabProxy.route_concurrency = 32
+
+# Traefik as an external proxy (docker-compose.traefik.yaml): routes are kept in a file on a
+# volume shared with the proxy, added and deleted one at a time and written in batches, and
+# running servers stay reachable while the hub restarts
+if os.getenv("DJLABHUB_PROXY") == "traefik":
+    c.JupyterHub.proxy_class = "djlabhub.traefik.DJLabTraefikProxy"
+    c.JupyterHub.hub_connect_ip = "djlabhub-hub"
+    c.DJLabTraefikProxy.should_start = False
+    # TLS with the hub's ssl_cert and ssl_key, which the hub passes on to the proxy
+    c.DJLabTraefikProxy.traefik_entrypoint = "https"
+    c.DJLabTraefikProxy.traefik_api_url = "http://djlabhub-proxy:8099"
+    c.DJLabTraefikProxy.traefik_api_username = "jupyterhub"
+    c.DJLabTraefikProxy.traefik_api_password = os.getenv("TRAEFIK_API_PASSWORD", "")
+    c.DJLabTraefikProxy.dynamic_config_file = "/srv/traefik/rules.toml"
+    c.DJLabTraefikProxy.concurrency = 64
+    c.DJLabTraefikProxy.route_batch_delay = 0.05
 
 ## The ip address for the Hub process to *bind* to.
 #
@@ -158,6 +144,78 @@ c.DockerSpawner.start_timeout = 60
 c.Spawner.http_timeout = 60
 c.Spawner.start_timeout = 60
 c.DockerSpawner.container_image = "datajoint/djlabhub:singleuser-4.0.2-py3.10"
+# Idle, pre-started containers per image, claimed at spawn time (images need djlabhub-pool-wait)
+# c.DJLabSpawner.warm_pool_sizes = {
+#     "datajoint/djlabhub:singleuser-4.0.2-py3.10": 4,
+#     "datajoint/djlabhub:singleuser-ide-4.0.2-py3.11": 2,
+# }
+# c.WarmPool.refill_concurrency = 2
+
+# Images pulled ahead of time, and kept at their registry digest, by the image service
+prepull_images = [c.DockerSpawner.container_image]
+c.JupyterHub.services = [
+    {
+        "name": "djlabhub-images",
+        "command": [sys.executable, "-m", "djlabhub.services.images", "--port=10101"]
+        + [f"--image={image}" for image in prepull_images],
+    },
+    # Stops (or, with hibernate, hibernates) servers idle for an hour whose kernels are not
+    # computing, sooner under memory pressure; --grace=<profile or image>=<seconds> per profile
+    {
+        "name": "djlabhub-culler",
+        "command": [
+            sys.executable, "-m", "djlabhub.services.culler",
+            "--timeout=3600", "--pressure-timeout=600", "--memory-pressure=0.85",
+        ],
+    },
+    # Collects singleuser servers' activity reports and flushes them to the hub in bulk,
+    # one database commit per interval instead of one per report
+    {
+        "name": "djlabhub-activity",
+        "command": [sys.executable, "-m", "djlabhub.services.activity", "--port=10102", "--interval=60"],
+    },
+]
+c.DJLabSpawner.image_service_url = "http://127.0.0.1:10101"
+c.DJLabSpawner.activity_url = "http://djlabhub-hub:10102"
+
+# Spawns creating and starting containers at the same time: adapts between min and max,
+# lowered when a start takes longer than target_latency. Queue waits count against start_timeout.
+c.SpawnQueue.initial_concurrency = 4
+c.SpawnQueue.min_concurrency = 1
+c.SpawnQueue.max_concurrency = 16
+c.SpawnQueue.target_latency = 20
+
+# Containers placed across several Docker hosts (best fit on CPU and memory requests,
+# preferring hosts with the image). Needs a network reaching every host, e.g. an overlay network.
+# c.DJLabSpawner.docker_hosts = {
+#     "node1": {"url": "tcp://10.0.0.11:2375"},
+#     "node2": {"url": "tcp://10.0.0.12:2375", "cpu": 32, "mem": "128G"},
+# }
+# c.PlacementScheduler.default_cpu = 1
+# c.PlacementScheduler.default_mem = "2G"
+# c.PlacementScheduler.mem_overcommit = 1.0
+
+# Stopped (e.g. culled) servers are checkpointed to disk and restored on their next start,
+# kernels included. Needs CRIU on the Docker host and "experimental": true in daemon.json.
+# c.DJLabSpawner.hibernate = True
+
+# Homes of new users made copy-on-write from a template per DJLABHUB_REPO commit, cloned once
+# on the Docker host under HomeTemplates.root (overlay, or reflink on XFS/Btrfs)
+# c.DJLabSpawner.home_templates = True
+# c.HomeTemplates.root = "/var/lib/djlabhub"
+# c.HomeTemplates.method = "overlay"
+
+# Thin images (singleuser/Thin.Dockerfile) mount their conda environment read-only from a copy
+# shared on the Docker host, keyed by content hash
+# c.DJLabSpawner.shared_env = True
+# c.EnvironmentStore.root = "/var/lib/djlabhub"
+
+# With DJLABHUB_REPO_INSTALL, the repository's dependencies are installed once per commit and
+# requirements under RepoEnvironments.root and mounted read-only; the startup hook only links
+# the repository
+# c.DJLabSpawner.repo_envs = True
+# c.DJLabSpawner.repo_env_wait = 10
+# c.RepoEnvironments.root = "/var/lib/djlabhub"
 
 c.DockerSpawner.environment = {
     ## Jupyter Official Environment Variables
@@ -178,13 +236,24 @@ c.DockerSpawner.environment = {
 
 # def auth_state_hook(spawner, auth_state):
 #     # print(f"{auth_state=}")
-#     spawner.environment['DJ_USER'] = auth_state['oauth_user']['preferred_username']
+#     spawner.environment['DJ_USER'] = auth_state['username']
 #     spawner.environment['DJ_PASS'] = auth_state['access_token']
 #     spawner.environment['DJ_HOST'] = 'percona-qa.datajoint.io'
 
 # # Set profile options
 # c.Spawner.auth_state_hook = auth_state_hook
 
+# GET /hub/api/djlabhub/users/<name>/credentials, the access token only, with ETag revalidation
+# POST /hub/api/djlabhub/users/<name>/spawn-timings, startup hook timings of a pending spawn
+# POST /hub/api/djlabhub/users/<name>/ready, sent by singleuser servers once they are listening
+# POST /hub/api/djlabhub/activity, bulk activity updates from the djlabhub-activity service
+c.JupyterHub.extra_handlers = (
+    credentials.default_handlers
+    + spawn_timing.default_handlers
+    + readiness.default_handlers
+    + activity.default_handlers
+)
+
 c.JupyterHub.load_roles = [
     {
         "name": "user",
@@ -196,5 +265,15 @@ c.JupyterHub.load_roles = [
         "description": "Allows parties to start and stop user servers",
         "scopes": ["access:servers!user", "read:users:activity!user", "users:activity!user", "admin:auth_state!user"],
         "services":[]
+    }, {
+        "name": "djlabhub-culler",
+        "description": "Stops idle servers",
+        "scopes": ["list:users", "read:users:activity", "read:servers", "admin:server_state", "delete:servers"],
+        "services": ["djlabhub-culler"],
+    }, {
+        "name": "djlabhub-activity",
+        "description": "Flushes aggregated activity of singleuser servers",
+        "scopes": ["users:activity"],
+        "services": ["djlabhub-activity"],
     }
 ]
\ No newline at end of file
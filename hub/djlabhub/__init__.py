@@ -0,0 +1,8 @@
+"""
+JupyterHub extensions for the djlabhub hub image.
+
+These are imported from `jupyterhub_config.py`, e.g.
+
+    from djlabhub.auth import RefreshingAuthenticator
+    c.JupyterHub.authenticator_class = RefreshingAuthenticator
+"""
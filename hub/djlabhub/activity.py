@@ -0,0 +1,86 @@
+"""
+Bulk activity updates, from the activity service (`djlabhub.services.activity`).
+
+Singleuser servers report their activity to the service instead of the hub,
+which commits every report to its database. The service coalesces reports
+per user and server and flushes them with
+
+    POST /hub/api/djlabhub/activity
+    {"users": {"<name>": {"last_activity": "<ISO 8601>",
+                          "servers": {"<server>": {"last_activity": "<ISO 8601>"}}}}}
+
+which updates every user and server in one commit. As in the hub's own
+activity API, a timestamp only moves activity forward. Users and servers
+deleted since their report, and reports that are invalid or more than an
+hour in the future, are skipped and returned, rather than failing the
+rest of the batch. Nothing is changed before every report is checked.
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from jupyterhub.apihandlers.base import APIHandler
+from jupyterhub.scopes import needs_scope
+from tornado import web
+
+
+def _timestamp(value) -> Optional[datetime]:
+    """
+    Naive UTC datetime, as the hub stores, of an ISO 8601 timestamp; None if
+    it is not one, or more than an hour in the future, as the hub's own
+    activity API rejects.
+    """
+    try:
+        date = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if date.tzinfo:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    if date - datetime.utcnow() > timedelta(minutes=59):
+        return None
+    return date
+
+
+class BulkActivityAPIHandler(APIHandler):
+    @needs_scope('users:activity')
+    async def post(self):
+        body = self.get_json_body() or {}
+        users = body.get('users')
+        if not isinstance(users, dict):
+            raise web.HTTPError(400, "users must be a dict of {name: {last_activity, servers}}")
+        has_access = self.get_scope_filter('users:activity')
+        skipped = []
+        # (user or spawner, last activity): every entry is checked before any is applied
+        updates = []
+        for user_name, report in users.items():
+            user = self.find_user(user_name)
+            if user is None or not isinstance(report, dict) or not isinstance(report.get('servers') or {}, dict):
+                skipped.append(user_name)
+                continue
+            if not has_access(user.orm_user, kind='user'):
+                raise web.HTTPError(403, "No access to activity of %s" % user_name)
+            if report.get('last_activity'):
+                last_activity = _timestamp(report['last_activity'])
+                if last_activity is None:
+                    skipped.append(user_name)
+                else:
+                    updates.append((user, last_activity))
+            for server_name, server in (report.get('servers') or {}).items():
+                spawner = user.orm_spawners.get(server_name)
+                last_activity = _timestamp(server.get('last_activity')) if isinstance(server, dict) else None
+                if spawner is None or last_activity is None:
+                    skipped.append('%s/%s' % (user_name, server_name))
+                else:
+                    updates.append((spawner, last_activity))
+        updated = 0
+        for obj, last_activity in updates:
+            if not obj.last_activity or last_activity > obj.last_activity:
+                obj.last_activity = last_activity
+                updated += 1
+        self.db.commit()
+        self.log.debug("Bulk activity of %d users: %d updates", len(users), updated)
+        self.finish({'updated': updated, 'skipped': skipped})
+
+
+default_handlers = [
+    (r"/api/djlabhub/activity", BulkActivityAPIHandler),
+]
@@ -0,0 +1,166 @@
+"""
+Admission control for spawns.
+
+Starting many containers at once makes every start slow, and past the
+spawn timeout they all fail and are retried. `SpawnQueue` lets a limited
+number of spawns reach the Docker daemon at a time, and queues the rest:
+
+- waiting spawns are admitted round-robin across users, so a user starting
+  several named servers does not hold back everybody else
+- the limit adapts to observed start latency: it grows by one per limit's
+  worth of fast starts, and shrinks by `decrease_factor` when a start is
+  slower than `target_latency` or fails
+- waiting spawns get their queue position and an estimated wait
+"""
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Callable, Optional
+
+from traitlets import Float, Integer
+from traitlets.config import LoggingConfigurable
+
+from .metrics import SPAWN_CONCURRENCY_LIMIT, SPAWN_QUEUE_LENGTH
+
+
+class SpawnQueue(LoggingConfigurable):
+    """Concurrency-limited, per-user fair queue of spawns."""
+
+    initial_concurrency = Integer(
+        4,
+        config=True,
+        help="Spawns admitted at the same time when the hub starts.",
+    )
+
+    min_concurrency = Integer(1, config=True, help="Lower bound of the adaptive limit.")
+
+    max_concurrency = Integer(16, config=True, help="Upper bound of the adaptive limit.")
+
+    target_latency = Float(
+        20,
+        config=True,
+        help="""
+        Start latency, in seconds, above which the limit is lowered. Should be
+        well below the spawn timeout.
+        """,
+    )
+
+    decrease_factor = Float(
+        0.75,
+        config=True,
+        help="Factor applied to the limit after a slow or failed start.",
+    )
+
+    progress_interval = Float(
+        2,
+        config=True,
+        help="Seconds between queue position updates to a waiting spawn.",
+    )
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._limit = float(self.initial_concurrency)
+        self._inflight = 0
+        # user name -> waiting futures of that user, in user rotation order
+        self._waiting = OrderedDict()
+        # moving average of start latency, for wait estimates
+        self._latency = self.target_latency / 2
+        self._decreased = 0.0
+        SPAWN_CONCURRENCY_LIMIT.set(self.limit)
+
+    @property
+    def limit(self) -> int:
+        return max(self.min_concurrency, min(self.max_concurrency, int(self._limit)))
+
+    def __len__(self):
+        return sum(len(waiters) for waiters in self._waiting.values())
+
+    def _order(self) -> list:
+        """Waiting futures in the order they will be admitted."""
+        queues = [list(waiters) for waiters in self._waiting.values()]
+        order = []
+        for i in range(max(map(len, queues), default=0)):
+            order += [waiters[i] for waiters in queues if i < len(waiters)]
+        return order
+
+    def position(self, future) -> Optional[tuple]:
+        """Spawns ahead of `future`, and its estimated wait in seconds."""
+        try:
+            ahead = self._order().index(future)
+        except ValueError:
+            return None
+        return ahead, (ahead // self.limit + 1) * self._latency
+
+    def _dispatch(self):
+        while self._waiting and self._inflight < self.limit:
+            user_name, waiters = next(iter(self._waiting.items()))
+            future = waiters.popleft()
+            if waiters:
+                # the user's next spawn waits for everyone else's turn
+                self._waiting.move_to_end(user_name)
+            else:
+                del self._waiting[user_name]
+            if not future.done():
+                future.set_result(None)
+                self._inflight += 1
+        SPAWN_QUEUE_LENGTH.set(len(self))
+
+    def _release(self, admitted: float, latency: float, succeeded: bool):
+        self._inflight -= 1
+        self._latency = 0.8 * self._latency + 0.2 * latency
+        if succeeded and latency <= self.target_latency:
+            self._limit = min(self.max_concurrency, self._limit + 1 / self.limit)
+        elif admitted >= self._decreased:
+            # only spawns admitted under the current limit lower it again
+            self._limit = max(self.min_concurrency, self._limit * self.decrease_factor)
+            self._decreased = time.monotonic()
+            self.log.info(
+                "Spawn took %.1fs (%s), lowering the spawn limit to %i",
+                latency, "ok" if succeeded else "failed", self.limit,
+            )
+        SPAWN_CONCURRENCY_LIMIT.set(self.limit)
+        self._dispatch()
+
+    @asynccontextmanager
+    async def admit(self, user_name: str, on_wait: Optional[Callable] = None):
+        """
+        Wait for a slot for a spawn of `user_name`, and hold it for the body
+        of the `async with` block. `on_wait(ahead, eta)` is called while
+        waiting.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(user_name, deque()).append(future)
+        self._dispatch()
+        try:
+            while not future.done():
+                if on_wait is not None:
+                    position = self.position(future)
+                    if position is not None:
+                        on_wait(*position)
+                try:
+                    await asyncio.wait_for(asyncio.shield(future), self.progress_interval)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            # gave up waiting, e.g. the spawn timed out
+            if future.done():
+                self._inflight -= 1
+                self._dispatch()
+            else:
+                future.cancel()
+                waiters = self._waiting.get(user_name)
+                if waiters is not None and future in waiters:
+                    waiters.remove(future)
+                    if not waiters:
+                        del self._waiting[user_name]
+                SPAWN_QUEUE_LENGTH.set(len(self))
+            raise
+
+        admitted = time.monotonic()
+        succeeded = False
+        try:
+            yield
+            succeeded = True
+        finally:
+            self._release(admitted, time.monotonic() - admitted, succeeded)
@@ -0,0 +1,468 @@
+"""
+OAuth authenticator that keeps the user's Keycloak tokens fresh.
+
+The tokens in `auth_state` are read by the singleuser servers (see
+`jupyter_codeserver_proxy.helpers.get_token_from_jhub_auth_state`) and used as
+the DataJoint database password, so they have to be refreshed before expiry.
+"""
+import asyncio
+import json
+import time
+from typing import Optional
+from urllib.parse import urlencode
+
+from oauthenticator.generic import GenericOAuthenticator
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
+from tornado.ioloop import IOLoop
+from tornado.web import HTTPError
+from traitlets import Any, Bool, Dict, Float, Instance, Integer, List, Unicode, default
+
+from .auth_state import AuthStateCache
+from .breaker import CircuitBreaker, CircuitOpen
+from .credentials import CredentialBroker
+from .metrics import (
+    REFRESH_USER_COALESCED,
+    REFRESH_USER_DURATION_SECONDS,
+    REFRESH_USER_OUTCOME,
+    TOKEN_DECODE_DURATION_SECONDS,
+    TOKEN_EXPIRY,
+    TOKEN_REQUEST_DURATION_SECONDS,
+    TOKEN_REQUEST_ERRORS,
+    RefreshOutcome,
+)
+from .scheduler import RefreshScheduler
+from .tokens import TokenInspector, UnknownSigningKey, jwks_max_age
+
+
+class RefreshingAuthenticator(GenericOAuthenticator):
+    """Custom Authenticator that refreshes OAuth tokens when needed."""
+
+    token_request_timeout = Float(
+        10,
+        config=True,
+        help="""
+        Seconds to wait for the token endpoint to answer a refresh request,
+        including time spent queued behind `token_max_clients` other requests.
+        """,
+    )
+
+    token_connect_timeout = Float(
+        5,
+        config=True,
+        help="Seconds to wait for a connection to the token endpoint.",
+    )
+
+    token_max_clients = Integer(
+        20,
+        config=True,
+        help="""
+        Maximum number of concurrent requests to the token endpoint.
+
+        Requests above this limit are queued by the HTTP client, and
+        connections are kept alive and reused between refreshes.
+        """,
+    )
+
+    auth_state_fields = List(
+        Unicode(),
+        default_value=['access_token', 'refresh_token', 'expires_at', 'username'],
+        allow_none=True,
+        config=True,
+        help="""
+        Keys of the OAuth `auth_state` to store after login. Set to None to
+        store everything, including the id_token, token response and userinfo.
+
+        `expires_at` (the access token's expiry, epoch seconds) and `username`
+        are derived from the token response and the authenticated user name.
+        The full state is still available to allow/admin group checks, which
+        run before it is stored.
+        """,
+    )
+
+    auth_state_cache_size = Integer(
+        1024,
+        config=True,
+        help="""
+        Number of users whose decrypted auth_state is kept in memory.
+        Set to 0 to decrypt it from the database on every read.
+        """,
+    )
+
+    auth_state_cache_ttl = Float(
+        300,
+        config=True,
+        help="Seconds to keep a user's decrypted auth_state in memory.",
+    )
+
+    cache_hub_auth_state_reads = Bool(
+        False,
+        config=True,
+        help="""
+        Also serve the hub's own auth_state reads from the cache, e.g. the
+        users API with `admin:auth_state` and spawner auth_state hooks. This
+        wraps `jupyterhub.user.User.get_auth_state` and `save_auth_state`.
+        """,
+    )
+
+    auth_state_cache = Instance(AuthStateCache)
+
+    @default("auth_state_cache")
+    def _auth_state_cache_default(self):
+        return AuthStateCache(size=self.auth_state_cache_size, ttl=self.auth_state_cache_ttl)
+
+    refresh_result_ttl = Float(
+        5,
+        config=True,
+        help="""
+        Seconds after a successful `refresh_user` call during which calls for
+        the same user return True without refreshing, absorbing bursts of
+        requests that arrive right after it. Failed refreshes are not reused.
+
+        Concurrent calls for a user always share one in-flight refresh,
+        regardless of this setting. Set to 0 to disable the result cache.
+        """,
+    )
+
+    jwks_url = Unicode(
+        config=True,
+        help="""
+        URL of the issuer's JSON Web Key Set, used to verify access token
+        signatures. Defaults to Keycloak's `certs` endpoint next to `token_url`.
+        """,
+    )
+
+    @default("jwks_url")
+    def _jwks_url_default(self):
+        if self.token_url.endswith("/token"):
+            return self.token_url[: -len("/token")] + "/certs"
+        return ""
+
+    verify_token_signature = Bool(
+        True,
+        config=True,
+        help="""
+        Verify access token signatures against `jwks_url`.
+
+        Refresh tokens are always inspected unverified, since Keycloak signs
+        them with a realm secret that is not published in the JWKS.
+        """,
+    )
+
+    jwks_max_age = Float(
+        3600,
+        config=True,
+        help="""
+        Seconds to keep the JWKS when the response has no Cache-Control
+        max-age. A token signed with an unknown key triggers an earlier
+        re-fetch, so key rotation is picked up regardless.
+        """,
+    )
+
+    token_claims_cache_size = Integer(
+        4096,
+        config=True,
+        help="Number of decoded tokens to keep, keyed by the token's digest.",
+    )
+
+    token_inspector = Any()
+
+    @default("token_inspector")
+    def _token_inspector_default(self):
+        return TokenInspector(
+            jwks_url=self.jwks_url if self.verify_token_signature else None,
+            cache_size=self.token_claims_cache_size,
+            jwks_max_age=self.jwks_max_age,
+        )
+
+    proactive_refresh = Bool(
+        False,
+        config=True,
+        help="""
+        Refresh the tokens of users with running servers in the background,
+        shortly before they expire, instead of only when a request happens to
+        call `refresh_user`. See `RefreshScheduler` for its settings.
+        """,
+    )
+
+    refresh_scheduler = Instance(RefreshScheduler)
+
+    @default("refresh_scheduler")
+    def _refresh_scheduler_default(self):
+        return RefreshScheduler(parent=self, authenticator=self, log=self.log)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        if self.cache_hub_auth_state_reads:
+            from jupyterhub.user import User
+
+            self.auth_state_cache.install(User)
+        if self.proactive_refresh:
+            IOLoop.current().add_callback(self.refresh_scheduler.start)
+
+    token_breaker = Instance(CircuitBreaker)
+
+    @default("token_breaker")
+    def _token_breaker_default(self):
+        return CircuitBreaker(parent=self, name='token_endpoint', log=self.log)
+
+    credential_broker = Instance(
+        CredentialBroker,
+        (),
+        help="Latest access token per user, served by djlabhub.credentials.",
+    )
+
+    # user name -> in-flight refresh future
+    _refresh_inflight = Dict()
+    # user name -> monotonic expiry of its last successful refresh
+    _refresh_results = Dict()
+    # in-flight JWKS fetch, shared by every refresh that needs the keys
+    _jwks_fetch = Any()
+
+    _token_client = None
+
+    @property
+    def token_client(self) -> AsyncHTTPClient:
+        """HTTP client shared by every token refresh.
+
+        A dedicated instance, so that the pool size is not shared with the
+        hub's own client (`AsyncHTTPClient` instances are per-IOLoop
+        singletons unless `force_instance` is given). JupyterHub selects the
+        curl implementation when pycurl is installed, as it is in the
+        jupyterhub/jupyterhub image, which keeps connections alive.
+        """
+        if self._token_client is None:
+            self._token_client = AsyncHTTPClient(
+                force_instance=True,
+                max_clients=self.token_max_clients,
+                defaults=dict(
+                    connect_timeout=self.token_connect_timeout,
+                    request_timeout=self.token_request_timeout,
+                ),
+            )
+        return self._token_client
+
+    async def _refresh_token(self, refresh_token: str) -> tuple[Optional[str], Optional[str]]:
+        values = dict(
+            grant_type='refresh_token',
+            client_id=self.client_id,
+            client_secret=self.client_secret,
+            refresh_token=refresh_token,
+        )
+        req = HTTPRequest(
+            self.token_url,
+            method='POST',
+            headers={
+                'Accept': 'application/json',
+                'Content-Type': 'application/x-www-form-urlencoded',
+            },
+            body=urlencode(values),
+        )
+        probe = self.token_breaker.before_call()
+        succeeded = False
+        start = time.perf_counter()
+        try:
+            response = await self.token_client.fetch(req)
+            succeeded = True
+        except HTTPClientError as e:
+            TOKEN_REQUEST_ERRORS.labels(code=str(e.code)).inc()
+            # a rejected refresh token (4xx) says nothing about the endpoint's health
+            succeeded = 400 <= e.code < 500 and e.code != 429
+            raise
+        finally:
+            TOKEN_REQUEST_DURATION_SECONDS.observe(time.perf_counter() - start)
+            self.token_breaker.record(succeeded, probe=probe)
+        data = json.loads(response.body)
+        return (data.get('access_token', None), data.get('refresh_token', None))
+
+    async def _fetch_jwks(self):
+        # one fetch at a time, however many refreshes notice stale keys
+        if self._jwks_fetch is None:
+            self._jwks_fetch = asyncio.ensure_future(self._load_jwks())
+            self._jwks_fetch.add_done_callback(lambda f: setattr(self, '_jwks_fetch', None))
+        await asyncio.shield(self._jwks_fetch)
+
+    async def _load_jwks(self):
+        response = await self.token_client.fetch(
+            self.token_inspector.jwks_url, headers={'Accept': 'application/json'}
+        )
+        self.token_inspector.load_jwks(
+            json.loads(response.body), jwks_max_age(response.headers.get('Cache-Control'))
+        )
+        self.log.debug('Loaded JWKS from %s' % self.token_inspector.jwks_url)
+
+    async def _decode_token(self, token: str, verify: bool = True) -> dict:
+        if verify and self.token_inspector.keys_needed(token):
+            try:
+                await self._fetch_jwks()
+            except Exception as e:
+                # keep verifying with the keys we have; unknown keys still fail
+                self.log.warning('Failed to fetch JWKS from %s: %s' % (self.token_inspector.jwks_url, e))
+        start = time.perf_counter()
+        claims = self.token_inspector.claims(token, verify=verify)
+        TOKEN_DECODE_DURATION_SECONDS.labels(verified=str(verify).lower()).observe(
+            time.perf_counter() - start
+        )
+        return claims
+
+    def project_auth_state(self, auth_state: dict, username: str) -> dict:
+        """
+        Reduce `auth_state` to `auth_state_fields`.
+        """
+        if self.auth_state_fields is None:
+            return auth_state
+        derived = {'username': username}
+        expires_in = (auth_state.get('token_response') or {}).get('expires_in')
+        if expires_in is not None:
+            derived['expires_at'] = int(time.time() + float(expires_in))
+        projected = {}
+        for key in self.auth_state_fields:
+            if key in auth_state:
+                projected[key] = auth_state[key]
+            elif key in derived:
+                projected[key] = derived[key]
+        return projected
+
+    async def run_post_auth_hook(self, handler, authentication):
+        """
+        Store only `auth_state_fields` of the login's auth_state.
+
+        Runs after the allow/block and admin group checks, which read the
+        userinfo from the full auth_state, and after any `post_auth_hook`.
+        """
+        authentication = await super().run_post_auth_hook(handler, authentication)
+        if authentication and authentication.get('auth_state'):
+            authentication['auth_state'] = self.project_auth_state(
+                authentication['auth_state'], authentication['name']
+            )
+            # the hub saves this state after the hook; replace any state cached before the
+            # login (None, or one with an expired refresh token), installed or not
+            self.auth_state_cache.put(authentication['name'], authentication['auth_state'])
+            try:
+                await self._publish_credential(authentication['name'], authentication['auth_state'])
+            except UnknownSigningKey as e:
+                self.log.error("Cannot verify the access token of %s: %s" % (authentication['name'], e))
+                raise HTTPError(503, "The identity provider's signing keys are unavailable, try again shortly")
+        return authentication
+
+    async def _publish_credential(self, name: str, auth_state: dict):
+        """
+        Hand the user's current access token to `credential_broker`, for
+        `djlabhub.credentials`.
+        """
+        access = await self._decode_token(auth_state['access_token'])
+        refresh_expires_at = None
+        if auth_state.get('refresh_token'):
+            refresh = await self._decode_token(auth_state['refresh_token'], verify=False)
+            refresh_expires_at = refresh.get('exp')
+        self.credential_broker.publish(
+            name, auth_state['access_token'], access.get('exp'), refresh_expires_at
+        )
+
+    def _refresh_done(self, name: str, future: asyncio.Future):
+        self._refresh_inflight.pop(name, None)
+        if future.cancelled() or future.exception() is not None:
+            return
+        now = time.monotonic()
+        for key in [k for k, expires in self._refresh_results.items() if expires <= now]:
+            del self._refresh_results[key]
+        # a False result logs the user out: the next request must refresh again
+        if self.refresh_result_ttl > 0 and future.result():
+            self._refresh_results[name] = now + self.refresh_result_ttl
+
+    async def refresh_user(self, user, handler=None):
+        """
+        Refresh user's OAuth tokens, coalescing concurrent calls per user.
+
+        The refresh tokens rotate, so two refreshes racing for the same user
+        would invalidate each other. Callers that arrive while a refresh is in
+        flight await that one instead, and share its result. Callers within
+        `refresh_result_ttl` seconds after a successful refresh get True: the
+        auth_state it returned has been saved already.
+        """
+        expires = self._refresh_results.get(user.name)
+        if expires is not None and expires > time.monotonic():
+            REFRESH_USER_COALESCED.inc()
+            return True
+        future = self._refresh_inflight.get(user.name)
+        if future is not None:
+            REFRESH_USER_COALESCED.inc()
+        else:
+            future = asyncio.ensure_future(self._refresh_user(user, handler))
+            future.add_done_callback(lambda f, name=user.name: self._refresh_done(name, f))
+            self._refresh_inflight[user.name] = future
+        # one caller going away must not cancel the refresh for the others
+        return await asyncio.shield(future)
+
+    async def _refresh_user(self, user, handler=None):
+        """
+        Refresh user's OAuth tokens. This is called when user info is requested
+        and has passed more than "auth_refresh_age" seconds.
+        """
+        start = time.perf_counter()
+        outcome = RefreshOutcome.error
+        try:
+            outcome, result = await self._refresh_tokens(user)
+            return result
+        finally:
+            REFRESH_USER_OUTCOME.labels(outcome=outcome.value).inc()
+            REFRESH_USER_DURATION_SECONDS.labels(outcome=outcome.value).observe(
+                time.perf_counter() - start
+            )
+
+    async def _refresh_tokens(self, user) -> tuple[RefreshOutcome, object]:
+        self.log.info('Refreshing OAuth tokens for user %s' % user.name)
+        try:
+            auth_state = await self.auth_state_cache.get_auth_state(user)
+            decoded_access_token = await self._decode_token(auth_state['access_token'])
+            decoded_refresh_token = await self._decode_token(auth_state['refresh_token'], verify=False)
+            TOKEN_EXPIRY.observe(user.name, decoded_access_token['exp'])
+            diff_access = decoded_access_token['exp'] - time.time()
+            # If we request the offline_access scope, our refresh token won't have expiration
+            diff_refresh = (decoded_refresh_token['exp'] - time.time()) if 'exp' in decoded_refresh_token else 0
+            if diff_access > self.auth_refresh_age:
+                # Access token is still valid and will stay until next refresh
+                return RefreshOutcome.still_valid, True
+            elif diff_refresh < 0:
+                # Refresh token not valid, need to re-authenticate again
+                TOKEN_EXPIRY.forget(user.name)
+                self.credential_broker.forget(user.name)
+                return RefreshOutcome.refresh_expired, False
+            else:
+                # We need to refresh access token (which will also refresh the refresh token)
+                access_token, refresh_token = await self._refresh_token(auth_state['refresh_token'])
+                if (access_token, refresh_token) == (auth_state['access_token'], auth_state['refresh_token']):
+                    # nothing new to encrypt and write
+                    return RefreshOutcome.refreshed, True
+                # verified before the (possibly cached) auth_state is changed
+                claims = await self._decode_token(access_token)
+                auth_state['access_token'] = access_token
+                auth_state['refresh_token'] = refresh_token
+                self.log.debug('User %s OAuth tokens refreshed' % user.name)
+                if 'expires_at' in auth_state:
+                    auth_state['expires_at'] = claims['exp']
+                # the hub saves the new state once we return it
+                self.auth_state_cache.put(user.name, auth_state)
+                TOKEN_EXPIRY.observe(user.name, claims['exp'])
+                await self._publish_credential(user.name, auth_state)
+                if self.proactive_refresh:
+                    self.refresh_scheduler.schedule(user, claims['exp'])
+                return RefreshOutcome.refreshed, {'auth_state': auth_state}
+        except CircuitOpen as e:
+            if diff_access > 0:
+                # keep serving the current access token until the endpoint recovers
+                self.log.info('Not refreshing OAuth tokens for user %s: %s' % (user.name, e))
+                return RefreshOutcome.shed, True
+            self.log.warning('OAuth tokens for user %s expired: %s' % (user.name, e))
+        except UnknownSigningKey as e:
+            # the JWKS could not be fetched: retried on the next request, as while
+            # the circuit is open, as long as the access token is known to be valid
+            if (auth_state or {}).get('expires_at', 0) > time.time():
+                self.log.info('Not refreshing OAuth tokens for user %s: %s' % (user.name, e))
+                return RefreshOutcome.shed, True
+            self.log.warning('Cannot verify the OAuth tokens of user %s: %s' % (user.name, e))
+        except HTTPClientError as e:
+            body = e.response.body if e.response is not None else e.message
+            self.log.error("Failure calling the renew endpoint: %s (code: %s)" % (body, e.code))
+        except Exception:
+            self.log.error("Failed to refresh the OAuth tokens", exc_info=True)
+        return RefreshOutcome.error, False
@@ -0,0 +1,99 @@
+"""
+In-process cache of decrypted `auth_state`.
+
+Every `User.get_auth_state()` decrypts the user's auth_state from the
+database. The cache keeps recently used states in memory for a short time,
+bounded in size, and is updated whenever a state is saved.
+"""
+import copy
+import time
+from collections import OrderedDict
+from functools import wraps
+from typing import Optional
+
+from .metrics import AUTH_STATE_CACHE
+
+
+class AuthStateCache:
+    """Bounded LRU of decrypted auth_state per user name, with a TTL."""
+
+    # returned by `get` for users not in the cache
+    MISS = object()
+
+    def __init__(self, size: int = 1024, ttl: float = 300):
+        self.size = size
+        self.ttl = ttl
+        # user name -> (monotonic expiry, auth_state)
+        self._states = OrderedDict()
+        self._installed = False
+
+    def get(self, name: str):
+        """
+        Return a copy of the cached state of `name`, or `AuthStateCache.MISS`.
+        """
+        entry = self._states.get(name)
+        if entry is None or entry[0] <= time.monotonic():
+            AUTH_STATE_CACHE.labels(result='miss').inc()
+            return self.MISS
+        self._states.move_to_end(name)
+        AUTH_STATE_CACHE.labels(result='hit').inc()
+        # callers, refresh_user included, modify the state they get back
+        return copy.deepcopy(entry[1])
+
+    def put(self, name: str, auth_state: Optional[dict]):
+        # no state yet, e.g. read before the first login: the next read asks the database
+        if auth_state is None:
+            self.invalidate(name)
+            return
+        if self.size <= 0 or self.ttl <= 0:
+            return
+        self._states[name] = (time.monotonic() + self.ttl, copy.deepcopy(auth_state))
+        self._states.move_to_end(name)
+        while len(self._states) > self.size:
+            self._states.popitem(last=False)
+
+    def invalidate(self, name: str):
+        self._states.pop(name, None)
+
+    async def get_auth_state(self, user) -> Optional[dict]:
+        """`user.get_auth_state()`, through the cache."""
+        if self._installed:
+            # User.get_auth_state goes through the cache already
+            return await user.get_auth_state()
+        auth_state = self.get(user.name)
+        if auth_state is self.MISS:
+            auth_state = await user.get_auth_state()
+            self.put(user.name, auth_state)
+        return auth_state
+
+    def install(self, user_class):
+        """
+        Route `get_auth_state` and `save_auth_state` of the hub's User class
+        through the cache, so that the hub's own reads (the users API with
+        `admin:auth_state`, spawner auth_state hooks) are cached as well.
+        """
+        if getattr(user_class.get_auth_state, '_djlabhub_cache', None) is not None:
+            return
+        get_auth_state = user_class.get_auth_state
+        save_auth_state = user_class.save_auth_state
+        cache = self
+
+        @wraps(get_auth_state)
+        async def cached_get_auth_state(user):
+            auth_state = cache.get(user.name)
+            if auth_state is cache.MISS:
+                auth_state = await get_auth_state(user)
+                cache.put(user.name, auth_state)
+            return auth_state
+
+        @wraps(save_auth_state)
+        async def cached_save_auth_state(user, auth_state):
+            cache.invalidate(user.name)
+            await save_auth_state(user, auth_state)
+            cache.put(user.name, auth_state)
+
+        cached_get_auth_state._djlabhub_cache = self
+        self._installed = True
+        user_class.get_auth_state = cached_get_auth_state
+        user_class.save_auth_state = cached_save_auth_state
+
@@ -0,0 +1,142 @@
+"""
+Circuit breaker for the OAuth token endpoint.
+
+When Keycloak is slow or failing, refreshes are shed instead of piling more
+requests onto it. Users keep their current access token while it is still
+valid, see `RefreshingAuthenticator._refresh_user`.
+"""
+import random
+import time
+from collections import deque
+
+from traitlets import Float, Integer, Unicode
+from traitlets.config import LoggingConfigurable
+
+from . import metrics
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling the token endpoint while the circuit is open."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"token endpoint circuit open, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(LoggingConfigurable):
+    """
+    Open after too many failures in a sliding window, then let a single probe
+    through once the backoff has passed (half-open). A successful probe
+    closes the circuit; a failed one reopens it with twice the backoff.
+    """
+
+    name = Unicode('token_endpoint', help="Label for logs and metrics.")
+
+    window = Float(
+        60,
+        config=True,
+        help="Seconds of call outcomes used to compute the failure rate.",
+    )
+
+    failure_rate = Float(
+        0.5,
+        config=True,
+        help="Fraction of failed calls within `window` that opens the circuit.",
+    )
+
+    min_calls = Integer(
+        10,
+        config=True,
+        help="Minimum number of calls within `window` before the circuit can open.",
+    )
+
+    backoff_base = Float(
+        5,
+        config=True,
+        help="""
+        Seconds the circuit stays open the first time. Each failed half-open
+        probe doubles it, up to `backoff_max`, and the actual wait is drawn
+        at random between half and all of it.
+        """,
+    )
+
+    backoff_max = Float(
+        300,
+        config=True,
+        help="Upper bound, in seconds, of the time the circuit stays open.",
+    )
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.state = CLOSED
+        # (monotonic time, succeeded)
+        self._calls = deque()
+        self._opens = 0
+        self._open_until = 0.0
+        self._probing = False
+        metrics.BREAKER_STATE.labels(breaker=self.name).set(0)
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            self.log.warning("Circuit breaker %s: %s -> %s", self.name, self.state, state)
+        self.state = state
+        metrics.BREAKER_STATE.labels(breaker=self.name).set(
+            {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}[state]
+        )
+
+    def retry_after(self) -> float:
+        """Seconds until the next call will be let through, 0 if closed."""
+        if self.state == CLOSED:
+            return 0
+        return max(0, self._open_until - time.monotonic())
+
+    def before_call(self) -> bool:
+        """
+        Raise `CircuitOpen` if the call should be shed. Returns whether the
+        call is the half-open probe, to pass on to `record`.
+        """
+        if self.state == CLOSED:
+            return False
+        if self.state == OPEN and time.monotonic() >= self._open_until:
+            self._set_state(HALF_OPEN)
+        if self.state == HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        metrics.BREAKER_SHED.labels(breaker=self.name).inc()
+        raise CircuitOpen(self.retry_after())
+
+    def record(self, succeeded: bool, probe: bool = False):
+        """
+        Record a call's outcome. Only the probe decides a half-open circuit:
+        calls let through while it was closed may still finish after it opened.
+        """
+        now = time.monotonic()
+        if probe:
+            self._probing = False
+            if succeeded:
+                self._opens = 0
+                self._calls.clear()
+                self._set_state(CLOSED)
+            else:
+                self._open(now)
+            return
+
+        self._calls.append((now, succeeded))
+        while self._calls and self._calls[0][0] < now - self.window:
+            self._calls.popleft()
+        if self.state != CLOSED or len(self._calls) < self.min_calls:
+            return
+        failures = sum(1 for _, ok in self._calls if not ok)
+        if failures / len(self._calls) >= self.failure_rate:
+            self._open(now)
+
+    def _open(self, now: float):
+        backoff = min(self.backoff_max, self.backoff_base * 2 ** self._opens)
+        self._opens += 1
+        self._open_until = now + random.uniform(backoff / 2, backoff)
+        self._calls.clear()
+        self._set_state(OPEN)
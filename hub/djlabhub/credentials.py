@@ -0,0 +1,104 @@
+"""
+Lightweight credential endpoint for singleuser servers.
+
+`GET /hub/api/djlabhub/users/<name>/credentials` returns only the user's
+current access token (the DataJoint database password) and expiry times,
+instead of the full user model with `auth_state` from `/hub/api/users/<name>`.
+
+Responses carry an ETag, and a request with a matching `If-None-Match`
+gets a 304 without the token being serialized again. The only consumer,
+`setup_database_password` in the singleuser image, runs once per process
+launch, so it revalidates instead of long-polling for the next rotation:
+nothing in the server would be there to receive it.
+
+Registered with
+
+    from djlabhub.credentials import default_handlers
+    c.JupyterHub.extra_handlers = default_handlers
+
+This is a hub API handler rather than a hub-managed service: the current
+token is in the authenticator's memory (`CredentialBroker`, fed on login and
+on every refresh) and its auth_state cache. A separate service would have
+to read it from the hub's users API with `admin:auth_state`, the full
+user model and auth_state decryption this endpoint avoids.
+"""
+import hashlib
+import json
+from typing import Optional
+
+from jupyterhub.apihandlers.base import APIHandler
+from jupyterhub.scopes import needs_scope
+from tornado import web
+
+
+class CredentialBroker:
+    """
+    The latest credential per user, kept in memory by the authenticator.
+    """
+
+    def __init__(self):
+        # user name -> (etag, credential)
+        self._credentials = {}
+
+    @staticmethod
+    def etag(access_token: str) -> str:
+        return '"%s"' % hashlib.sha256(access_token.encode()).hexdigest()[:32]
+
+    def publish(
+        self,
+        name: str,
+        access_token: str,
+        expires_at: Optional[float] = None,
+        refresh_expires_at: Optional[float] = None,
+    ):
+        credential = dict(
+            access_token=access_token,
+            expires_at=expires_at,
+            refresh_expires_at=refresh_expires_at,
+        )
+        self._credentials[name] = (self.etag(access_token), credential)
+
+    def get(self, name: str) -> Optional[tuple]:
+        return self._credentials.get(name)
+
+    def forget(self, name: str):
+        self._credentials.pop(name, None)
+
+
+class CredentialsAPIHandler(APIHandler):
+    @property
+    def broker(self) -> CredentialBroker:
+        return self.authenticator.credential_broker
+
+    async def _current(self, user) -> Optional[tuple]:
+        current = self.broker.get(user.name)
+        if current is not None:
+            return current
+        # not seen since the hub started: decrypt once and keep it
+        auth_state = await self.authenticator.auth_state_cache.get_auth_state(user)
+        if not auth_state or not auth_state.get('access_token'):
+            return None
+        await self.authenticator._publish_credential(user.name, auth_state)
+        return self.broker.get(user.name)
+
+    @needs_scope('admin:auth_state')
+    async def get(self, user_name):
+        user = self.find_user(user_name)
+        if user is None:
+            raise web.HTTPError(404)
+        current = await self._current(user)
+        if current is None:
+            raise web.HTTPError(404, "No credential for user %s" % user_name)
+
+        etag, credential = current
+        self.set_header('ETag', etag)
+        self.set_header('Cache-Control', 'no-cache')
+        if self.request.headers.get('If-None-Match') == etag:
+            self.set_status(304)
+            return
+        self.write(json.dumps(credential))
+
+
+default_handlers = [
+    (r"/api/djlabhub/users/(?P<user_name>[^/]+)/credentials", CredentialsAPIHandler),
+]
@@ -0,0 +1,407 @@
+"""
+Async client for the Docker Engine API, on a Unix socket or over TCP.
+
+DockerSpawner runs every docker-py call on a single-thread executor, so a
+few hundred users polling and spawning queue up behind one another.
+`AsyncDockerClient` speaks HTTP/1.1 to the daemon directly from the event
+loop instead:
+
+- connections are kept alive and reused, up to `max_connections`
+- idempotent GET requests (inspect, list) are pipelined, up to
+  `max_pipeline` on one connection, behind the responses already pending
+- other requests get a connection of their own for their duration
+- at most `max_concurrency` requests are in flight in total
+
+Its methods have the names, arguments and return values of docker-py's
+`APIClient` for the calls the spawner makes, and raise docker-py's errors,
+so `DJLabSpawner.docker` can use it in place of the thread pool. Streaming
+calls (pull, exec) are not implemented and stay on the thread pool.
+"""
+import asyncio
+import json
+from collections import deque
+from typing import Optional
+from urllib.parse import quote, urlencode, urlparse
+
+from docker import errors
+
+# methods of AsyncDockerClient that stand in for docker-py's
+ASYNC_METHODS = frozenset([
+    'containers', 'create_container', 'create_volume', 'images', 'info', 'inspect_container',
+    'inspect_image', 'inspect_volume', 'logs', 'port', 'put_archive', 'remove_container',
+    'remove_volume', 'rename', 'start', 'stop', 'version', 'wait',
+])
+
+# methods without a docker-py counterpart, only available from AsyncDockerClient
+CHECKPOINT_METHODS = frozenset(['checkpoint_create', 'checkpoint_delete', 'checkpoints'])
+
+
+class _Response:
+    """The parts of a `requests.Response` docker-py's errors look at."""
+
+    def __init__(self, status_code: int, reason: str, headers: dict, body: bytes):
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = body
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class _Connection:
+    """One keep-alive connection; responses are read in request order."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        # futures of requests written, waiting for their response
+        self.pending = deque()
+        # held by a request that must not be pipelined
+        self.exclusive = False
+        self.closed = False
+        self._reading: Optional[asyncio.Task] = None
+
+    def send(self, head: bytes, body: bytes) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(future)
+        self.writer.write(head + body)
+        if self._reading is None or self._reading.done():
+            self._reading = asyncio.ensure_future(self._read_responses())
+        return future
+
+    async def _read_responses(self):
+        while self.pending:
+            try:
+                response = await self._read_response()
+            except Exception as e:
+                self.close(e)
+                return
+            future = self.pending.popleft()
+            if not future.done():
+                future.set_result(response)
+            if response.headers.get('connection', '').lower() == 'close':
+                self.close(ConnectionResetError("Docker closed the connection"))
+                return
+
+    async def _read_response(self) -> _Response:
+        status_line = await self.reader.readuntil(b'\r\n')
+        _, status, reason = status_line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        status = int(status)
+        headers = {}
+        while True:
+            line = await self.reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self.reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                if size == 0:
+                    # trailers, if any, end with an empty line
+                    while await self.reader.readuntil(b'\r\n') != b'\r\n':
+                        pass
+                    break
+                chunks.append(await self.reader.readexactly(size))
+                await self.reader.readexactly(2)
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await self.reader.readexactly(int(headers['content-length']))
+        elif status in (204, 304) or 100 <= status < 200:
+            body = b''
+        else:
+            body = await self.reader.read()
+            headers['connection'] = 'close'
+        return _Response(status, reason, headers, body)
+
+    def close(self, exc: Exception):
+        self.closed = True
+        while self.pending:
+            future = self.pending.popleft()
+            if not future.done():
+                future.set_exception(exc)
+        self.writer.close()
+
+
+class AsyncDockerClient:
+    """Pooled, pipelining HTTP client for the Docker Engine API."""
+
+    def __init__(
+        self,
+        address: str = '/var/run/docker.sock',
+        version: str = '1.41',
+        max_connections: int = 8,
+        max_pipeline: int = 8,
+        max_concurrency: int = 64,
+        config_client=None,
+    ):
+        # a socket path, or tcp://host:port (plain HTTP, no TLS)
+        self.address = address
+        self.version = version
+        self.max_connections = max_connections
+        self.max_pipeline = max_pipeline
+        self._limit = asyncio.Semaphore(max_concurrency)
+        self._connections = []
+        self._changed = asyncio.Condition()
+        self._opening = 0
+        # docker-py APIClient used only to build request bodies, no I/O
+        self.config_client = config_client
+
+    async def _open(self) -> _Connection:
+        self._opening += 1
+        try:
+            if self.address.startswith(('tcp://', 'http://')):
+                url = urlparse(self.address)
+                reader, writer = await asyncio.open_connection(url.hostname, url.port or 2375)
+            else:
+                reader, writer = await asyncio.open_unix_connection(
+                    self.address[len('unix://'):] if self.address.startswith('unix://') else self.address
+                )
+        finally:
+            self._opening -= 1
+        connection = _Connection(reader, writer)
+        self._connections.append(connection)
+        return connection
+
+    async def _acquire(self, pipelined: bool) -> _Connection:
+        async with self._changed:
+            while True:
+                self._connections = [c for c in self._connections if not c.closed]
+                idle = [c for c in self._connections if not c.exclusive and not c.pending]
+                if pipelined and not idle:
+                    # least loaded connection with room in its pipeline
+                    shared = [
+                        c for c in self._connections
+                        if not c.exclusive and len(c.pending) < self.max_pipeline
+                    ]
+                    if shared and len(self._connections) + self._opening >= self.max_connections:
+                        return min(shared, key=lambda c: len(c.pending))
+                if idle:
+                    connection = idle[0]
+                elif len(self._connections) + self._opening < self.max_connections:
+                    connection = await self._open()
+                else:
+                    await self._changed.wait()
+                    continue
+                connection.exclusive = not pipelined
+                return connection
+
+    async def _release(self, connection: _Connection, pipelined: bool):
+        if not pipelined:
+            connection.exclusive = False
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        params: Optional[dict] = None,
+        body=None,
+        content_type: str = 'application/json',
+        timeout: Optional[float] = 60,
+    ) -> _Response:
+        url = '/v%s%s' % (self.version, path)
+        params = {k: v for k, v in (params or {}).items() if v is not None}
+        if params:
+            url += '?' + urlencode(params)
+        if body is None:
+            data = b''
+        elif isinstance(body, (bytes, bytearray)):
+            data = bytes(body)
+        elif hasattr(body, 'read'):
+            data = body.read()
+        else:
+            data = json.dumps(body).encode()
+        headers = ['%s %s HTTP/1.1' % (method, url), 'Host: docker']
+        if data or method in ('POST', 'PUT'):
+            headers += ['Content-Type: %s' % content_type, 'Content-Length: %i' % len(data)]
+        head = ('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1')
+
+        pipelined = method == 'GET'
+        async with self._limit:
+            # a GET that fails on a connection Docker closed is sent again once
+            for attempt in range(2 if pipelined else 1):
+                connection = await self._acquire(pipelined)
+                try:
+                    response = await asyncio.wait_for(connection.send(head, data), timeout)
+                except (ConnectionError, asyncio.IncompleteReadError) as e:
+                    if attempt or not pipelined:
+                        raise errors.APIError("Docker API connection failed: %s" % e) from e
+                    continue
+                except asyncio.TimeoutError:
+                    # a late response would be taken for the next request's
+                    connection.close(ConnectionAbortedError("request timed out"))
+                    raise errors.APIError("Docker API request %s %s timed out" % (method, path))
+                finally:
+                    await self._release(connection, pipelined)
+                break
+        if response.status_code >= 400:
+            try:
+                explanation = response.json().get('message')
+            except ValueError:
+                explanation = response.content.decode('utf-8', 'replace')
+            message = '%i %s for %s %s' % (response.status_code, response.reason, method, path)
+            cls = errors.NotFound if response.status_code == 404 else errors.APIError
+            if response.status_code == 404 and path.startswith('/images/'):
+                cls = errors.ImageNotFound
+            raise cls(message, response=response, explanation=explanation)
+        return response
+
+    async def close(self):
+        for connection in self._connections:
+            connection.close(ConnectionAbortedError("client closed"))
+        self._connections = []
+
+    @staticmethod
+    def _id(name: str) -> str:
+        return quote(name, safe='/:')
+
+    @staticmethod
+    def _filters(filters: dict) -> str:
+        """docker-py's `convert_filters`."""
+        return json.dumps({
+            key: [
+                ('true' if v else 'false') if isinstance(v, bool) else str(v)
+                for v in (value if isinstance(value, list) else [value])
+            ]
+            for key, value in filters.items()
+        })
+
+    # docker-py APIClient methods
+
+    async def version(self):
+        return (await self.request('GET', '/version')).json()
+
+    async def info(self):
+        return (await self.request('GET', '/info')).json()
+
+    async def images(self, all=False, filters=None):
+        params = {'all': 1 if all else 0}
+        if filters:
+            params['filters'] = self._filters(filters)
+        return (await self.request('GET', '/images/json', params)).json()
+
+    async def stats(self, container):
+        """One sample of a container's resource usage, without waiting for a CPU delta."""
+        response = await self.request(
+            'GET', '/containers/%s/stats' % self._id(container), {'stream': 0, 'one-shot': 1}
+        )
+        return response.json()
+
+    async def inspect_container(self, container):
+        return (await self.request('GET', '/containers/%s/json' % self._id(container))).json()
+
+    async def inspect_image(self, image):
+        return (await self.request('GET', '/images/%s/json' % self._id(image))).json()
+
+    async def containers(self, all=False, filters=None, limit=-1, size=False, quiet=False):
+        params = {'all': 1 if all else 0, 'limit': limit, 'size': 1 if size else 0}
+        if filters:
+            params['filters'] = self._filters(filters)
+        result = (await self.request('GET', '/containers/json', params)).json()
+        if quiet:
+            return [{'Id': c['Id']} for c in result]
+        return result
+
+    async def create_container(self, image, command=None, name=None, platform=None,
+                               use_config_proxy=True, **kwargs):
+        config = self.config_client.create_container_config(image, command, **kwargs)
+        response = await self.request(
+            'POST', '/containers/create', {'name': name, 'platform': platform}, config
+        )
+        return response.json()
+
+    async def start(self, container, checkpoint=None, checkpoint_dir=None):
+        params = {'checkpoint': checkpoint, 'checkpoint-dir': checkpoint_dir}
+        await self.request(
+            'POST', '/containers/%s/start' % self._id(container), params,
+            timeout=300 if checkpoint else 60,
+        )
+
+    async def stop(self, container, timeout=None):
+        params = {} if timeout is None else {'t': timeout}
+        await self.request(
+            'POST', '/containers/%s/stop' % self._id(container), params,
+            timeout=60 + (10 if timeout is None else timeout),
+        )
+
+    async def remove_container(self, container, v=False, link=False, force=False):
+        params = {'v': int(v), 'link': int(link), 'force': int(force)}
+        await self.request('DELETE', '/containers/%s' % self._id(container), params)
+
+    async def wait(self, container, timeout=None, condition=None):
+        response = await self.request(
+            'POST', '/containers/%s/wait' % self._id(container), {'condition': condition},
+            timeout=timeout,
+        )
+        return response.json()
+
+    async def logs(self, container, stdout=True, stderr=True, timestamps=False, tail='all'):
+        """Logs of a container with a TTY; others' are multiplexed, see docker-py."""
+        params = {
+            'stdout': int(stdout), 'stderr': int(stderr), 'timestamps': int(timestamps), 'tail': tail,
+        }
+        response = await self.request('GET', '/containers/%s/logs' % self._id(container), params)
+        return response.content
+
+    async def rename(self, container, name):
+        await self.request('POST', '/containers/%s/rename' % self._id(container), {'name': name})
+
+    async def put_archive(self, container, path, data):
+        await self.request(
+            'PUT', '/containers/%s/archive' % self._id(container), {'path': path},
+            data, content_type='application/x-tar',
+        )
+        return True
+
+    async def create_volume(self, name=None, driver=None, driver_opts=None, labels=None):
+        body = {'Name': name, 'Driver': driver, 'DriverOpts': driver_opts, 'Labels': labels}
+        response = await self.request(
+            'POST', '/volumes/create', body={k: v for k, v in body.items() if v is not None}
+        )
+        return response.json()
+
+    async def inspect_volume(self, name):
+        return (await self.request('GET', '/volumes/%s' % self._id(name))).json()
+
+    async def remove_volume(self, name, force=False):
+        await self.request('DELETE', '/volumes/%s' % self._id(name), {'force': int(force)})
+
+    # checkpoints need an experimental daemon with CRIU installed
+
+    async def checkpoint_create(self, container, checkpoint_id, exit=True, checkpoint_dir=None):
+        body = {'CheckpointID': checkpoint_id, 'Exit': exit}
+        if checkpoint_dir:
+            body['CheckpointDir'] = checkpoint_dir
+        await self.request(
+            'POST', '/containers/%s/checkpoints' % self._id(container), body=body, timeout=300
+        )
+
+    async def checkpoints(self, container, checkpoint_dir=None):
+        response = await self.request(
+            'GET', '/containers/%s/checkpoints' % self._id(container),
+            {'dir': checkpoint_dir},
+        )
+        return response.json()
+
+    async def checkpoint_delete(self, container, checkpoint_id, checkpoint_dir=None):
+        await self.request(
+            'DELETE', '/containers/%s/checkpoints/%s' % (self._id(container), self._id(checkpoint_id)),
+            {'dir': checkpoint_dir},
+        )
+
+    async def port(self, container, private_port):
+        info = await self.inspect_container(container)
+        ports = (info.get('NetworkSettings') or {}).get('Ports')
+        if ports is None:
+            return None
+        private_port = str(private_port)
+        if '/' in private_port:
+            return ports.get(private_port)
+        for protocol in ('tcp', 'udp', 'sctp'):
+            if ports.get('%s/%s' % (private_port, protocol)):
+                return ports['%s/%s' % (private_port, protocol)]
+        return None
@@ -0,0 +1,123 @@
+"""
+Shared, read-only Python environments for thin singleuser images.
+
+    c.DJLabSpawner.shared_env = True
+    c.EnvironmentStore.root = "/var/lib/djlabhub"
+
+A thin image (`singleuser/Thin.Dockerfile`) is a full singleuser image
+without its conda environment, labelled with the full image it was made
+from:
+
+    djlabhub.env-source=datajoint/djlabhub:singleuser-4.0.2-py3.10
+
+On the first spawn of a thin image on a Docker host, the full image's
+`/opt/conda` is exported to the host and keyed by a hash of its content:
+
+    <root>/envs/<content hash>/           the environment
+    <root>/envs/sources/<image id>        content hash of a full image's environment
+
+and every container of a thin image with the same environment mounts it
+read-only at `/opt/conda`. Image variants differing outside the
+environment, or rebuilt with identical packages, share one copy on disk
+and in the page cache, and pull only their thin layer. The full image is
+pulled once per host, for the export.
+
+The environment is read-only: `pip install` falls back to the user's
+`~/.local`, and `conda install` fails.
+"""
+import asyncio
+import time
+from typing import Dict, Optional, Tuple
+
+from docker.errors import ImageNotFound
+from traitlets import Unicode
+from traitlets.config import LoggingConfigurable
+
+from .jobs import run_job
+
+# label of thin images, naming the full image with their environment
+ENV_SOURCE_LABEL = 'djlabhub.env-source'
+
+
+class EnvironmentUnavailable(Exception):
+    """A thin image's environment could not be exported: it has none to fall back to."""
+
+EXPORT_SCRIPT = """
+set -eo pipefail
+envs=/djlabhub/envs
+source_file="$envs/sources/$IMAGE_ID"
+if [ -f "$source_file" ] && [ -d "$envs/$(cat "$source_file")" ]; then
+  cat "$source_file"
+  exit 0
+fi
+mkdir -p "$envs/sources"
+tmp=$(mktemp -d "$envs/.export-XXXXXX")
+trap 'rm -rf "$tmp"' EXIT
+cp -a {env}/. "$tmp/"
+hash=$(cd "$tmp" && find . -type f -print0 | LC_ALL=C sort -z | xargs -0 sha256sum \\
+  | sha256sum | cut -c1-32)
+if [ -d "$envs/$hash" ]; then
+  rm -rf "$tmp"
+else
+  chmod 755 "$tmp"
+  mv "$tmp" "$envs/$hash"
+fi
+trap - EXIT
+echo "$hash" > "$source_file.tmp" && mv "$source_file.tmp" "$source_file"
+echo "$hash"
+"""
+
+
+class EnvironmentStore(LoggingConfigurable):
+    """Environments exported from full images, shared by thin images' containers."""
+
+    root = Unicode(
+        "/var/lib/djlabhub",
+        config=True,
+        help="Directory on the Docker host holding the environments.",
+    )
+
+    env_path = Unicode("/opt/conda", config=True, help="Environment directory in the images.")
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # (host, image id) -> export, resolving to the content hash
+        self._exports: Dict[Tuple[str, str], asyncio.Future] = {}
+
+    async def _export(self, docker, config_client, source: str, image_id: str) -> str:
+        start = time.monotonic()
+        output = await run_job(
+            docker, config_client, source, EXPORT_SCRIPT.format(env=self.env_path),
+            binds=['%s:/djlabhub' % self.root],
+            env={'IMAGE_ID': image_id.replace('sha256:', '')},
+            kind='env-export',
+        )
+        content_hash = output.strip().splitlines()[-1].strip()
+        self.log.info(
+            "Environment of %s is %s (%.1fs)", source, content_hash, time.monotonic() - start
+        )
+        return content_hash
+
+    async def ensure(self, host: str, docker, config_client, source: str) -> str:
+        """Path on the Docker host of the environment of the full image `source`."""
+        try:
+            image = await docker('inspect_image', source)
+        except ImageNotFound:
+            self.log.info("Pulling %s for its environment", source)
+            repository, _, tag = source.rpartition(':')
+            if not repository or '/' in tag:
+                repository, tag = source, 'latest'
+            await docker('pull', repository, tag=tag)
+            image = await docker('inspect_image', source)
+        key = (host, image['Id'])
+        export = self._exports.get(key)
+        if export is None or (export.done() and (export.cancelled() or export.exception() is not None)):
+            export = self._exports[key] = asyncio.ensure_future(
+                self._export(docker, config_client, source, image['Id'])
+            )
+        return '%s/envs/%s' % (self.root, await asyncio.shield(export))
+
+    @staticmethod
+    def source(image: dict) -> Optional[str]:
+        """The full image of a thin image, from `inspect_image`."""
+        return ((image.get('Config') or {}).get('Labels') or {}).get(ENV_SOURCE_LABEL)
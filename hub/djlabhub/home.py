@@ -0,0 +1,193 @@
+"""
+Copy-on-write home directories from per-repository templates.
+
+    c.DJLabSpawner.home_templates = True
+    c.HomeTemplates.root = "/var/lib/djlabhub"
+
+Without templates, every new user's `before_start_hook.sh` clones
+`DJLABHUB_REPO` into their home. With them, the repository is cloned once
+per repository, branch and commit into a template on the Docker host:
+
+    <root>/templates/<repo hash>-<commit>/    the image's home, and the clone
+
+A new user's home is then a Docker volume made from the template in time
+independent of the repository's size:
+
+- `overlay`: an overlayfs volume with the template as its read-only lower
+  layer and `<root>/homes/<volume>/` holding the user's changes
+- `reflink`: a reflinked copy of the template in `<root>/homes/<volume>/`,
+  which needs a filesystem with reflinks (XFS, Btrfs)
+
+The hook finds the clone in place and skips it. The branch's commit is
+resolved with `git ls-remote`, at most every `resolve_interval` seconds, so
+a class started together shares one template; users who start after a new
+commit get a new template, and existing homes are never changed.
+Templates stay on disk, as overlay homes keep using them.
+
+Template builds and home creation run in helper containers of the spawn's
+image (see `djlabhub.jobs`), with `<root>` bind-mounted, so `<root>` is a
+path on the Docker host, not in the hub's container.
+"""
+import asyncio
+import hashlib
+import shlex
+import time
+from typing import Dict, Tuple
+
+from docker.errors import NotFound
+from traitlets import Enum, Float, Unicode
+from traitlets.config import LoggingConfigurable
+
+from .jobs import run_job
+
+# labels on home volumes
+HOME_LABEL = 'djlabhub.home'
+TEMPLATE_LABEL = 'djlabhub.home-template'
+
+
+class HomeTemplates(LoggingConfigurable):
+    """Home templates per repository commit, and home volumes made from them."""
+
+    root = Unicode(
+        "/var/lib/djlabhub",
+        config=True,
+        help="Directory on the Docker host holding templates and homes.",
+    )
+
+    method = Enum(
+        ["overlay", "reflink"],
+        default_value="overlay",
+        config=True,
+        help="How a home is made from its template, see `djlabhub.home`.",
+    )
+
+    owner = Unicode("1000:100", config=True, help="uid:gid owning the home, NB_UID:NB_GID.")
+
+    home_path = Unicode("/home/jovyan", config=True, help="Home directory in the image.")
+
+    resolve_interval = Float(
+        300,
+        config=True,
+        help="Seconds a branch's resolved commit is reused before asking the remote again.",
+    )
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # (repo, branch) -> (commit, resolved at)
+        self._commits: Dict[Tuple[str, str], Tuple[str, float]] = {}
+        # (host, template) -> build, shared by concurrent spawns
+        self._builds: Dict[Tuple[str, str], asyncio.Future] = {}
+
+    @staticmethod
+    def repo_name(repo: str) -> str:
+        """Directory of the clone in the home, as the startup hook names it."""
+        name = repo.rstrip('/').rsplit('/', 1)[-1]
+        return name[:-4] if name.endswith('.git') else name
+
+    async def resolve(self, docker, config_client, image: str, repo: str, branch: str) -> str:
+        """Commit at the head of `branch`, or of the default branch."""
+        key = (repo, branch)
+        cached = self._commits.get(key)
+        if cached and time.monotonic() - cached[1] < self.resolve_interval:
+            return cached[0]
+        output = await run_job(
+            docker, config_client, image,
+            'git ls-remote "$REPO" "${BRANCH:-HEAD}" | head -n 1',
+            env={'REPO': repo, 'BRANCH': branch},
+            kind='resolve', user=self.owner,
+        )
+        commit = output.split()[0] if output.split() else ''
+        if len(commit) != 40:
+            raise ValueError("Could not resolve %s of the repository" % (branch or 'HEAD'))
+        self._commits[key] = (commit, time.monotonic())
+        return commit
+
+    def template_name(self, repo: str, commit: str) -> str:
+        return '%s-%s' % (hashlib.sha256(repo.encode()).hexdigest()[:16], commit)
+
+    async def _build(self, docker, config_client, image: str, repo: str, branch: str, template: str):
+        start = time.monotonic()
+        script = """
+set -eo pipefail
+dest=/djlabhub/templates/{template}
+[ -d "$dest" ] && exit 0
+mkdir -p /djlabhub/templates
+tmp=$(mktemp -d /djlabhub/templates/.build-XXXXXX)
+trap 'rm -rf "$tmp"' EXIT
+cp -a {home}/. "$tmp/"
+git clone -q ${{BRANCH:+--branch "$BRANCH"}} "$REPO" "$tmp/{name}"
+git -C "$tmp/{name}" reset -q --hard {commit}
+chown -R {owner} "$tmp"
+chmod 755 "$tmp"
+mv "$tmp" "$dest"
+trap - EXIT
+""".format(
+            template=template,
+            home=shlex.quote(self.home_path),
+            name=shlex.quote(self.repo_name(repo)),
+            commit=template.rsplit('-', 1)[1],
+            owner=self.owner,
+        )
+        await run_job(
+            docker, config_client, image, script,
+            binds=['%s:/djlabhub' % self.root],
+            env={'REPO': repo, 'BRANCH': branch},
+            kind='home-template',
+        )
+        self.log.info("Built home template %s in %.1fs", template, time.monotonic() - start)
+
+    async def template(self, host: str, docker, config_client, image: str, repo: str, branch: str) -> str:
+        """Name of the template of `repo` at `branch`'s commit, built if needed."""
+        commit = await self.resolve(docker, config_client, image, repo, branch)
+        template = self.template_name(repo, commit)
+        key = (host, template)
+        build = self._builds.get(key)
+        if build is None or (build.done() and (build.cancelled() or build.exception() is not None)):
+            build = self._builds[key] = asyncio.ensure_future(
+                self._build(docker, config_client, image, repo, branch, template)
+            )
+        await asyncio.shield(build)
+        return template
+
+    async def ensure_home(
+        self, host: str, docker, config_client, image: str, volume: str, repo: str, branch: str,
+        on_build=None,
+    ) -> bool:
+        """
+        Create the home volume `volume` from the template of `repo`, unless
+        it exists. Returns True if it was created.
+        """
+        try:
+            await docker('inspect_volume', volume)
+            return False
+        except NotFound:
+            pass
+        if on_build is not None:
+            on_build()
+        template = await self.template(host, docker, config_client, image, repo, branch)
+        lower = '%s/templates/%s' % (self.root, template)
+        homes = '%s/homes/%s' % (self.root, volume)
+        if self.method == 'overlay':
+            script = 'mkdir -p /djlabhub/homes/{v}/upper /djlabhub/homes/{v}/work && ' \
+                     'chown {owner} /djlabhub/homes/{v}/upper'
+            driver_opts = {
+                'type': 'overlay',
+                'device': 'overlay',
+                'o': 'lowerdir=%s,upperdir=%s/upper,workdir=%s/work' % (lower, homes, homes),
+            }
+        else:
+            script = 'mkdir -p /djlabhub/homes/{v} && rm -rf /djlabhub/homes/{v}/home && ' \
+                     'cp -a --reflink=always /djlabhub/templates/{t} /djlabhub/homes/{v}/home'
+            driver_opts = {'type': 'none', 'o': 'bind', 'device': '%s/home' % homes}
+        await run_job(
+            docker, config_client, image,
+            script.format(v=shlex.quote(volume), t=template, owner=self.owner),
+            binds=['%s:/djlabhub' % self.root],
+            kind='home',
+        )
+        await docker(
+            'create_volume', volume, driver='local', driver_opts=driver_opts,
+            labels={HOME_LABEL: self.method, TEMPLATE_LABEL: template},
+        )
+        self.log.info("Created home %s from template %s (%s)", volume, template, self.method)
+        return True
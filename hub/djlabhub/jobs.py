@@ -0,0 +1,67 @@
+"""
+One-off helper containers, for work on a Docker host's filesystem.
+
+The hub runs in a container of its own, so preparing directories on a
+Docker host (home templates, shared environments) is done by a short-lived
+container with the host directories bind-mounted, running a bash script.
+"""
+import uuid
+from typing import Dict, List, Optional
+
+from docker.errors import APIError
+
+# label on helper containers, so that leftovers can be found
+JOB_LABEL = 'djlabhub.job'
+
+
+class JobFailed(Exception):
+    """A helper container exited with a non-zero status."""
+
+
+async def run_job(
+    docker,
+    config_client,
+    image: str,
+    script: str,
+    binds: Optional[List[str]] = None,
+    env: Optional[Dict[str, str]] = None,
+    kind: str = 'job',
+    user: str = 'root',
+    timeout: Optional[float] = None,
+) -> str:
+    """
+    Run `script` with bash in a new container of `image` and return its
+    output. `docker` calls the Docker API (e.g. `DJLabSpawner.docker`),
+    `config_client` is a docker-py APIClient for `create_host_config`.
+
+    Raises JobFailed, with the end of the output, if the script fails.
+    """
+    container = await docker(
+        'create_container',
+        image,
+        name='djlabhub-%s-%s' % (kind, uuid.uuid4().hex[:12]),
+        entrypoint=['bash', '-c'],
+        command=[script],
+        user=user,
+        environment=env or {},
+        labels={JOB_LABEL: kind},
+        tty=True,
+        host_config=config_client.create_host_config(binds=binds or []),
+    )
+    container_id = container['Id']
+    try:
+        await docker('start', container_id)
+        result = await docker('wait', container_id, timeout=timeout)
+        output = await docker('logs', container_id)
+        if isinstance(output, bytes):
+            output = output.decode('utf-8', 'replace')
+        if result.get('StatusCode'):
+            raise JobFailed(
+                "%s exited with %s: %s" % (kind, result['StatusCode'], output[-2000:].strip())
+            )
+        return output
+    finally:
+        try:
+            await docker('remove_container', container_id, force=True)
+        except APIError:
+            pass
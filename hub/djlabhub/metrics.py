@@ -0,0 +1,154 @@
+"""
+Prometheus metrics for the djlabhub hub extensions.
+
+They are registered in prometheus_client's default registry, which is what
+JupyterHub serves on `/hub/metrics`.
+"""
+import time
+from enum import Enum
+
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client.core import GaugeMetricFamily
+
+
+class RefreshOutcome(Enum):
+    """Branches taken by `RefreshingAuthenticator._refresh_user`."""
+
+    still_valid = 'still_valid'
+    refresh_expired = 'refresh_expired'
+    refreshed = 'refreshed'
+    # circuit open, current access token kept
+    shed = 'shed'
+    error = 'error'
+
+
+REFRESH_USER_DURATION_SECONDS = Histogram(
+    'djlabhub_refresh_user_duration_seconds',
+    'Time spent in RefreshingAuthenticator.refresh_user, by outcome',
+    ['outcome'],
+)
+
+REFRESH_USER_OUTCOME = Counter(
+    'djlabhub_refresh_user_total',
+    'RefreshingAuthenticator.refresh_user calls, by outcome',
+    ['outcome'],
+)
+
+REFRESH_USER_COALESCED = Counter(
+    'djlabhub_refresh_user_coalesced_total',
+    'refresh_user calls answered by an in-flight or recently finished refresh',
+)
+
+TOKEN_DECODE_DURATION_SECONDS = Histogram(
+    'djlabhub_token_decode_duration_seconds',
+    'Time to decode a token, including claims cache lookups and signature verification',
+    ['verified'],
+    buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1, 1),
+)
+
+TOKEN_REQUEST_DURATION_SECONDS = Histogram(
+    'djlabhub_token_request_duration_seconds',
+    'Latency of refresh requests to the OAuth token endpoint',
+)
+
+TOKEN_REQUEST_ERRORS = Counter(
+    'djlabhub_token_request_errors_total',
+    'Failed refresh requests to the OAuth token endpoint, by HTTP status code (599 for timeouts and connection errors)',
+    ['code'],
+)
+
+AUTH_STATE_CACHE = Counter(
+    'djlabhub_auth_state_cache_total',
+    'Lookups in the decrypted auth_state cache, by result (hit or miss)',
+    ['result'],
+)
+
+BREAKER_STATE = Gauge(
+    'djlabhub_circuit_breaker_state',
+    'State of a circuit breaker: 0 closed, 1 half-open, 2 open',
+    ['breaker'],
+)
+
+BREAKER_SHED = Counter(
+    'djlabhub_circuit_breaker_shed_total',
+    'Calls rejected because the circuit breaker was open',
+    ['breaker'],
+)
+
+SPAWN_PHASE_DURATION_SECONDS = Histogram(
+    'djlabhub_spawn_phase_duration_seconds',
+    'Duration of the phases of a spawn, see djlabhub.spawn_timing',
+    ['phase'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600),
+)
+
+SPAWN_QUEUE_LENGTH = Gauge(
+    'djlabhub_spawn_queue_length',
+    'Spawns waiting for admission',
+)
+
+SPAWN_CONCURRENCY_LIMIT = Gauge(
+    'djlabhub_spawn_concurrency_limit',
+    'Current adaptive limit of spawns admitted at the same time',
+)
+
+CHECKPOINT_DURATION_SECONDS = Histogram(
+    'djlabhub_checkpoint_duration_seconds',
+    'Duration of checkpointing servers to disk on hibernation',
+    ['outcome'],
+    buckets=(0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300),
+)
+
+RESTORE_OUTCOME = Counter(
+    'djlabhub_restore_total',
+    'Starts of hibernated servers, by whether their checkpoint was restored',
+    ['outcome'],
+)
+
+
+class TokenExpiryCollector:
+    """
+    Seconds until access token expiry, summarized over the users whose
+    tokens the hub has inspected recently.
+
+    Per-user series would grow with the user count, so the collector only
+    exports the minimum, median and maximum, plus the number of users.
+    """
+
+    # forget users whose token expired longer ago than this
+    retention = 3600
+
+    def __init__(self):
+        # user name -> access token exp
+        self._exp = {}
+
+    def observe(self, name: str, exp: float):
+        self._exp[name] = exp
+
+    def forget(self, name: str):
+        self._exp.pop(name, None)
+
+    def collect(self):
+        now = time.time()
+        for name in [n for n, exp in self._exp.items() if exp < now - self.retention]:
+            del self._exp[name]
+        remaining = sorted(exp - now for exp in self._exp.values())
+        gauge = GaugeMetricFamily(
+            'djlabhub_access_token_seconds_until_expiry',
+            'Seconds until access token expiry across active users',
+            labels=['quantile'],
+        )
+        if remaining:
+            gauge.add_metric(['0'], remaining[0])
+            gauge.add_metric(['0.5'], remaining[len(remaining) // 2])
+            gauge.add_metric(['1'], remaining[-1])
+        yield gauge
+        yield GaugeMetricFamily(
+            'djlabhub_access_token_users',
+            'Number of users included in djlabhub_access_token_seconds_until_expiry',
+            value=len(remaining),
+        )
+
+
+TOKEN_EXPIRY = TokenExpiryCollector()
+REGISTRY.register(TOKEN_EXPIRY)
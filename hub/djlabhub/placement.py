@@ -0,0 +1,310 @@
+"""
+Placement of singleuser containers on several Docker hosts.
+
+    c.DJLabSpawner.docker_hosts = {
+        "node1": {"url": "tcp://10.0.0.11:2375"},
+        "node2": {"url": "tcp://10.0.0.12:2375", "cpu": 32, "mem": "128G"},
+    }
+
+Each spawn is placed on one host and stays there while its container exists
+(the host is part of the spawner's state). A new placement goes to the host
+that fits the spawn's CPU and memory request most tightly (best-fit bin
+packing), among hosts with room for it, adjusted for
+
+- image locality: hosts that have the image already are preferred, so the
+  spawn does not pull it
+- live load: the memory the host's djlabhub containers actually use, when
+  it exceeds what they requested, and the number of running containers per
+  CPU
+
+Host capacity comes from the daemon (`/info`) unless configured. Requests
+are recorded as container labels, so a restarted hub recovers every host's
+allocation from one container listing per host. Stopped containers
+(`c.DockerSpawner.remove = False`) hold no allocation, unless they are
+hibernated: their checkpoint is restored on the same host.
+
+Containers on other hosts are only reachable from the hub over a network
+spanning the hosts, e.g. an attachable overlay network as
+`c.DockerSpawner.network_name`, or through published ports
+(`use_internal_ip = False`).
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+import docker
+from jupyterhub.traitlets import ByteSpecification
+from traitlets import Float, Integer
+from traitlets.config import LoggingConfigurable
+
+from .docker_api import ASYNC_METHODS, CHECKPOINT_METHODS, AsyncDockerClient
+
+# labels on placed containers
+HOST_LABEL = 'djlabhub.host'
+CPU_LABEL = 'djlabhub.cpu'
+MEM_LABEL = 'djlabhub.mem'
+
+# container states that hold their allocation; stopped ones only with a checkpoint
+ALLOCATED_STATES = frozenset(['created', 'running', 'paused', 'restarting'])
+
+
+class NoCapacity(Exception):
+    """No configured host has room for a spawn."""
+
+
+class DockerHost:
+    """One Docker endpoint, its capacity, and what has been placed on it."""
+
+    def __init__(self, name: str, url: str, cpu: Optional[float] = None, mem: Optional[int] = None,
+                 version: str = '1.41', max_connections: int = 4):
+        self.name = name
+        self.url = url
+        self._cpu = cpu
+        self._mem = mem
+        # a fixed API version: 'auto' would contact the host right away
+        self.client = docker.APIClient(base_url=url, version=version)
+        self.async_client = AsyncDockerClient(
+            url, version=version, max_connections=max_connections,
+            config_client=self.client,
+        )
+        self._executor = ThreadPoolExecutor(2)
+        self.available = False
+        self.cpu = 0.0
+        self.mem = 0
+        self.running = 0
+        # container id -> (cpu, mem) requested by djlabhub containers
+        self.allocations: Dict[str, tuple] = {}
+        # container id -> memory in use, from the last stats sample
+        self.usage: Dict[str, int] = {}
+        self.images = set()
+        self.refreshed = 0.0
+
+    def docker(self, method, *args, **kwargs):
+        """Call a docker-py APIClient method on this host."""
+        if method in ASYNC_METHODS or method in CHECKPOINT_METHODS:
+            return getattr(self.async_client, method)(*args, **kwargs)
+        return asyncio.wrap_future(
+            self._executor.submit(getattr(self.client, method), *args, **kwargs)
+        )
+
+    @property
+    def allocated_cpu(self) -> float:
+        return sum(cpu for cpu, _ in self.allocations.values())
+
+    @property
+    def allocated_mem(self) -> int:
+        return sum(mem for _, mem in self.allocations.values())
+
+    @property
+    def used_mem(self) -> int:
+        """Memory committed to djlabhub containers: requested, or used if more."""
+        return sum(
+            max(mem, self.usage.get(container_id, 0))
+            for container_id, (_, mem) in self.allocations.items()
+        )
+
+    def has_image(self, image: str) -> bool:
+        return image in self.images or (':' not in image.split('/')[-1] and image + ':latest' in self.images)
+
+    async def refresh(self, sample_usage: bool, stats_concurrency: int,
+                      checkpoints: bool = False, checkpoint_dir: Optional[str] = None):
+        info = await self.docker('info')
+        self.cpu = float(self._cpu or info['NCPU'])
+        self.mem = int(self._mem or info['MemTotal'])
+        self.running = info.get('ContainersRunning', 0)
+        self.images = {
+            tag for image in await self.docker('images') for tag in image.get('RepoTags') or ()
+        }
+        # allocations added from here on are kept, see below
+        before = set(self.allocations)
+        containers = await self.docker('containers', all=True, filters={'label': CPU_LABEL})
+        limit = asyncio.Semaphore(stats_concurrency)
+
+        async def has_checkpoint(container_id):
+            async with limit:
+                return bool(await self.async_client.checkpoints(container_id, checkpoint_dir=checkpoint_dir))
+
+        stopped = [c['Id'] for c in containers if c.get('State') not in ALLOCATED_STATES]
+        hibernated = set()
+        if checkpoints and stopped:
+            results = await asyncio.gather(*map(has_checkpoint, stopped), return_exceptions=True)
+            # a failed listing keeps the container's allocation
+            hibernated = {c for c, r in zip(stopped, results) if r is True or isinstance(r, Exception)}
+        allocations = {}
+        for container in containers:
+            if container.get('State') not in ALLOCATED_STATES and container['Id'] not in hibernated:
+                continue
+            labels = container.get('Labels') or {}
+            try:
+                allocations[container['Id']] = (float(labels[CPU_LABEL]), int(labels[MEM_LABEL]))
+            except (KeyError, ValueError):
+                continue
+        # pending placements, and containers placed since the listing started
+        # (`placed` renames a pending key to the new container's id)
+        for container_id, request in self.allocations.items():
+            if container_id.startswith('pending-') or container_id not in before:
+                allocations.setdefault(container_id, request)
+        self.allocations = allocations
+
+        if sample_usage:
+            running = [c['Id'] for c in containers if c.get('State') == 'running']
+
+            async def sample(container_id):
+                async with limit:
+                    stats = await self.async_client.stats(container_id)
+                return container_id, (stats.get('memory_stats') or {}).get('usage', 0)
+
+            results = await asyncio.gather(*map(sample, running), return_exceptions=True)
+            self.usage = dict(r for r in results if isinstance(r, tuple))
+        self.available = True
+        self.refreshed = time.monotonic()
+
+
+class PlacementScheduler(LoggingConfigurable):
+    """Chooses a Docker host for each new singleuser container."""
+
+    default_cpu = Float(
+        1, config=True, help="CPUs requested by spawns without cpu_guarantee or cpu_limit."
+    )
+
+    default_mem = ByteSpecification(
+        '2G', config=True, help="Memory requested by spawns without mem_guarantee or mem_limit."
+    )
+
+    cpu_overcommit = Float(
+        1.0, config=True, help="Factor of a host's CPUs that may be requested in total."
+    )
+
+    mem_overcommit = Float(
+        1.0, config=True, help="Factor of a host's memory that may be requested in total."
+    )
+
+    image_locality_weight = Float(
+        0.5,
+        config=True,
+        help="""
+        Score bonus of hosts that have the spawn's image, relative to a host
+        that would be filled completely by the spawn.
+        """,
+    )
+
+    load_weight = Float(
+        0.25,
+        config=True,
+        help="Score penalty per running container per CPU of a host.",
+    )
+
+    refresh_interval = Float(
+        30, config=True, help="Seconds between refreshes of host capacity, images and load."
+    )
+
+    sample_usage = Integer(
+        8,
+        config=True,
+        help="""
+        Containers whose memory usage is sampled at the same time on each
+        refresh, per host. 0 disables sampling, and placement uses requests only.
+        """,
+    )
+
+    def __init__(self, hosts: Dict[str, dict], hibernate: bool = False, checkpoint_dir: str = '', **kwargs):
+        super().__init__(**kwargs)
+        # whether stopped containers may hold checkpoints, and where
+        self.hibernate = hibernate
+        self.checkpoint_dir = checkpoint_dir or None
+        self.hosts = {}
+        for name, spec in hosts.items():
+            mem = spec.get('mem')
+            if isinstance(mem, str):
+                mem = ByteSpecification().from_string(mem)
+            self.hosts[name] = DockerHost(name, spec['url'], cpu=spec.get('cpu'), mem=mem)
+        self._refreshing: Optional[asyncio.Future] = None
+
+    async def _refresh_host(self, host: DockerHost):
+        try:
+            await host.refresh(
+                self.sample_usage > 0, max(self.sample_usage, 1),
+                checkpoints=self.hibernate, checkpoint_dir=self.checkpoint_dir,
+            )
+        except Exception as e:
+            if host.available:
+                self.log.warning("Docker host %s is unavailable: %s", host.name, e)
+            host.available = False
+
+    async def refresh(self, force: bool = False):
+        """Refresh all hosts, at most every `refresh_interval` unless forced."""
+        stale = force or any(
+            time.monotonic() - host.refreshed > self.refresh_interval for host in self.hosts.values()
+        )
+        if not stale:
+            return
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.ensure_future(
+                asyncio.gather(*map(self._refresh_host, self.hosts.values()))
+            )
+        await asyncio.shield(self._refreshing)
+
+    def score(self, host: DockerHost, image: str, cpu: float, mem: int) -> Optional[float]:
+        """Placement score of `host`, higher is better; None if it does not fit."""
+        if not host.available or host.cpu <= 0 or host.mem <= 0:
+            return None
+        free_cpu = host.cpu * self.cpu_overcommit - host.allocated_cpu
+        free_mem = host.mem * self.mem_overcommit - host.used_mem
+        if cpu > free_cpu or mem > free_mem:
+            return None
+        # best fit: the fuller the host after placement, the better
+        fill = max(
+            1 - (free_cpu - cpu) / (host.cpu * self.cpu_overcommit),
+            1 - (free_mem - mem) / (host.mem * self.mem_overcommit),
+        )
+        score = fill - self.load_weight * host.running / host.cpu
+        if host.has_image(image):
+            score += self.image_locality_weight
+        return score
+
+    async def place(self, key: str, image: str, cpu: Optional[float], mem: Optional[int]) -> DockerHost:
+        """
+        Choose a host for a new container and reserve its request there
+        under `key` until `placed` or `cancel`.
+        """
+        cpu = cpu or self.default_cpu
+        mem = mem or self.default_mem
+        await self.refresh()
+        scores = {
+            name: self.score(host, image, cpu, mem) for name, host in self.hosts.items()
+        }
+        scores = {name: score for name, score in scores.items() if score is not None}
+        if not scores:
+            raise NoCapacity(
+                "No Docker host has %.1f CPUs and %i MB of memory free" % (cpu, mem >> 20)
+            )
+        host = self.hosts[max(scores, key=scores.get)]
+        host.allocations['pending-' + key] = (cpu, mem)
+        self.log.debug("Placing %s on %s, scores %s", key, host.name, scores)
+        return host
+
+    def labels(self, host: DockerHost, cpu: Optional[float], mem: Optional[int]) -> dict:
+        return {
+            HOST_LABEL: host.name,
+            CPU_LABEL: str(cpu or self.default_cpu),
+            MEM_LABEL: str(mem or self.default_mem),
+        }
+
+    def placed(self, host: DockerHost, key: str, container_id: str):
+        """The container reserved for under `key` exists now."""
+        request = host.allocations.pop('pending-' + key, None)
+        if request is not None:
+            host.allocations[container_id] = request
+
+    def started(self, host: DockerHost, container_id: str, cpu: Optional[float], mem: Optional[int]):
+        """A stopped container on `host` is running again."""
+        host.allocations.setdefault(container_id, (cpu or self.default_cpu, mem or self.default_mem))
+
+    def cancel(self, host: DockerHost, key: str):
+        host.allocations.pop('pending-' + key, None)
+
+    def removed(self, host: DockerHost, container_id: str):
+        """The container is removed, or stopped without a checkpoint."""
+        host.allocations.pop(container_id, None)
+        host.usage.pop(container_id, None)
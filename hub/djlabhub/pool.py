@@ -0,0 +1,206 @@
+"""
+Warm pool of pre-started singleuser containers.
+
+Pool containers are created and started ahead of time from the configured
+images, and wait in `djlabhub-pool-wait` (see `singleuser/config/pool_wait.sh`)
+without starting Jupyter. A spawn claims one: the spawner renames it to the
+user's container name and writes a claim script with the user's environment
+and command into it, which the waiting process then `exec`s. Image pull,
+container create and start are therefore off the spawn path.
+
+Claimed containers are replaced in the background.
+"""
+import asyncio
+import io
+import shlex
+import tarfile
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+from traitlets import Any, Float, Integer
+from traitlets.config import LoggingConfigurable
+
+# label carrying the image a pool container was created for
+POOL_LABEL = 'djlabhub.pool'
+WAIT_COMMAND = ['djlabhub-pool-wait']
+CLAIM_DIR = '/tmp/djlabhub-claim'
+# docker-stacks' startup hooks, which start.sh ran at pool boot, without the user's environment
+HOOKS_DIR = '/usr/local/bin/before-notebook.d'
+
+
+def claim_archive(env: Dict[str, str], cmd: List[str], uid: int = 1000, gid: int = 100) -> bytes:
+    """
+    Tar archive for `put_archive`, holding the claim script and, after it,
+    the `ready` marker that `pool_wait.sh` waits for. Tar members are
+    extracted in order, so the script is complete once the marker exists.
+
+    The script removes itself, as it holds the server's API token, runs the
+    startup hooks again with the user's environment (`DJLABHUB_REPO` etc.)
+    as start.sh does, and execs `cmd`.
+    """
+    lines = ['#!/bin/bash', 'rm -f -- "$0"']
+    lines += ['export %s=%s' % (key, shlex.quote(str(value))) for key, value in env.items()]
+    lines += [
+        'for f in %s/*; do' % HOOKS_DIR,
+        '  case "$f" in',
+        '    *.sh) source "$f" ;;',
+        '    *) if [ -x "$f" ]; then "$f"; fi ;;',
+        '  esac',
+        'done',
+    ]
+    lines.append('exec ' + ' '.join(shlex.quote(arg) for arg in cmd))
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for name, data, mode in [
+            ('claim.sh', ('\n'.join(lines) + '\n').encode(), 0o700),
+            ('ready', b'', 0o600),
+        ]:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = mode
+            info.uid, info.gid = uid, gid
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+class WarmPool(LoggingConfigurable):
+    """Idle, started containers per image, refilled in the background."""
+
+    refill_concurrency = Integer(
+        2,
+        config=True,
+        help="Pool containers created at the same time, across all images.",
+    )
+
+    refill_interval = Float(
+        30,
+        config=True,
+        help="""
+        Seconds between checks that every image has its pool, e.g. after a
+        pool container exited. Claims trigger a refill immediately.
+        """,
+    )
+
+    docker = Any(help="Coroutine function calling the Docker API, as DockerSpawner.docker.")
+
+    create_kwargs = Any(
+        help="Callable returning `create_container` keyword arguments for an image."
+    )
+
+    def __init__(self, sizes: Dict[str, int], **kwargs):
+        super().__init__(**kwargs)
+        self.sizes = dict(sizes)
+        # image -> ids of idle, started pool containers
+        self._idle: Dict[str, deque] = {image: deque() for image in self.sizes}
+        self._creating: Dict[str, int] = {image: 0 for image in self.sizes}
+        self._refill = asyncio.Event()
+        self._limit = asyncio.Semaphore(self.refill_concurrency)
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def idle(self, image: str) -> int:
+        return len(self._idle.get(image, ()))
+
+    async def _discover(self):
+        """Adopt pool containers left by a previous hub process."""
+        containers = await self.docker(
+            'containers', filters={'label': POOL_LABEL, 'status': 'running'}
+        )
+        for container in containers:
+            if not any(n.startswith('/djlabhub-pool-') for n in container['Names']):
+                # claimed already, and renamed to its user's container name
+                continue
+            image = container['Labels'].get(POOL_LABEL)
+            if image in self._idle and container['Id'] not in self._idle[image]:
+                self._idle[image].append(container['Id'])
+
+    async def _create(self, image: str):
+        self._creating[image] += 1
+        try:
+            async with self._limit:
+                kwargs = self.create_kwargs(image)
+                container = await self.docker('create_container', **kwargs)
+                await self.docker('start', container['Id'])
+                self._idle[image].append(container['Id'])
+                self.log.info("Warm pool: started %s for %s", container['Id'][:12], image)
+        except Exception:
+            self.log.error("Warm pool: failed to create a container for %s", image, exc_info=True)
+        finally:
+            self._creating[image] -= 1
+
+    async def fill(self):
+        tasks = []
+        for image, size in self.sizes.items():
+            missing = size - len(self._idle[image]) - self._creating[image]
+            tasks += [asyncio.ensure_future(self._create(image)) for _ in range(missing)]
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    async def _run(self):
+        try:
+            await self._discover()
+        except Exception:
+            self.log.error("Warm pool: failed to list existing pool containers", exc_info=True)
+        while True:
+            await self.fill()
+            self._refill.clear()
+            try:
+                await asyncio.wait_for(self._refill.wait(), self.refill_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self._prune()
+            except Exception:
+                self.log.error("Warm pool: failed to check idle pool containers", exc_info=True)
+
+    async def _prune(self):
+        """Forget pool containers that are no longer running."""
+        for image, idle in list(self._idle.items()):
+            for container_id in list(idle):
+                try:
+                    info = await self.docker('inspect_container', container_id)
+                    running = info['State']['Running']
+                except Exception:
+                    running = False
+                # claimed while it was inspected
+                if not running and container_id in idle:
+                    idle.remove(container_id)
+
+    async def claim(self, image: str) -> Optional[str]:
+        """
+        Take an idle container for `image` out of the pool, or None.
+        """
+        idle = self._idle.get(image)
+        while idle:
+            container_id = idle.popleft()
+            self._refill.set()
+            try:
+                info = await self.docker('inspect_container', container_id)
+            except Exception:
+                continue
+            if info['State']['Running']:
+                return container_id
+        return None
+
+    async def hand_over(
+        self, container_id: str, name: str, env: Dict[str, str], cmd: List[str],
+        uid: int = 1000, gid: int = 100,
+    ):
+        """
+        Give a claimed container to a user: rename it and let it start `cmd`
+        with `env`.
+        """
+        await self.docker('rename', container_id, name)
+        await self.docker(
+            'put_archive', container_id, CLAIM_DIR, claim_archive(env, cmd, uid, gid)
+        )
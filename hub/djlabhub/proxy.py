@@ -0,0 +1,45 @@
+"""
+Proxy for the djlabhub hub.
+
+    c.JupyterHub.proxy_class = "djlabhub.proxy.DJLabProxy"
+
+After a restart the hub re-checks every route and issues one proxy API
+request for each route to add, update or delete, all at once. `DJLabProxy`
+keeps at most `route_concurrency` of them in flight, starting the next as
+soon as one finishes, so thousands of route updates do not swamp the
+proxy's API.
+
+This is a concurrency cap, not batching: configurable-http-proxy's API
+takes one route per request and has no bulk endpoint, so updates collected
+into a batch would still be sent one request each, only later. The hub
+already reads every route with a single `GET /api/routes`. For route
+changes written together, see `djlabhub.traefik`.
+"""
+import asyncio
+
+from jupyterhub.proxy import ConfigurableHTTPProxy
+from traitlets import Integer
+
+
+class DJLabProxy(ConfigurableHTTPProxy):
+    route_concurrency = Integer(
+        32,
+        config=True,
+        help="Maximum number of route updates in flight to the proxy's API at once.",
+    )
+
+    _route_limit = None
+
+    @property
+    def route_limit(self) -> asyncio.Semaphore:
+        if self._route_limit is None:
+            self._route_limit = asyncio.Semaphore(self.route_concurrency)
+        return self._route_limit
+
+    async def add_route(self, routespec, target, data):
+        async with self.route_limit:
+            return await super().add_route(routespec, target, data)
+
+    async def delete_route(self, routespec):
+        async with self.route_limit:
+            return await super().delete_route(routespec)
@@ -0,0 +1,43 @@
+"""
+Push-based readiness of singleuser servers.
+
+The singleuser images run a server extension (singleuser/config/djlabhub_ready.py)
+that posts to
+
+    POST /hub/api/djlabhub/users/<name>/ready
+    {"server_name": ""}
+
+with the server's API token once Jupyter is listening. `DJLabSpawner.start`
+waits for it before returning, so the hub's readiness check succeeds on its
+first request instead of polling with backoff. Images without the extension
+are not waited for (see `READY_LABEL`), and the hub's own polling remains
+the fallback.
+"""
+from jupyterhub.apihandlers.base import APIHandler
+from jupyterhub.scopes import needs_scope
+from tornado import web
+
+# image label of singleuser images that notify the hub
+READY_LABEL = 'djlabhub.ready-notify'
+
+
+class ServerReadyAPIHandler(APIHandler):
+    @needs_scope('users:activity')
+    async def post(self, user_name):
+        user = self.find_user(user_name)
+        if user is None:
+            raise web.HTTPError(404)
+        body = self.get_json_body() or {}
+        server_name = body.get('server_name') or ''
+        if server_name not in user.spawners:
+            raise web.HTTPError(404, "No such server %s" % server_name)
+        spawner = user.spawners[server_name]
+        if not spawner.pending or not hasattr(spawner, 'notify_ready'):
+            raise web.HTTPError(404, "Not waiting for %s to start" % spawner._log_name)
+        spawner.notify_ready()
+        self.set_status(204)
+
+
+default_handlers = [
+    (r"/api/djlabhub/users/(?P<user_name>[^/]+)/ready", ServerReadyAPIHandler),
+]
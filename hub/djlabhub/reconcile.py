@@ -0,0 +1,79 @@
+"""
+Bulk reconciliation of running servers when the hub starts.
+
+On startup the hub polls every server it believes is running. For
+DockerSpawner that is one `inspect_container` per server, so thousands of
+servers take a long time to check. `ContainerSnapshot` lists all containers
+in a single Docker API call instead, and answers each spawner's startup
+poll from that listing. Only containers whose state the listing does not
+settle (restarting, removing, or found under a different name) are
+inspected one by one, at most `max_inspect` at a time.
+"""
+import asyncio
+import time
+from typing import Optional
+
+# poll result meaning "inspect the container to find out"
+AMBIGUOUS = object()
+
+# listed states of containers that have stopped running
+STOPPED_STATES = {'created', 'exited', 'dead'}
+
+
+class ContainerSnapshot:
+    """A listing of all containers, shared by the polls of one hub start."""
+
+    def __init__(self, docker, max_age: float = 30, max_inspect: int = 16, log=None):
+        self.docker = docker
+        self.max_age = max_age
+        self.log = log
+        self.inspect_limit = asyncio.Semaphore(max_inspect)
+        self._listing: Optional[asyncio.Future] = None
+        self._listed = 0.0
+
+    async def _list(self):
+        start = time.monotonic()
+        containers = await self.docker('containers', all=True)
+        by_name = {}
+        by_id = {}
+        for container in containers:
+            by_id[container['Id']] = container
+            for name in container.get('Names') or ():
+                by_name[name.lstrip('/')] = container
+        if self.log is not None:
+            self.log.info(
+                "Listed %i containers in %.2fs to reconcile running servers",
+                len(containers), time.monotonic() - start,
+            )
+        return by_name, by_id
+
+    async def listing(self):
+        if self._listing is None or time.monotonic() - self._listed > self.max_age:
+            self._listed = time.monotonic()
+            self._listing = asyncio.ensure_future(self._list())
+        try:
+            return await asyncio.shield(self._listing)
+        except Exception:
+            # let the next poll list again
+            self._listing = None
+            raise
+
+    async def status(self, name: str, container_id: Optional[str]):
+        """
+        `(status, container id)` of the container `name`, with DockerSpawner's
+        poll results: None while running, 0 if missing, a description if
+        stopped. The status is `AMBIGUOUS` if the container must be inspected.
+        """
+        by_name, by_id = await self.listing()
+        container = by_name.get(name)
+        if container is None:
+            if container_id and container_id in by_id:
+                # known under another name, e.g. a renamed pool container
+                return AMBIGUOUS, container_id
+            return 0, None
+        state = container.get('State')
+        if state == 'running':
+            return None, container['Id']
+        if state in STOPPED_STATES:
+            return "State=%s, Status='%s'" % (state, container.get('Status')), container['Id']
+        return AMBIGUOUS, container['Id']
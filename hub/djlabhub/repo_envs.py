@@ -0,0 +1,149 @@
+"""
+Prebuilt dependencies of `DJLABHUB_REPO` for `DJLABHUB_REPO_INSTALL`.
+
+    c.DJLabSpawner.repo_envs = True
+    c.RepoEnvironments.root = "/var/lib/djlabhub"
+
+With `DJLABHUB_REPO_INSTALL=TRUE` the startup hook runs
+`pip install -e $HOME/$REPO_NAME` on every start, resolving and often
+building the repository's dependencies again. With repository environments
+the hub installs them once, into a directory on the Docker host keyed by
+the files declaring them (`pyproject.toml`, `setup.py`, `setup.cfg`,
+`requirements*.txt`) and the image:
+
+    <root>/repo-envs/<requirements hash>/            pip install --target
+    <root>/repo-envs/commits/<repo>-<commit>-<image> requirements hash of a commit
+
+and mounts it read-only at `/opt/djlabhub/repo-env`, named by
+`DJLABHUB_REPO_ENV`. The hook puts it on `PYTHONPATH` and only links the
+repository itself, with `pip install --no-deps -e`.
+
+The repository's own distribution is left out of the directory, so the
+editable install is the one imported. Commits that do not change the
+dependency files reuse the directory. A spawn waits `repo_env_wait`
+seconds for a build, then starts without it, and the hook installs as
+before; the build carries on for later spawns.
+"""
+import asyncio
+import hashlib
+import time
+from typing import Dict, Tuple
+
+from traitlets import Unicode
+from traitlets.config import LoggingConfigurable
+
+from .jobs import run_job
+
+BUILD_SCRIPT = """
+set -eo pipefail
+base=/djlabhub/repo-envs
+commit_file="$base/commits/$KEY"
+if [ -f "$commit_file" ] && [ -d "$base/$(cat "$commit_file")" ]; then
+  cat "$commit_file"
+  exit 0
+fi
+mkdir -p "$base/commits"
+work=$(mktemp -d)
+git clone -q ${BRANCH:+--branch "$BRANCH"} "$REPO" "$work/repo"
+git -C "$work/repo" reset -q --hard "$COMMIT"
+requirements_hash=$(
+  cd "$work/repo"
+  echo "$IMAGE_ID"
+  for f in pyproject.toml setup.py setup.cfg requirements*.txt; do
+    if [ -f "$f" ]; then echo "$f"; cat "$f"; fi
+  done | sha256sum | cut -c1-32
+)
+if [ ! -d "$base/$requirements_hash" ]; then
+  tmp=$(mktemp -d "$base/.build-XXXXXX")
+  trap 'rm -rf "$tmp"' EXIT
+  pip install --quiet --no-warn-script-location --target "$tmp" --report "$work/report.json" "$work/repo"
+  python - "$tmp" "$work/report.json" <<'PY'
+import json
+import os
+import shutil
+import sys
+
+# the repository's own distribution is installed editable by the startup hook
+target, report = sys.argv[1:]
+names = [
+    item["metadata"]["name"].lower().replace("-", "_")
+    for item in json.load(open(report))["install"]
+    if item.get("download_info", {}).get("url", "").startswith("file://")
+]
+for entry in os.listdir(target):
+    if not entry.endswith(".dist-info") or entry.rsplit("-", 1)[0].lower().replace("-", "_") not in names:
+        continue
+    dist_info = os.path.join(target, entry)
+    with open(os.path.join(dist_info, "RECORD")) as record:
+        for line in record:
+            path = os.path.normpath(os.path.join(target, line.rsplit(",", 2)[0]))
+            if path.startswith(target + os.sep) and os.path.isfile(path):
+                os.remove(path)
+    shutil.rmtree(dist_info, ignore_errors=True)
+PY
+  chmod -R a+rX "$tmp"
+  mv "$tmp" "$base/$requirements_hash"
+  trap - EXIT
+fi
+rm -rf "$work"
+echo "$requirements_hash" > "$commit_file.tmp" && mv "$commit_file.tmp" "$commit_file"
+echo "$requirements_hash"
+"""
+
+
+class RepoEnvironments(LoggingConfigurable):
+    """Dependencies of repository commits, installed once per host."""
+
+    root = Unicode(
+        "/var/lib/djlabhub",
+        config=True,
+        help="Directory on the Docker host holding the installed dependencies.",
+    )
+
+    mount_path = Unicode(
+        "/opt/djlabhub/repo-env",
+        config=True,
+        help="Where the dependencies are mounted in singleuser containers.",
+    )
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # (host, repo, commit, image id) -> build, resolving to the path on the host
+        self._builds: Dict[Tuple[str, str, str, str], asyncio.Future] = {}
+
+    async def _build(self, docker, config_client, image_id: str, repo: str, branch: str, commit: str) -> str:
+        start = time.monotonic()
+        key = '%s-%s-%s' % (
+            hashlib.sha256(repo.encode()).hexdigest()[:16], commit, image_id.replace('sha256:', '')[:16]
+        )
+        output = await run_job(
+            docker, config_client, image_id, BUILD_SCRIPT,
+            binds=['%s:/djlabhub' % self.root],
+            env={'REPO': repo, 'BRANCH': branch, 'COMMIT': commit, 'IMAGE_ID': image_id, 'KEY': key},
+            kind='repo-env',
+        )
+        requirements_hash = output.strip().splitlines()[-1].strip()
+        self.log.info(
+            "Dependencies of %s at %s are %s (%.1fs)",
+            repo.rsplit('/', 1)[-1], commit[:12], requirements_hash, time.monotonic() - start,
+        )
+        return '%s/repo-envs/%s' % (self.root, requirements_hash)
+
+    def build(self, host: str, docker, config_client, image_id: str, repo: str, branch: str, commit: str) -> asyncio.Future:
+        """
+        The dependencies of `repo` at `commit` for the image `image_id`,
+        resolving to their path on the Docker host; built if needed, once.
+        """
+        key = (host, repo, commit, image_id)
+        build = self._builds.get(key)
+        if build is None or (build.done() and (build.cancelled() or build.exception() is not None)):
+            build = self._builds[key] = asyncio.ensure_future(
+                self._build(docker, config_client, image_id, repo, branch, commit)
+            )
+            build.add_done_callback(self._log_failure)
+        return build
+
+    def _log_failure(self, build: asyncio.Future):
+        # spawns stop waiting after `repo_env_wait`, so failures may have no one to raise to
+        if not build.cancelled() and build.exception() is not None:
+            self.log.warning("Failed to build repository dependencies: %s", build.exception())
@@ -0,0 +1,227 @@
+"""
+Background token refresh, so that requests rarely wait on the token endpoint.
+
+Users with a running server are kept in a min-heap ordered by when their
+access token should be refreshed, `margin` (plus jitter) seconds before its
+`exp`. Due users are refreshed through `RefreshingAuthenticator.refresh_user`,
+the same path the hub uses on requests, and the new `auth_state` is saved.
+"""
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from typing import Iterable, Optional
+
+from traitlets import Any, Float
+from traitlets.config import LoggingConfigurable
+
+from .metrics import TOKEN_EXPIRY
+
+
+class RefreshScheduler(LoggingConfigurable):
+    """Refresh active users' OAuth tokens shortly before they expire."""
+
+    margin = Float(
+        60,
+        config=True,
+        help="""
+        Seconds before the access token's `exp` to refresh it.
+
+        `refresh_user` only contacts the token endpoint once the token has
+        less than `auth_refresh_age` seconds left, so `margin + jitter` is
+        capped at the authenticator's `auth_refresh_age`.
+        """,
+    )
+
+    jitter = Float(
+        30,
+        config=True,
+        help="""
+        Up to this many extra seconds are taken off each user's refresh time
+        at random, so that tokens issued together are not refreshed together.
+        """,
+    )
+
+    rate_limit = Float(
+        10,
+        config=True,
+        help="Maximum number of refreshes per second sent to the token endpoint.",
+    )
+
+    scan_interval = Float(
+        60,
+        config=True,
+        help="""
+        Seconds between scans for users whose servers started since the last
+        scan. Users whose servers stopped are dropped when they come due.
+        """,
+    )
+
+    authenticator = Any(help="The RefreshingAuthenticator doing the refreshes.")
+
+    users = Any(
+        help="""
+        Callable returning the hub's User objects. Defaults to the users
+        loaded by the JupyterHub application that owns the authenticator.
+        """
+    )
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._heap = []
+        # user name -> due time of the user's current heap entry;
+        # older entries for the same user are skipped when popped
+        self._due = {}
+        # user name -> User, for users with a heap entry
+        self._users = {}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._scan_task: Optional[asyncio.Task] = None
+        self._last_refresh = 0.0
+        # refreshes run concurrently, bounded by the authenticator's
+        # token_max_clients; keep references until they finish
+        self._refreshing = set()
+
+    def _all_users(self) -> Iterable:
+        if self.users is not None:
+            return self.users()
+        return list(self.authenticator.parent.users.values())
+
+    def start(self):
+        if self._task is not None:
+            return
+        ahead = self.margin + self.jitter
+        if ahead > self.authenticator.auth_refresh_age:
+            self.log.warning(
+                "RefreshScheduler margin + jitter (%ss) exceeds auth_refresh_age (%ss); capping",
+                ahead,
+                self.authenticator.auth_refresh_age,
+            )
+        self._task = asyncio.ensure_future(self._run())
+        self._scan_task = asyncio.ensure_future(self._scan_loop())
+
+    def stop(self):
+        for task in (self._task, self._scan_task):
+            if task is not None:
+                task.cancel()
+        self._task = self._scan_task = None
+
+    def schedule(self, user, exp: float, not_before: Optional[float] = None):
+        """
+        Schedule a refresh for `user`, whose access token expires at `exp`.
+
+        Replaces any refresh already scheduled for the user.
+        """
+        ahead = min(
+            self.margin + random.uniform(0, self.jitter),
+            self.authenticator.auth_refresh_age,
+        )
+        due = max(exp - ahead, not_before or 0)
+        self._due[user.name] = due
+        self._users[user.name] = user
+        heapq.heappush(self._heap, (due, next(self._seq), user.name))
+        if self._heap[0][2] == user.name:
+            # new earliest entry, wake the loop up from a longer sleep
+            self._wakeup.set()
+
+    def unschedule(self, name: str):
+        self._due.pop(name, None)
+        self._users.pop(name, None)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._due
+
+    async def _enroll(self, user, not_before: Optional[float] = None):
+        auth_state = await self.authenticator.auth_state_cache.get_auth_state(user)
+        if not auth_state or not auth_state.get('access_token'):
+            return
+        claims = await self.authenticator._decode_token(auth_state['access_token'])
+        self.schedule(user, claims['exp'], not_before=not_before)
+
+    async def scan(self):
+        """
+        Schedule every user with an active server that is not scheduled yet.
+        """
+        for user in self._all_users():
+            if user.name in self._due or not user.active:
+                continue
+            try:
+                await self._enroll(user)
+            except Exception:
+                self.log.error("Failed to schedule token refresh for %s", user.name, exc_info=True)
+
+    async def _scan_loop(self):
+        while True:
+            await self.scan()
+            await asyncio.sleep(self.scan_interval)
+
+    async def _throttle(self):
+        if self.rate_limit <= 0:
+            return
+        wait = self._last_refresh + 1 / self.rate_limit - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        self._last_refresh = time.monotonic()
+
+    async def _next_due(self):
+        while True:
+            while self._heap and self._due.get(self._heap[0][2]) != self._heap[0][0]:
+                # superseded or unscheduled
+                heapq.heappop(self._heap)
+            timeout = (self._heap[0][0] - time.time()) if self._heap else None
+            if timeout is not None and timeout <= 0:
+                due, _, name = heapq.heappop(self._heap)
+                del self._due[name]
+                return self._users.pop(name)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run(self):
+        while True:
+            user = await self._next_due()
+            if not user.active:
+                # picked up again by the next scan once a server starts
+                self.log.debug("Not refreshing tokens for %s, no active server", user.name)
+                TOKEN_EXPIRY.forget(user.name)
+                continue
+            await self._throttle()
+            task = asyncio.ensure_future(self._refresh_logged(user))
+            self._refreshing.add(task)
+            task.add_done_callback(self._refreshing.discard)
+
+    async def _refresh_logged(self, user):
+        try:
+            await self.refresh(user)
+        except Exception:
+            self.log.error("Scheduled token refresh for %s failed", user.name, exc_info=True)
+
+    async def refresh(self, user):
+        """
+        Refresh `user`'s tokens and save them, as the hub does on requests.
+
+        A successful refresh reschedules the user from the new token (see
+        `RefreshingAuthenticator._refresh_user`). A failed one leaves the user
+        unscheduled until the next scan.
+        """
+        result = await self.authenticator.refresh_user(user)
+        if isinstance(result, dict) and result.get('auth_state'):
+            await user.save_auth_state(result['auth_state'])
+            # tells the hub's request handlers not to refresh again for
+            # auth_refresh_age seconds (see BaseHandler.refresh_auth)
+            user._auth_refreshed = time.monotonic()
+        if result and user.name not in self._due:
+            # still valid, e.g. a result shared with a concurrent request or
+            # a refresh shed by the open circuit breaker
+            await self._enroll(
+                user,
+                not_before=time.time() + max(
+                    1,
+                    self.authenticator.refresh_result_ttl,
+                    self.authenticator.token_breaker.retry_after(),
+                ),
+            )
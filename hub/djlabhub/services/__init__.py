@@ -0,0 +1 @@
+"""Hub-managed services, run with `python -m djlabhub.services.<name>`."""
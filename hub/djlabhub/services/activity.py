@@ -0,0 +1,266 @@
+"""
+Hub-managed service that aggregates singleuser servers' activity reports.
+
+Every singleuser server posts its activity to the hub every few minutes,
+and the hub commits each report to its database on its own, so the hub's
+write rate grows with the number of servers. With
+`c.DJLabSpawner.activity_url` set, servers post to this service instead,
+at the same path and with the same body as the hub's activity API:
+
+    POST /users/<name>/activity
+    {"last_activity": "<ISO 8601>", "servers": {"<server>": {"last_activity": "<ISO 8601>"}}}
+
+Reports are coalesced per user and server, keeping the latest timestamp,
+and every `--interval` seconds flushed to the hub in bulk (see
+`djlabhub.activity`), `--batch-size` users per request and database
+commit. The hub's write rate stays at one commit per interval (per batch)
+however many servers report. Activity reaches the hub up to `--interval`
+seconds late, which is small next to the idle culler's timeouts.
+
+A report is accepted with the server's own API token. The token is checked
+against the hub once (`GET /hub/api/user`, for its `users:activity` scope
+on the user) and cached for `--token-ttl` seconds.
+
+    c.JupyterHub.services = [{
+        "name": "djlabhub-activity",
+        "command": [sys.executable, "-m", "djlabhub.services.activity", "--port=10102"],
+    }]
+    c.DJLabSpawner.activity_url = "http://djlabhub-hub:10102"
+
+The service needs the `users:activity` scope. `GET /status` reports the
+pending reports and flushes.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import signal
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+
+from tornado import web
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.ioloop import PeriodicCallback
+
+from .culler import parse_date
+
+log = logging.getLogger("djlabhub.activity")
+
+# seconds in the future a report may be, as in the hub's activity API
+MAX_FUTURE = 59 * 60
+
+
+def isoformat(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+class ActivityAggregator:
+    def __init__(self, api_url: str, api_token: str, batch_size: int = 1000, token_ttl: float = 600):
+        self.api_url = api_url.rstrip("/")
+        self.api_token = api_token
+        self.batch_size = batch_size
+        self.token_ttl = token_ttl
+        self._http = AsyncHTTPClient()
+        # user -> {"last_activity": timestamp or None, "servers": {server: timestamp}}
+        self._pending: Dict[str, dict] = {}
+        # token hash -> (user name, may report the user's activity, checked until)
+        self._tokens: Dict[str, Tuple[str, bool, float]] = {}
+        self._checks: Dict[str, asyncio.Future] = {}
+        self._flushing: Optional[asyncio.Future] = None
+        self.received = 0
+        self.flushes = 0
+        self.flushed_users = 0
+        self.last_flush: Optional[float] = None
+
+    async def _hub(self, method: str, path: str, body: Optional[dict] = None, token: Optional[str] = None) -> dict:
+        response = await self._http.fetch(
+            self.api_url + path,
+            method=method,
+            headers={"Authorization": "token " + (token or self.api_token)},
+            body=json.dumps(body) if body is not None else None,
+            request_timeout=60,
+        )
+        return json.loads(response.body) if response.body else {}
+
+    async def _check(self, token: str) -> Tuple[str, bool]:
+        try:
+            model = await self._hub("GET", "/user", token=token)
+        except HTTPClientError as e:
+            if e.code in (401, 403, 404):
+                return "", False
+            raise
+        name = model.get("name") or ""
+        scopes = set(model.get("scopes") or ())
+        return name, "users:activity" in scopes or "users:activity!user=%s" % name in scopes
+
+    async def authorize(self, token: str, user_name: str) -> bool:
+        """Whether `token` may report the activity of `user_name`."""
+        key = hashlib.sha256(token.encode()).hexdigest()
+        cached = self._tokens.get(key)
+        if cached is None or cached[2] < time.monotonic():
+            check = self._checks.get(key)
+            if check is None:
+                check = self._checks[key] = asyncio.ensure_future(self._check(token))
+                check.add_done_callback(lambda _: self._checks.pop(key, None))
+            name, allowed = await asyncio.shield(check)
+            cached = self._tokens[key] = (name, allowed, time.monotonic() + self.token_ttl)
+        return cached[1] and cached[0] == user_name
+
+    def record(self, user_name: str, body: dict):
+        """Coalesce one report into the pending activity of `user_name`."""
+        if not isinstance(body, dict):
+            raise web.HTTPError(400, "body must be a json dict")
+        servers = body.get("servers") or {}
+        if not body.get("last_activity") and not servers:
+            raise web.HTTPError(400, "body must contain at least one of `last_activity` or `servers`")
+        if not isinstance(servers, dict) or not all(
+            isinstance(server, dict) and server.get("last_activity") for server in servers.values()
+        ):
+            raise web.HTTPError(400, "servers must be a dict of the form {server_name: {last_activity: timestamp}}")
+        try:
+            last_activity = parse_date(body.get("last_activity"))
+            server_activity = {name: parse_date(server["last_activity"]) for name, server in servers.items()}
+        except (AttributeError, TypeError, ValueError):
+            raise web.HTTPError(400, "Not a valid timestamp")
+        # the hub would skip it, and it would hold the server's activity in the future
+        if max([last_activity or 0, *server_activity.values()]) - time.time() > MAX_FUTURE:
+            raise web.HTTPError(400, "Rejecting activity from more than an hour in the future")
+        self._merge(user_name, last_activity, server_activity)
+        self.received += 1
+
+    def _merge(self, user_name: str, last_activity: Optional[float], servers: Dict[str, float]):
+        pending = self._pending.setdefault(user_name, {"last_activity": None, "servers": {}})
+        if last_activity is not None:
+            pending["last_activity"] = max(pending["last_activity"] or 0, last_activity)
+        for name, timestamp in servers.items():
+            pending["servers"][name] = max(pending["servers"].get(name, 0), timestamp)
+
+    async def flush(self):
+        """Send the pending activity to the hub, `batch_size` users per request."""
+        if self._flushing is not None:
+            return await asyncio.shield(self._flushing)
+        self._flushing = asyncio.ensure_future(self._flush())
+        try:
+            await asyncio.shield(self._flushing)
+        finally:
+            self._flushing = None
+
+    async def _flush(self):
+        now = time.monotonic()
+        self._tokens = {key: cached for key, cached in self._tokens.items() if cached[2] > now}
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        names = list(pending)
+        start = time.monotonic()
+        for i in range(0, len(names), self.batch_size):
+            batch = names[i:i + self.batch_size]
+            users = {}
+            for name in batch:
+                report = {"servers": {
+                    server: {"last_activity": isoformat(timestamp)}
+                    for server, timestamp in pending[name]["servers"].items()
+                }}
+                if pending[name]["last_activity"] is not None:
+                    report["last_activity"] = isoformat(pending[name]["last_activity"])
+                users[name] = report
+            try:
+                result = await self._hub("POST", "/djlabhub/activity", {"users": users})
+            except HTTPClientError as e:
+                if not 400 <= e.code < 500 or e.code == 429:
+                    self._requeue(names[i:], pending, e)
+                    return
+                # rejected, and would be again: retrying it would hold back everyone's activity
+                log.error("Hub rejected activity of %d users, dropping it: %s", len(batch), e)
+                continue
+            except Exception as e:
+                self._requeue(names[i:], pending, e)
+                return
+            self.flushed_users += len(batch)
+            if result.get("skipped"):
+                log.debug("Skipped activity of deleted users or servers: %s", result["skipped"])
+        self.flushes += 1
+        self.last_flush = time.time()
+        log.info("Flushed activity of %d users in %.2fs", len(names), time.monotonic() - start)
+
+    def _requeue(self, names, pending: dict, error: Exception):
+        # kept, with anything reported since, for the next flush
+        log.warning("Failed to flush activity of %d users: %s", len(names), error)
+        for name in names:
+            self._merge(name, pending[name]["last_activity"], pending[name]["servers"])
+
+    def status(self) -> dict:
+        return {
+            "pending_users": len(self._pending),
+            "pending_servers": sum(len(p["servers"]) for p in self._pending.values()),
+            "received": self.received,
+            "flushes": self.flushes,
+            "flushed_users": self.flushed_users,
+            "last_flush": isoformat(self.last_flush) if self.last_flush else None,
+        }
+
+
+class ActivityHandler(web.RequestHandler):
+    @property
+    def aggregator(self) -> ActivityAggregator:
+        return self.settings["aggregator"]
+
+    async def post(self, user_name):
+        scheme, _, token = self.request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() not in ("token", "bearer") or not token:
+            raise web.HTTPError(403, "Missing or invalid credentials.")
+        if not await self.aggregator.authorize(token.strip(), user_name):
+            raise web.HTTPError(403, "Not allowed to report activity of %s" % user_name)
+        try:
+            body = json.loads(self.request.body or b"{}")
+        except ValueError:
+            raise web.HTTPError(400, "body must be json")
+        self.aggregator.record(user_name, body)
+        self.finish()
+
+
+class StatusHandler(web.RequestHandler):
+    def get(self):
+        self.finish(self.settings["aggregator"].status())
+
+
+def make_app(aggregator: ActivityAggregator) -> web.Application:
+    return web.Application(
+        [
+            (r"/users/([^/]+)/activity", ActivityHandler),
+            (r"/status", StatusHandler),
+        ],
+        aggregator=aggregator,
+    )
+
+
+async def main(args):
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)1.1s %(asctime)s %(name)s] %(message)s")
+    aggregator = ActivityAggregator(
+        os.environ["JUPYTERHUB_API_URL"],
+        os.environ["JUPYTERHUB_API_TOKEN"],
+        batch_size=args.batch_size,
+        token_ttl=args.token_ttl,
+    )
+    make_app(aggregator).listen(args.port, address=args.ip)
+    PeriodicCallback(aggregator.flush, args.interval * 1000).start()
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopped.set)
+    await stopped.wait()
+    # the hub stops its services on shutdown: keep what has not been flushed yet
+    await aggregator.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--ip", default="", help="address to listen on, reachable by singleuser servers")
+    parser.add_argument("--port", type=int, default=10102)
+    parser.add_argument("--interval", type=float, default=60, help="seconds between flushes to the hub")
+    parser.add_argument("--batch-size", type=int, default=1000, help="users per bulk request")
+    parser.add_argument("--token-ttl", type=float, default=600, help="seconds a checked server token is cached")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,325 @@
+"""
+Hub-managed service that stops idle singleuser servers.
+
+Every `--interval` seconds it lists all ready servers with one paginated
+users request to the hub, which includes each server's last activity and
+spawner state (container id and Docker host). It lists the running
+containers of each Docker host once, and samples every server container's
+CPU and memory usage (Docker has no bulk stats call, so this is one
+one-shot stats request per container, a few at a time).
+
+A server is stopped when
+
+- it has been idle, by the hub's last activity, for longer than `--timeout`
+- and its container used less than `--cpu-threshold` CPUs since the
+  previous round, so a long-running computation in a kernel nobody is
+  looking at is never stopped, however long it runs
+
+When the memory used by a host's servers exceeds `--memory-pressure` of the
+host's memory, servers idle for longer than `--pressure-timeout` are
+stopped as well, those with the most reclaimable memory (usage minus
+inactive page cache) first, until the host is back under the threshold.
+
+Servers are grouped into profiles, by their `user_options["profile"]` or
+else their image. A profile's `--grace` period replaces both timeouts for
+its servers, e.g. `--grace=datajoint/djlabhub:singleuser-ide-4.0.2-py3.11=14400`.
+
+    c.JupyterHub.services = [{
+        "name": "djlabhub-culler",
+        "command": [sys.executable, "-m", "djlabhub.services.culler", "--timeout=3600"],
+    }]
+
+With `c.DJLabSpawner.hibernate`, stopped servers are hibernated rather
+than stopped. The service needs the scopes `list:users`,
+`read:users:activity`, `read:servers`, `admin:server_state` and
+`delete:servers`.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+from urllib.parse import quote, urlencode
+
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.ioloop import PeriodicCallback
+
+from ..docker_api import AsyncDockerClient
+
+log = logging.getLogger("djlabhub.culler")
+
+
+def parse_date(value: Optional[str]) -> Optional[float]:
+    """Timestamp of one of the hub's ISO 8601 dates."""
+    if not value:
+        return None
+    date = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date.timestamp()
+
+
+def reclaimable(memory_stats: dict) -> int:
+    """Memory in use minus inactive page cache, for cgroup v2 and v1."""
+    stats = memory_stats.get("stats") or {}
+    cache = stats.get("inactive_file", stats.get("total_inactive_file", 0))
+    return max(memory_stats.get("usage", 0) - cache, 0)
+
+
+class Server:
+    def __init__(self, user: str, name: str, model: dict):
+        self.user = user
+        self.name = name
+        self.last_activity = parse_date(model.get("last_activity")) or parse_date(model.get("started"))
+        self.profile = (model.get("user_options") or {}).get("profile")
+        state = model.get("state") or {}
+        self.container_id: Optional[str] = state.get("object_id")
+        self.host: str = state.get("docker_host") or ""
+        self.image: Optional[str] = None
+        self.memory = 0
+        self.reclaimable = 0
+        # CPUs used since the previous round, None until sampled twice
+        self.cpu: Optional[float] = None
+
+    def __repr__(self):
+        return "%s/%s" % (self.user, self.name) if self.name else self.user
+
+    def idle(self, now: float) -> float:
+        return now - self.last_activity if self.last_activity else 0
+
+
+class Culler:
+    def __init__(
+        self,
+        api_url: str,
+        api_token: str,
+        hosts: Dict[str, str],
+        timeout: float = 3600,
+        pressure_timeout: float = 600,
+        grace: Optional[Dict[str, float]] = None,
+        memory_pressure: float = 0.85,
+        cpu_threshold: float = 0.05,
+        concurrency: int = 10,
+        stats_concurrency: int = 16,
+        page_size: int = 200,
+    ):
+        self.api_url = api_url.rstrip("/")
+        self.api_token = api_token
+        self.docker = {name: AsyncDockerClient(url) for name, url in hosts.items()}
+        self.timeout = timeout
+        self.pressure_timeout = pressure_timeout
+        self.grace = grace or {}
+        self.memory_pressure = memory_pressure
+        self.cpu_threshold = cpu_threshold
+        self.page_size = page_size
+        self._cull_limit = asyncio.Semaphore(concurrency)
+        self._stats_limit = asyncio.Semaphore(stats_concurrency)
+        self._http = AsyncHTTPClient()
+        # container id -> (monotonic time, total CPU ns) of the previous sample
+        self._cpu_samples: Dict[str, tuple] = {}
+
+    async def _hub(self, method: str, path: str, **params) -> Optional[dict]:
+        url = self.api_url + path
+        if params:
+            url += "?" + urlencode(params)
+        response = await self._http.fetch(
+            url,
+            method=method,
+            headers={
+                "Authorization": "token " + self.api_token,
+                "Accept": "application/jupyterhub-pagination+json",
+            },
+            request_timeout=60,
+        )
+        return json.loads(response.body) if response.body else None
+
+    async def servers(self) -> List[Server]:
+        """All ready servers, in pages of `page_size` users."""
+        servers = []
+        offset = 0
+        while True:
+            page = await self._hub("GET", "/users", state="ready", offset=offset, limit=self.page_size)
+            for user in page["items"]:
+                for name, model in (user.get("servers") or {}).items():
+                    if model.get("ready"):
+                        servers.append(Server(user["name"], name, model))
+            following = (page.get("_pagination") or {}).get("next")
+            if not following:
+                return servers
+            offset = following["offset"]
+
+    async def _stats(self, client: AsyncDockerClient, server: Server):
+        async with self._stats_limit:
+            stats = await client.stats(server.container_id)
+        memory_stats = stats.get("memory_stats") or {}
+        server.memory = memory_stats.get("usage", 0)
+        server.reclaimable = reclaimable(memory_stats)
+        total = ((stats.get("cpu_stats") or {}).get("cpu_usage") or {}).get("total_usage")
+        if total is None:
+            return
+        now = time.monotonic()
+        previous = self._cpu_samples.get(server.container_id)
+        self._cpu_samples[server.container_id] = (now, total)
+        if previous is not None and now > previous[0]:
+            server.cpu = (total - previous[1]) / 1e9 / (now - previous[0])
+
+    async def sample(self, servers: List[Server]) -> Dict[str, tuple]:
+        """
+        Fill in the image and usage of each server's container, and return
+        the memory used by servers and the total memory of each host.
+        """
+        memory = {}
+        for host, client in self.docker.items():
+            on_host = [s for s in servers if s.host == host and s.container_id]
+            if not on_host:
+                continue
+            try:
+                info = await client.info()
+                running = {c["Id"]: c for c in await client.containers()}
+            except Exception as e:
+                log.error("Failed to list containers on Docker host %r: %s", host, e)
+                continue
+            on_host = [s for s in on_host if s.container_id in running]
+            for server in on_host:
+                server.image = running[server.container_id].get("Image")
+            results = await asyncio.gather(
+                *(self._stats(client, s) for s in on_host), return_exceptions=True
+            )
+            for server, result in zip(on_host, results):
+                if isinstance(result, Exception):
+                    log.warning("Failed to sample %s: %s", server, result)
+            memory[host] = (sum(s.memory for s in on_host), info["MemTotal"])
+        sampled = {s.container_id for s in servers}
+        for container_id in [c for c in self._cpu_samples if c not in sampled]:
+            del self._cpu_samples[container_id]
+        return memory
+
+    def _timeouts(self, server: Server) -> tuple:
+        grace = self.grace.get(server.profile, self.grace.get(server.image))
+        if grace is not None:
+            return grace, grace
+        return self.timeout, self.pressure_timeout
+
+    def _busy(self, server: Server) -> bool:
+        # not sampled twice yet: assume it is computing
+        return server.cpu is None or server.cpu >= self.cpu_threshold
+
+    def select(self, servers: List[Server], memory: Dict[str, tuple], now: float) -> List[tuple]:
+        """`(server, reason)` of the servers to stop."""
+        # memory to reclaim from each host under pressure
+        excess = {
+            host: used - self.memory_pressure * total
+            for host, (used, total) in memory.items()
+            if used > self.memory_pressure * total
+        }
+        selected = []
+        pressed: Dict[str, List[Server]] = {}
+        for server in servers:
+            if server.image is None or self._busy(server):
+                continue
+            timeout, pressure_timeout = self._timeouts(server)
+            idle = server.idle(now)
+            if idle > timeout:
+                selected.append((server, "idle for %is" % idle))
+            elif idle > pressure_timeout and server.host in excess:
+                pressed.setdefault(server.host, []).append(server)
+        for host, candidates in pressed.items():
+            # servers stopped for being idle free their memory as well
+            remaining = excess[host] - sum(s.reclaimable for s, _ in selected if s.host == host)
+            for server in sorted(candidates, key=lambda s: s.reclaimable, reverse=True):
+                if remaining <= 0:
+                    break
+                selected.append(
+                    (server, "idle for %is, reclaiming %i MB under memory pressure"
+                     % (server.idle(now), server.reclaimable >> 20))
+                )
+                remaining -= server.reclaimable
+        return selected
+
+    async def cull(self, server: Server, reason: str):
+        path = "/users/%s/servers/%s" % (quote(server.user, safe=""), quote(server.name, safe=""))
+        async with self._cull_limit:
+            log.info("Stopping %s: %s", server, reason)
+            try:
+                await self._hub("DELETE", path)
+            except HTTPClientError as e:
+                log.error("Failed to stop %s: %s", server, e)
+
+    async def run_once(self):
+        start = time.monotonic()
+        try:
+            servers = await self.servers()
+        except Exception as e:
+            log.error("Failed to list servers: %s", e)
+            return
+        memory = await self.sample(servers)
+        selected = self.select(servers, memory, time.time())
+        await asyncio.gather(*(self.cull(server, reason) for server, reason in selected))
+        log.info(
+            "Checked %i servers in %.1fs, stopped %i; memory used by servers: %s",
+            len(servers), time.monotonic() - start, len(selected),
+            ", ".join(
+                "%s %.0f%%" % (host or "local", 100 * used / total) for host, (used, total) in memory.items()
+            ) or "-",
+        )
+
+
+def key_value(value: str) -> tuple:
+    key, sep, rest = value.rpartition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError("expected KEY=VALUE, got %r" % value)
+    return key, rest
+
+
+async def main(args):
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)1.1s %(asctime)s %(name)s] %(message)s")
+    hosts = {"": args.docker_socket}
+    hosts.update(dict(args.docker_host))
+    culler = Culler(
+        os.environ["JUPYTERHUB_API_URL"],
+        os.environ["JUPYTERHUB_API_TOKEN"],
+        hosts,
+        timeout=args.timeout,
+        pressure_timeout=args.pressure_timeout,
+        grace={profile: float(seconds) for profile, seconds in args.grace},
+        memory_pressure=args.memory_pressure,
+        cpu_threshold=args.cpu_threshold,
+        concurrency=args.concurrency,
+        stats_concurrency=args.stats_concurrency,
+    )
+    await culler.run_once()
+    PeriodicCallback(culler.run_once, args.interval * 1000).start()
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--timeout", type=float, default=3600, help="idle seconds before stopping")
+    parser.add_argument(
+        "--pressure-timeout", type=float, default=600,
+        help="idle seconds before stopping, under memory pressure",
+    )
+    parser.add_argument(
+        "--grace", type=key_value, action="append", default=[],
+        help="PROFILE=SECONDS, replaces both timeouts for a profile or image, repeatable",
+    )
+    parser.add_argument(
+        "--memory-pressure", type=float, default=0.85,
+        help="fraction of a host's memory used by servers above which idle servers are reclaimed",
+    )
+    parser.add_argument(
+        "--cpu-threshold", type=float, default=0.05,
+        help="CPUs used since the previous round at which a server counts as busy",
+    )
+    parser.add_argument("--interval", type=float, default=300, help="seconds between rounds")
+    parser.add_argument("--concurrency", type=int, default=10, help="servers stopped at the same time")
+    parser.add_argument("--stats-concurrency", type=int, default=16, help="containers sampled at the same time")
+    parser.add_argument("--docker-socket", default="/var/run/docker.sock")
+    parser.add_argument(
+        "--docker-host", type=key_value, action="append", default=[],
+        help="NAME=URL of a Docker host of c.DJLabSpawner.docker_hosts, repeatable",
+    )
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,245 @@
+"""
+Hub-managed service that keeps singleuser images pulled on the Docker host.
+
+For each configured image it compares the registry's digest with the local
+one and pulls new digests in the background, a few images at a time,
+recording per-layer progress and sizes. The hub's spawner asks it which
+images are warm before starting a container (see
+`DJLabSpawner.image_service_url`), and asks it to pull a cold image instead
+of pulling it on its own. Images built on the host, which have no registry
+digest, are warm as they are and never pulled over.
+
+    c.JupyterHub.services = [{
+        "name": "djlabhub-images",
+        "command": [sys.executable, "-m", "djlabhub.services.images",
+                    "--port=10101", "--image=datajoint/djlabhub:singleuser-4.0.2-py3.10"],
+    }]
+
+API, served on 127.0.0.1 only and not routed through the proxy:
+
+    GET  /images                 status of every image
+    GET  /images/<image>         status of one image
+    POST /images/<image>/pull    pull now, if not pulled or pulling already
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+import docker
+from tornado import web
+from tornado.ioloop import PeriodicCallback
+
+log = logging.getLogger("djlabhub.images")
+
+
+class ImageStatus:
+    def __init__(self, image: str):
+        self.image = image
+        # on the host, whether or not it came from a registry
+        self.present = False
+        self.local_digest: Optional[str] = None
+        self.remote_digest: Optional[str] = None
+        self.size: Optional[int] = None
+        self.pulling = False
+        self.error: Optional[str] = None
+        self.checked: Optional[float] = None
+        self.pulled: Optional[float] = None
+        # layer id -> {"status", "current", "total"}
+        self.layers: Dict[str, dict] = {}
+
+    @property
+    def local_build(self) -> bool:
+        """Present without a registry digest, e.g. from `docker compose build`."""
+        return self.present and self.local_digest is None
+
+    @property
+    def warm(self) -> bool:
+        """
+        Present locally, at the registry's current digest if known. A local
+        build is warm as it is: pulling the tag would replace it.
+        """
+        if not self.present:
+            return False
+        if self.local_build:
+            return True
+        return self.remote_digest is None or self.remote_digest == self.local_digest
+
+    def to_dict(self) -> dict:
+        layers_total = sum(l.get("total") or 0 for l in self.layers.values())
+        layers_current = sum(l.get("current") or 0 for l in self.layers.values())
+        return dict(
+            image=self.image,
+            warm=self.warm,
+            present=self.present,
+            pulling=self.pulling,
+            local_digest=self.local_digest,
+            remote_digest=self.remote_digest,
+            size=self.size,
+            error=self.error,
+            checked=self.checked,
+            pulled=self.pulled,
+            progress=dict(
+                current=layers_current,
+                total=layers_total,
+                layers=self.layers,
+            ),
+        )
+
+
+def repo_digest(image: str, repo_digests) -> Optional[str]:
+    """The `sha256:` digest of `image` among an image's RepoDigests."""
+    repo = image.rsplit(":", 1)[0] if "/" not in image.rsplit(":", 1)[-1] else image
+    for entry in repo_digests or ():
+        name, _, digest = entry.partition("@")
+        if name == repo:
+            return digest
+    return None
+
+
+class ImagePuller:
+    def __init__(self, images, parallelism: int = 2, client: Optional[docker.APIClient] = None):
+        self.client = client or docker.APIClient()
+        self.status = {image: ImageStatus(image) for image in images}
+        self._executor = ThreadPoolExecutor(max_workers=parallelism + 1)
+        self._limit = asyncio.Semaphore(parallelism)
+        self._pulls: Dict[str, asyncio.Future] = {}
+
+    def _call(self, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self._executor, lambda: getattr(self.client, method)(*args, **kwargs))
+
+    async def check(self, status: ImageStatus):
+        try:
+            info = await self._call("inspect_image", status.image)
+            status.present = True
+            status.local_digest = repo_digest(status.image, info.get("RepoDigests"))
+            status.size = info.get("Size")
+        except docker.errors.ImageNotFound:
+            status.present = False
+            status.local_digest = None
+        if status.local_build:
+            status.checked = time.time()
+            return
+        try:
+            dist = await self._call("inspect_distribution", status.image)
+            status.remote_digest = dist["Descriptor"]["digest"]
+        except docker.errors.APIError as e:
+            # registry unreachable: a local copy still counts as warm
+            log.warning("Could not resolve %s at the registry: %s", status.image, e)
+        status.checked = time.time()
+
+    def _pull_blocking(self, status: ImageStatus):
+        repository, _, tag = status.image.rpartition(":")
+        if not repository or "/" in tag:
+            repository, tag = status.image, "latest"
+        for event in self.client.pull(repository, tag=tag, stream=True, decode=True):
+            layer = event.get("id")
+            if "error" in event:
+                raise docker.errors.APIError(event["error"])
+            if layer and "status" in event:
+                detail = event.get("progressDetail") or {}
+                entry = status.layers.setdefault(layer, {})
+                entry["status"] = event["status"]
+                if detail.get("total"):
+                    entry["total"] = detail["total"]
+                if "current" in detail:
+                    entry["current"] = detail["current"]
+                elif event["status"] in ("Download complete", "Pull complete", "Already exists"):
+                    entry["current"] = entry.get("total")
+
+    async def _pull(self, status: ImageStatus):
+        async with self._limit:
+            status.pulling = True
+            status.error = None
+            status.layers = {}
+            start = time.monotonic()
+            try:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(self._executor, self._pull_blocking, status)
+                await self.check(status)
+                status.pulled = time.time()
+                log.info("Pulled %s in %.1fs", status.image, time.monotonic() - start)
+            except Exception as e:
+                status.error = str(e)
+                log.error("Failed to pull %s: %s", status.image, e)
+            finally:
+                status.pulling = False
+
+    def pull(self, image: str) -> Optional[asyncio.Future]:
+        status = self.status.setdefault(image, ImageStatus(image))
+        if status.local_build:
+            log.info("Not pulling %s over its local build", image)
+            return None
+        future = self._pulls.get(image)
+        if future is None or future.done():
+            future = self._pulls[image] = asyncio.ensure_future(self._pull(status))
+        return future
+
+    async def refresh(self):
+        """Check every image and pull the ones that are not warm."""
+        for status in list(self.status.values()):
+            if status.pulling:
+                continue
+            try:
+                await self.check(status)
+            except Exception as e:
+                status.error = str(e)
+                continue
+            if not status.warm:
+                self.pull(status.image)
+
+
+class ImagesHandler(web.RequestHandler):
+    @property
+    def puller(self) -> ImagePuller:
+        return self.settings["puller"]
+
+    def get(self, image=None):
+        if image is None:
+            self.write(json.dumps({i: s.to_dict() for i, s in self.puller.status.items()}))
+            return
+        status = self.puller.status.get(image)
+        if status is None:
+            raise web.HTTPError(404, "Unknown image %s" % image)
+        self.write(json.dumps(status.to_dict()))
+
+
+class PullHandler(ImagesHandler):
+    def post(self, image):
+        self.puller.pull(image)
+        self.set_status(202)
+        self.write(json.dumps(self.puller.status[image].to_dict()))
+
+
+def make_app(puller: ImagePuller) -> web.Application:
+    return web.Application(
+        [
+            (r"/images", ImagesHandler),
+            (r"/images/(.+)/pull", PullHandler),
+            (r"/images/(.+)", ImagesHandler),
+        ],
+        puller=puller,
+    )
+
+
+async def main(args):
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)1.1s %(asctime)s %(name)s] %(message)s")
+    puller = ImagePuller(args.image, parallelism=args.parallelism)
+    make_app(puller).listen(args.port, address="127.0.0.1")
+    log.info("Tracking %s", ", ".join(args.image))
+    await puller.refresh()
+    PeriodicCallback(puller.refresh, args.interval * 1000).start()
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--image", action="append", default=[], help="image to keep pulled, repeatable")
+    parser.add_argument("--port", type=int, default=10101)
+    parser.add_argument("--parallelism", type=int, default=2, help="images pulled at the same time")
+    parser.add_argument("--interval", type=float, default=300, help="seconds between registry checks")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,117 @@
+"""
+Per-phase timing of spawns.
+
+A spawn's wall time is split into phases, each observed in the
+`djlabhub_spawn_phase_duration_seconds` histogram and collected into one
+structured log record per spawn (`Spawn timeline {...}`):
+
+- `image_service`: waiting for the image service to pull a cold image
+- `pull`, `create`, `start`: DockerSpawner's image pull, container create and start
+- `pool_claim`: claiming a warm pool container instead of `create` and `start`
+- `container_boot`: container start until `before_start_hook.sh` runs
+- `hook_<step>`: steps of `before_start_hook.sh`, reported by the hook
+- `jupyter_boot`: end of the hook (or container start, without a report)
+  until the hub's readiness check succeeds and the server is routed
+
+The hook reports its steps to
+
+    POST /hub/api/djlabhub/users/<name>/spawn-timings
+    {"server_name": "", "marks": [["start", <epoch>], ["clone", <epoch>], ...]}
+
+with the server's own API token; each mark ends the step named after it.
+"""
+import json
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from jupyterhub.apihandlers.base import APIHandler
+from jupyterhub.scopes import needs_scope
+from tornado import web
+
+from .metrics import SPAWN_PHASE_DURATION_SECONDS
+
+
+class SpawnTimeline:
+    """Phase durations of one spawn, in wall-clock time."""
+
+    def __init__(self, log, user_name: str, server_name: str = ''):
+        self.log = log
+        self.user_name = user_name
+        self.server_name = server_name
+        self.started = time.time()
+        # end of the container start, and of the startup hook, as epoch seconds
+        self.container_started: Optional[float] = None
+        self.hook_done: Optional[float] = None
+        # phase -> seconds, in the order phases ended
+        self.phases = {}
+        self.finished = False
+
+    def record(self, phase: str, seconds: float):
+        seconds = max(seconds, 0)
+        SPAWN_PHASE_DURATION_SECONDS.labels(phase=phase).observe(seconds)
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def hook_marks(self, marks):
+        """Record the steps `before_start_hook.sh` reported."""
+        marks = sorted(marks, key=lambda mark: mark[1])
+        if self.container_started is not None:
+            self.record('container_boot', marks[0][1] - self.container_started)
+        for (_, previous), (step, ts) in zip(marks, marks[1:]):
+            self.record('hook_%s' % step, ts - previous)
+        self.hook_done = marks[-1][1]
+
+    def finish(self, status: str):
+        if self.finished:
+            return
+        self.finished = True
+        now = time.time()
+        if status == 'success':
+            since = self.hook_done or self.container_started
+            if since is not None:
+                self.record('jupyter_boot', now - since)
+        record = dict(
+            user=self.user_name,
+            server_name=self.server_name,
+            status=status,
+            total=round(now - self.started, 3),
+            phases={phase: round(seconds, 3) for phase, seconds in self.phases.items()},
+        )
+        self.log.info("Spawn timeline %s", json.dumps(record))
+
+
+class SpawnTimingsAPIHandler(APIHandler):
+    @needs_scope('users:activity')
+    async def post(self, user_name):
+        user = self.find_user(user_name)
+        if user is None:
+            raise web.HTTPError(404)
+        body = self.get_json_body() or {}
+        server_name = body.get('server_name') or ''
+        marks = body.get('marks')
+        try:
+            marks = [(str(step), float(ts)) for step, ts in marks]
+        except (TypeError, ValueError):
+            raise web.HTTPError(400, "marks must be a list of [step, epoch seconds]")
+        if not marks:
+            raise web.HTTPError(400, "marks must not be empty")
+        if server_name not in user.spawners:
+            raise web.HTTPError(404, "No such server %s" % server_name)
+        timeline = getattr(user.spawners[server_name], 'spawn_timeline', None)
+        if timeline is None or timeline.finished:
+            raise web.HTTPError(404, "No spawn in progress for %s" % user_name)
+        timeline.hook_marks(marks)
+        self.set_status(204)
+
+
+default_handlers = [
+    (r"/api/djlabhub/users/(?P<user_name>[^/]+)/spawn-timings", SpawnTimingsAPIHandler),
+]
@@ -0,0 +1,899 @@
+"""
+DockerSpawner for djlabhub singleuser images.
+
+    c.JupyterHub.spawner_class = "djlabhub.spawner.DJLabSpawner"
+
+`c.DockerSpawner.*` settings apply unchanged; the additions are configured
+on `c.DJLabSpawner`.
+"""
+import asyncio
+import json
+import os
+import time
+import uuid
+from typing import Optional
+from urllib.parse import quote, urlparse
+
+from dockerspawner import DockerSpawner
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from traitlets import Bool, Dict, Float, Integer, Unicode
+
+from .admission import SpawnQueue
+from .docker_api import ASYNC_METHODS, CHECKPOINT_METHODS, AsyncDockerClient
+from .envs import EnvironmentStore, EnvironmentUnavailable
+from .home import HomeTemplates
+from .metrics import CHECKPOINT_DURATION_SECONDS, RESTORE_OUTCOME
+from .placement import DockerHost, PlacementScheduler
+from .pool import POOL_LABEL, WAIT_COMMAND, WarmPool
+from .readiness import READY_LABEL
+from .reconcile import AMBIGUOUS, ContainerSnapshot
+from .repo_envs import RepoEnvironments
+from .spawn_timing import SpawnTimeline
+
+
+class DJLabSpawner(DockerSpawner):
+    """
+    DockerSpawner with a warm pool of pre-started containers, and images
+    pulled ahead of time by the image service.
+    """
+
+    warm_pool_sizes = Dict(
+        value_trait=Integer(),
+        config=True,
+        help="""
+        Number of idle, started containers to keep per image, e.g.
+
+            {"datajoint/djlabhub:singleuser-4.0.2-py3.10": 4,
+             "datajoint/djlabhub:singleuser-ide-4.0.2-py3.11": 2}
+
+        A spawn of one of these images claims a pool container instead of
+        creating one, and gets the user's environment and command at claim
+        time. The image must provide `djlabhub-pool-wait`
+        (singleuser/config/pool_wait.sh).
+
+        Pool containers are created from the hub-wide DockerSpawner settings,
+        so spawns with per-user volumes, or without `use_internal_ip`, are
+        not served from the pool. A claimed container is removed rather than
+        restarted when its server stops.
+        """,
+    )
+
+    image_service_url = Unicode(
+        "",
+        config=True,
+        help="""
+        URL of the image pre-pull service (`djlabhub.services.images`), e.g.
+        `http://127.0.0.1:10101`. When set, a spawn whose image is not on
+        the host yet has the service pull it, and reports the pull's
+        progress, instead of pulling it in `start`.
+        """,
+    )
+
+    activity_url = Unicode(
+        "",
+        config=True,
+        help="""
+        URL of the activity aggregation service
+        (`djlabhub.services.activity`), e.g. `http://djlabhub-hub:10102`,
+        reachable from singleuser containers. When set, servers report
+        their activity to the service, which flushes it to the hub in bulk,
+        instead of to the hub itself.
+        """,
+    )
+
+    image_pull_wait = Float(
+        45,
+        config=True,
+        help="""
+        Seconds a spawn waits for the image service to pull a cold image
+        before starting anyway, which pulls as DockerSpawner would.
+        """,
+    )
+
+    admission_control = Bool(
+        True,
+        config=True,
+        help="""
+        Queue spawns so that only a limited, adaptive number of them create
+        and start containers at the same time (see `c.SpawnQueue`). Waiting
+        spawns show their queue position and estimated wait. The wait
+        counts against `start_timeout`.
+        """,
+    )
+
+    ready_wait = Float(
+        30,
+        config=True,
+        help="""
+        Seconds `start` waits for the server's ready notification, for images
+        labelled `djlabhub.ready-notify`, before leaving it to the hub's
+        polling. 0 disables waiting.
+        """,
+    )
+
+    async_docker = Bool(
+        True,
+        config=True,
+        help="""
+        Call the Docker API from the event loop with `AsyncDockerClient`,
+        over pooled, pipelining connections to `docker_socket`, instead of
+        DockerSpawner's single-thread executor. Calls it does not implement
+        (image pull, exec, volumes) still go through the executor. Only used
+        when the Docker daemon is the local socket.
+        """,
+    )
+
+    docker_socket = Unicode("/var/run/docker.sock", config=True, help="Docker daemon socket.")
+
+    docker_max_connections = Integer(
+        8, config=True, help="Connections `AsyncDockerClient` keeps open to the socket."
+    )
+
+    docker_max_pipeline = Integer(
+        8, config=True, help="GET requests pipelined on one connection."
+    )
+
+    docker_max_concurrency = Integer(
+        64, config=True, help="Docker API requests in flight at the same time."
+    )
+
+    reconcile_bulk = Bool(
+        True,
+        config=True,
+        help="""
+        When the hub starts, answer the check of each running server from a
+        single listing of all containers, instead of inspecting every
+        container (see `djlabhub.reconcile`).
+        """,
+    )
+
+    reconcile_max_inspect = Integer(
+        16,
+        config=True,
+        help="Containers inspected at the same time when the listing does not settle their state.",
+    )
+
+    docker_hosts = Dict(
+        config=True,
+        help="""
+        Docker hosts to place singleuser containers on, by name, e.g.
+
+            {"node1": {"url": "tcp://10.0.0.11:2375"},
+             "node2": {"url": "tcp://10.0.0.12:2375", "cpu": 32, "mem": "128G"}}
+
+        See `djlabhub.placement` and `c.PlacementScheduler`. Empty, the
+        default, runs every container on the hub's own Docker daemon.
+        Placement bypasses the warm pool and the image service, which manage
+        the hub's daemon only.
+        """,
+    )
+
+    hibernate = Bool(
+        False,
+        config=True,
+        help="""
+        Checkpoint a server's container to disk when it is stopped, e.g. by
+        the idle culler, instead of stopping it, and restore the checkpoint
+        on its next start: memory is freed, but the user's kernels and
+        terminals come back as they were, and the start is much faster than
+        a fresh spawn. Needs CRIU on the Docker hosts and their daemons in
+        experimental mode, `async_docker` or `docker_hosts` (docker-py has
+        no checkpoint API), and `c.DockerSpawner.remove = False`. Servers
+        whose checkpoint or restore fails are stopped, or started afresh.
+        """,
+    )
+
+    checkpoint_dir = Unicode(
+        "",
+        config=True,
+        help="""
+        Directory on the Docker host for checkpoints. Empty, the default,
+        uses the daemon's, under the container's directory, so checkpoints
+        are removed with their container.
+        """,
+    )
+
+    home_templates = Bool(
+        False,
+        config=True,
+        help="""
+        Create the home of a new server whose environment sets
+        `DJLABHUB_REPO` as a copy-on-write volume of a template holding the
+        repository's clone, built once per repository commit, instead of
+        each startup hook cloning it (see `djlabhub.home` and
+        `c.HomeTemplates`). Homes made this way bypass the warm pool.
+        """,
+    )
+
+    home_volume_name = Unicode(
+        "djlabhub-home-{username}",
+        config=True,
+        help="Name of the home volume, with DockerSpawner's {username}, {servername} etc.",
+    )
+
+    shared_env = Bool(
+        False,
+        config=True,
+        help="""
+        Mount the conda environment of thin images (labelled
+        `djlabhub.env-source`, see `singleuser/Thin.Dockerfile`) read-only
+        from an environment shared by all containers on the host, exported
+        once from the full image (see `djlabhub.envs` and
+        `c.EnvironmentStore`). Thin images cannot be used by the warm pool.
+        """,
+    )
+
+    repo_envs = Bool(
+        False,
+        config=True,
+        help="""
+        Install the dependencies of `DJLABHUB_REPO`, for servers whose
+        environment sets `DJLABHUB_REPO_INSTALL=TRUE`, once per repository
+        commit and requirements on the hub, and mount them read-only, so
+        that the startup hook only links the repository (see
+        `djlabhub.repo_envs` and `c.RepoEnvironments`). Such servers bypass
+        the warm pool.
+        """,
+    )
+
+    repo_env_wait = Float(
+        10,
+        config=True,
+        help="""
+        Seconds a spawn waits for the repository's dependencies to be built.
+        After that it starts without them and the startup hook installs them;
+        the build carries on for later spawns.
+        """,
+    )
+
+    # one pool, queue, Docker client, placement scheduler and container
+    # listing (per host) per hub process, shared by every user's spawner
+    _warm_pool: Optional[WarmPool] = None
+    _spawn_queue: Optional[SpawnQueue] = None
+    _async_client: Optional[AsyncDockerClient] = None
+    _placement: Optional[PlacementScheduler] = None
+    _home: Optional[HomeTemplates] = None
+    _envs: Optional[EnvironmentStore] = None
+    _repo_environments: Optional[RepoEnvironments] = None
+    _snapshots: dict = {}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._progress_events = []
+        self._progress_changed = asyncio.Event()
+        # phases of the current, or last, spawn
+        self.spawn_timeline: Optional[SpawnTimeline] = None
+        self._ready = asyncio.Event()
+        # name of the Docker host of this server's container, with placement
+        self.docker_host: Optional[str] = None
+        # checkpoint of the hibernated container, restored on the next start
+        self.checkpoint: Optional[str] = None
+        self._restored = False
+        # whether the repository's prebuilt dependencies are mounted
+        self._repo_env = False
+
+    @property
+    def warm_pool(self) -> Optional[WarmPool]:
+        if not self.warm_pool_sizes:
+            return None
+        cls = DJLabSpawner
+        if cls._warm_pool is None:
+            cls._warm_pool = WarmPool(
+                self.warm_pool_sizes,
+                config=self.config,
+                log=self.log,
+                docker=self.docker,
+                create_kwargs=self._pool_create_kwargs,
+            )
+            cls._warm_pool.start()
+        return cls._warm_pool
+
+    @property
+    def async_client(self) -> Optional[AsyncDockerClient]:
+        if not self.async_docker:
+            return None
+        cls = DJLabSpawner
+        if cls._async_client is None:
+            docker_host = os.environ.get('DOCKER_HOST', 'unix://' + self.docker_socket)
+            if (
+                self.tls_config
+                or self.client_kwargs.get('base_url')
+                or docker_host != 'unix://' + self.docker_socket
+                or not os.path.exists(self.docker_socket)
+            ):
+                return None
+            cls._async_client = AsyncDockerClient(
+                self.docker_socket,
+                version=self.client.api_version,
+                max_connections=self.docker_max_connections,
+                max_pipeline=self.docker_max_pipeline,
+                max_concurrency=self.docker_max_concurrency,
+                config_client=self.client,
+            )
+        return cls._async_client
+
+    def docker(self, method, *args, **kwargs):
+        """Call a Docker API method, from the event loop if possible."""
+        host = self.placed_host
+        if host is not None:
+            if method == 'create_container' and kwargs.get('name') == self.object_name:
+                labels = self.placement.labels(host, *self._resource_request())
+                kwargs['labels'] = dict(kwargs.get('labels') or {}, **labels)
+            return host.docker(method, *args, **kwargs)
+        async_method = method in ASYNC_METHODS or method in CHECKPOINT_METHODS
+        client = self.async_client if async_method else None
+        if client is None:
+            return super().docker(method, *args, **kwargs)
+        return getattr(client, method)(*args, **kwargs)
+
+    @property
+    def placement(self) -> Optional[PlacementScheduler]:
+        if not self.docker_hosts:
+            return None
+        cls = DJLabSpawner
+        if cls._placement is None:
+            cls._placement = PlacementScheduler(
+                self.docker_hosts,
+                hibernate=self.hibernate,
+                checkpoint_dir=self.checkpoint_dir,
+                config=self.config,
+                log=self.log,
+            )
+        return cls._placement
+
+    @property
+    def placed_host(self) -> Optional[DockerHost]:
+        placement = self.placement
+        if placement is None or self.docker_host is None:
+            return None
+        return placement.hosts.get(self.docker_host)
+
+    def load_state(self, state):
+        super().load_state(state)
+        self.docker_host = state.get('docker_host') or self.docker_host
+        self.checkpoint = state.get('checkpoint') or self.checkpoint
+
+    def get_state(self):
+        state = super().get_state()
+        if self.docker_host:
+            state['docker_host'] = self.docker_host
+        if self.checkpoint and self.object_id:
+            state['checkpoint'] = self.checkpoint
+        return state
+
+    @property
+    def will_resume(self):
+        # a hibernated server keeps its API token: the restored process uses it
+        return bool(self.checkpoint) or super().will_resume
+
+    @property
+    def snapshot(self) -> ContainerSnapshot:
+        host = self.placed_host
+        key = host.name if host is not None else ''
+        snapshots = DJLabSpawner._snapshots
+        if key not in snapshots:
+            snapshots[key] = ContainerSnapshot(
+                host.docker if host is not None else self.docker,
+                max_inspect=self.reconcile_max_inspect,
+                log=self.log,
+            )
+        return snapshots[key]
+
+    async def poll(self):
+        if not (self._check_pending and self.reconcile_bulk):
+            return await super().poll()
+        # the hub's startup check of a server it believes is running
+        try:
+            status, container_id = await self.snapshot.status(self.object_name, self.object_id)
+        except Exception:
+            self.log.warning("Failed to list containers, inspecting %s", self._log_name, exc_info=True)
+            status = AMBIGUOUS
+        if status is AMBIGUOUS:
+            async with self.snapshot.inspect_limit:
+                return await super().poll()
+        if container_id is not None:
+            self.object_id = container_id
+        elif status == 0:
+            self.log.warning("Container not found: %s", self.container_name)
+            self.object_id = ""
+        return status
+
+    @property
+    def spawn_queue(self) -> SpawnQueue:
+        cls = DJLabSpawner
+        if cls._spawn_queue is None:
+            cls._spawn_queue = SpawnQueue(config=self.config, log=self.log)
+        return cls._spawn_queue
+
+    def _pool_create_kwargs(self, image: str) -> dict:
+        host_config = dict(network_mode=self.network_name)
+        if self.volumes:
+            host_config['binds'] = self.volume_binds
+        if self.mem_limit:
+            host_config['mem_limit'] = self.mem_limit
+        if self.cpu_limit:
+            host_config['cpu_quota'] = int(self.cpu_limit * 100000)
+            host_config['cpu_period'] = 100000
+        host_config.update(self.extra_host_config)
+        return dict(
+            image=image,
+            name='djlabhub-pool-%s' % uuid.uuid4().hex[:12],
+            command=WAIT_COMMAND,
+            labels={POOL_LABEL: image},
+            host_config=self.client.create_host_config(**host_config),
+        )
+
+    def _pool_eligible(self) -> bool:
+        if self.placement is not None or self.home_templates or self.repo_envs:
+            return False
+        if self.image not in self.warm_pool_sizes or not self.use_internal_ip:
+            return False
+        # volumes templated per user can only be mounted at create time
+        return not any('{' in str(k) or '{' in str(v) for k, v in self.volumes.items())
+
+    async def _claim_from_pool(self) -> bool:
+        pool = self.warm_pool
+        container_id = await pool.claim(self.image)
+        if container_id is None:
+            self.log.info("Warm pool for %s is empty, creating a container", self.image)
+            return False
+        env = self.get_env()
+        cmd = await self.get_command()
+        await pool.hand_over(container_id, self.object_name, env, cmd)
+        self.object_id = container_id
+        self.log.info(
+            "Claimed pool container %s for %s", container_id[:12], self._log_name
+        )
+        return True
+
+    def _emit(self, message: str, progress: Optional[int] = None):
+        """Add a spawn progress event, shown on the spawn pending page."""
+        event = {'message': message}
+        if progress is not None:
+            event['progress'] = progress
+        self._progress_events.append(event)
+        self._progress_changed.set()
+
+    async def progress(self):
+        sent = 0
+        while True:
+            while sent < len(self._progress_events):
+                yield self._progress_events[sent]
+                sent += 1
+            self._progress_changed.clear()
+            # cancelled by the hub once the spawn finishes
+            await self._progress_changed.wait()
+
+    async def _image_request(self, path: str, method: str = 'GET') -> Optional[dict]:
+        url = self.image_service_url.rstrip('/') + '/images/' + quote(self.image, safe='') + path
+        try:
+            response = await AsyncHTTPClient().fetch(
+                url, method=method, body=b'' if method == 'POST' else None, request_timeout=5
+            )
+        except HTTPClientError as e:
+            if e.code == 404:
+                return None
+            raise
+        return json.loads(response.body)
+
+    async def _ensure_image(self):
+        """Have the image service pull a cold image, and wait for it."""
+        try:
+            status = await self._image_request('')
+            if status is not None and status['present']:
+                # present, if not at the registry's latest digest, or built locally: no pull needed
+                return
+            if status is None or not status['pulling']:
+                status = await self._image_request('/pull', method='POST')
+        except Exception as e:
+            self.log.warning("Image service unavailable, not checking %s: %s", self.image, e)
+            return
+        self.log.info("Image %s is not on the host yet, waiting for its pull", self.image)
+        deadline = time.monotonic() + self.image_pull_wait
+        while status['pulling'] or not status['present']:
+            if status['error'] or time.monotonic() > deadline:
+                self.log.warning(
+                    "Image service did not pull %s (%s), starting anyway",
+                    self.image, status['error'] or 'timeout',
+                )
+                return
+            done, total = status['progress']['current'], status['progress']['total']
+            if total:
+                self._emit(
+                    "Pulling %s: %d of %d MB" % (self.image, done >> 20, total >> 20),
+                    progress=int(40 * done / total),
+                )
+            await asyncio.sleep(1)
+            try:
+                status = await self._image_request('')
+            except Exception as e:
+                self.log.warning("Image service unavailable while pulling %s: %s", self.image, e)
+                return
+        self._emit("Pulled %s" % self.image, progress=40)
+
+    async def pull_image(self, image):
+        with self.spawn_timeline.phase('pull'):
+            await super().pull_image(image)
+
+    @property
+    def home(self) -> HomeTemplates:
+        cls = DJLabSpawner
+        if cls._home is None:
+            cls._home = HomeTemplates(config=self.config, log=self.log)
+        return cls._home
+
+    async def _prepare_home(self):
+        """Mount a home made from the repository's template, creating it if new."""
+        env = self.get_env()
+        repo = env.get('DJLABHUB_REPO')
+        if not repo:
+            return
+        volume = self._render_templates(self.home_volume_name)
+        host = self.placed_host
+        try:
+            await self.home.ensure_home(
+                host.name if host is not None else '',
+                self.docker,
+                host.client if host is not None else self.client,
+                self.image,
+                volume,
+                repo,
+                env.get('DJLABHUB_REPO_BRANCH', ''),
+                on_build=lambda: self._emit("Preparing your home directory", progress=35),
+            )
+        except Exception as e:
+            # the startup hook clones the repository as before
+            self.log.warning("Failed to prepare home %s for %s: %s", volume, self._log_name, e)
+            return
+        self.volumes = dict(self.volumes, **{volume: self.home.home_path})
+
+    @property
+    def envs(self) -> EnvironmentStore:
+        cls = DJLabSpawner
+        if cls._envs is None:
+            cls._envs = EnvironmentStore(config=self.config, log=self.log)
+        return cls._envs
+
+    async def _prepare_env(self):
+        """Mount the shared environment of a thin image."""
+        source = self.envs.source(await self.docker('inspect_image', self.image))
+        if not source:
+            return
+        host = self.placed_host
+        self._emit("Preparing the Python environment", progress=35)
+        try:
+            path = await self.envs.ensure(
+                host.name if host is not None else '',
+                self.docker,
+                host.client if host is not None else self.client,
+                source,
+            )
+        except Exception as e:
+            # unlike a home or repository environment, a thin image cannot start without it
+            self.log.error(
+                "Failed to export the environment of %s from %s for %s: %s",
+                self.image, source, self._log_name, e,
+            )
+            raise EnvironmentUnavailable(
+                "Could not prepare the Python environment of %s, which has none of its own:"
+                " pulling %s or exporting its environment failed (%s)" % (self.image, source, e)
+            ) from e
+        self.volumes = dict(self.volumes, **{path: {'bind': self.envs.env_path, 'mode': 'ro'}})
+
+    @property
+    def repo_environments(self) -> RepoEnvironments:
+        cls = DJLabSpawner
+        if cls._repo_environments is None:
+            cls._repo_environments = RepoEnvironments(config=self.config, log=self.log)
+        return cls._repo_environments
+
+    async def _prepare_repo_env(self):
+        """Mount the prebuilt dependencies of the repository the startup hook installs."""
+        mount_path = self.repo_environments.mount_path
+        # dependencies of a previous container's commit
+        self._repo_env = False
+        self.volumes = {
+            k: v for k, v in self.volumes.items() if not (isinstance(v, dict) and v.get('bind') == mount_path)
+        }
+        env = self.get_env()
+        repo = env.get('DJLABHUB_REPO')
+        if not repo or env.get('DJLABHUB_REPO_INSTALL') != 'TRUE':
+            return
+        name = self.home.repo_name(repo)
+        branch = env.get('DJLABHUB_REPO_BRANCH', '')
+        host = self.placed_host
+        config_client = host.client if host is not None else self.client
+        try:
+            image = await self.docker('inspect_image', self.image)
+            # a thin image's Python is its full image's
+            source = self.envs.source(image) if self.shared_env else None
+            if source:
+                image = await self.docker('inspect_image', source)
+            commit = await self.home.resolve(self.docker, config_client, image['Id'], repo, branch)
+            build = self.repo_environments.build(
+                host.name if host is not None else '',
+                self.docker, config_client, image['Id'], repo, branch, commit,
+            )
+            if not build.done():
+                self._emit("Preparing the dependencies of %s" % name, progress=35)
+            path = await asyncio.wait_for(asyncio.shield(build), self.repo_env_wait)
+        except asyncio.TimeoutError:
+            self.log.info(
+                "Dependencies of %s for %s are still building, the startup hook installs them",
+                name, self._log_name,
+            )
+            return
+        except Exception as e:
+            self.log.warning("Failed to prepare dependencies of %s for %s: %s", name, self._log_name, e)
+            return
+        self._repo_env = True
+        self.volumes = dict(self.volumes, **{path: {'bind': mount_path, 'mode': 'ro'}})
+
+    def get_env(self):
+        env = super().get_env()
+        if self.activity_url:
+            env['JUPYTERHUB_ACTIVITY_URL'] = '%s/users/%s/activity' % (
+                self.activity_url.rstrip('/'), quote(self.user.name, safe='')
+            )
+        if self._repo_env:
+            # the startup hook links the repository only
+            env['DJLABHUB_REPO_ENV'] = self.repo_environments.mount_path
+        return env
+
+    async def create_object(self):
+        if self.shared_env:
+            with self.spawn_timeline.phase('environment'):
+                await self._prepare_env()
+        if self.home_templates:
+            with self.spawn_timeline.phase('home'):
+                await self._prepare_home()
+        if self.repo_envs:
+            with self.spawn_timeline.phase('repo_env'):
+                await self._prepare_repo_env()
+        with self.spawn_timeline.phase('create'):
+            obj = await super().create_object()
+        host = self.placed_host
+        if host is not None:
+            self.placement.placed(host, self.object_name, obj['Id'])
+        return obj
+
+    async def remove_object(self):
+        container_id = self.object_id
+        await super().remove_object()
+        # the default checkpoint directory goes with the container
+        self.checkpoint = None
+        host = self.placed_host
+        if host is not None:
+            self.placement.removed(host, container_id)
+
+    async def get_ip_and_port(self):
+        ip, port = await super().get_ip_and_port()
+        host = self.placed_host
+        if host is not None and not self.use_internal_ip:
+            # published port on the container's host, not the hub's daemon
+            ip = urlparse(host.url).hostname or ip
+        return ip, port
+
+    def _resource_request(self) -> tuple:
+        return (self.cpu_guarantee or self.cpu_limit, self.mem_guarantee or self.mem_limit)
+
+    async def _place(self):
+        """Choose a Docker host for a new container; existing ones stay where they are."""
+        placement = self.placement
+        host = self.placed_host
+        if host is not None:
+            await placement.refresh()
+            if host.available:
+                return
+            self.log.warning(
+                "Docker host %s of %s is unavailable, placing it again", host.name, self._log_name
+            )
+        with self.spawn_timeline.phase('placement'):
+            host = await placement.place(self.object_name, self.image, *self._resource_request())
+        self.log.info("Placing %s on Docker host %s", self._log_name, host.name)
+        self.docker_host = host.name
+        self.object_id = ""
+        self.checkpoint = None
+
+    async def start_object(self):
+        if self.checkpoint:
+            with self.spawn_timeline.phase('restore'):
+                await self._restore()
+        else:
+            with self.spawn_timeline.phase('start'):
+                await super().start_object()
+        host = self.placed_host
+        if host is not None:
+            self.placement.started(host, self.object_id, *self._resource_request())
+        self.spawn_timeline.container_started = time.time()
+
+    def _can_checkpoint(self) -> bool:
+        return self.placed_host is not None or self.async_client is not None
+
+    async def _refresh_auth(self):
+        """Refresh the user's auth_state, which the restored server reads from the hub."""
+        handler = getattr(self, 'handler', None)
+        if handler is None:
+            return
+        try:
+            await handler.refresh_auth(self.user, force=True)
+        except Exception as e:
+            self.log.warning("Failed to refresh auth for %s before restore: %s", self._log_name, e)
+
+    async def _restore(self):
+        """Start the container from its checkpoint, or afresh if that fails."""
+        checkpoint, self.checkpoint = self.checkpoint, None
+        self._emit("Restoring your server", progress=30)
+        await self._refresh_auth()
+        try:
+            await self.docker(
+                'start', self.container_id,
+                checkpoint=checkpoint, checkpoint_dir=self.checkpoint_dir or None,
+            )
+        except Exception as e:
+            RESTORE_OUTCOME.labels(outcome='failure').inc()
+            self.log.warning(
+                "Failed to restore %s from checkpoint %s, starting it afresh: %s",
+                self._log_name, checkpoint, e,
+            )
+            await super().start_object()
+        else:
+            RESTORE_OUTCOME.labels(outcome='success').inc()
+            self._restored = True
+            self.log.info("Restored %s from checkpoint %s", self._log_name, checkpoint)
+        try:
+            await self.docker(
+                'checkpoint_delete', self.container_id, checkpoint,
+                checkpoint_dir=self.checkpoint_dir or None,
+            )
+        except Exception as e:
+            self.log.debug("Failed to delete checkpoint %s of %s: %s", checkpoint, self._log_name, e)
+
+    async def _hibernate(self) -> bool:
+        """Checkpoint the running container to disk, which stops it."""
+        if not self._can_checkpoint():
+            self.log.warning(
+                "Not hibernating %s: checkpoints need async_docker or docker_hosts", self._log_name
+            )
+            return False
+        if self.remove:
+            self.log.warning("Not hibernating %s: DockerSpawner.remove is set", self._log_name)
+            return False
+        checkpoint = 'djlabhub-%i' % time.time()
+        start = time.monotonic()
+        try:
+            await self.docker(
+                'checkpoint_create', self.container_id, checkpoint,
+                exit=True, checkpoint_dir=self.checkpoint_dir or None,
+            )
+        except Exception as e:
+            CHECKPOINT_DURATION_SECONDS.labels(outcome='failure').observe(time.monotonic() - start)
+            self.log.warning("Failed to checkpoint %s, stopping it: %s", self._log_name, e)
+            return False
+        elapsed = time.monotonic() - start
+        CHECKPOINT_DURATION_SECONDS.labels(outcome='success').observe(elapsed)
+        self.checkpoint = checkpoint
+        self.log.info("Hibernated %s to checkpoint %s in %.1fs", self._log_name, checkpoint, elapsed)
+        return True
+
+    async def stop(self, now=False):
+        if self.hibernate and not now and self.object_id and await self._hibernate():
+            self.clear_state()
+            return
+        container_id = self.object_id
+        await super().stop(now=now)
+        host = self.placed_host
+        if host is not None and container_id:
+            # a stopped container, kept or not, frees its host's allocation
+            self.placement.removed(host, container_id)
+        if not self.object_id:
+            # removed (DockerSpawner.remove): the next start is placed afresh,
+            # with a capacity check, instead of pinned to this host
+            self.docker_host = None
+
+    async def _finish_timeline(self, timeline: SpawnTimeline):
+        """Close the timeline once the hub has seen the server respond."""
+        status = 'success'
+        try:
+            if self._spawn_future is not None:
+                await self._spawn_future
+        except Exception:
+            status = 'failure'
+        timeline.finish(status)
+
+    def notify_ready(self):
+        """Called by the ready endpoint when the server is listening."""
+        self._ready.set()
+
+    async def _notifies_ready(self) -> bool:
+        try:
+            image = await self.docker('inspect_image', self.image)
+        except Exception:
+            return False
+        return (image['Config'].get('Labels') or {}).get(READY_LABEL) == 'true'
+
+    async def _wait_ready(self):
+        """Wait for the ready notification, while the container is running."""
+        deadline = time.monotonic() + self.ready_wait
+        while not self._ready.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.log.warning(
+                    "No ready notification from %s after %is, leaving it to polling",
+                    self._log_name, self.ready_wait,
+                )
+                return
+            try:
+                await asyncio.wait_for(self._ready.wait(), min(remaining, 5))
+            except asyncio.TimeoutError:
+                if await self.poll() is not None:
+                    # exited: the hub's check reports the failure
+                    return
+        self.log.debug("%s notified it is ready", self._log_name)
+
+    async def start(self, *args, **kwargs):
+        self._progress_events = []
+        self._progress_changed = asyncio.Event()
+        self._ready = asyncio.Event()
+        self._restored = False
+        timeline = self.spawn_timeline = SpawnTimeline(self.log, self.user.name, self.name)
+        try:
+            if self.image_service_url and self.placement is None:
+                # before admission: a pull would hold a slot and skew start latency
+                with timeline.phase('image_service'):
+                    await self._ensure_image()
+            if self.admission_control:
+                ip_port = await self._admitted_start(*args, **kwargs)
+            else:
+                ip_port = await self._start(*args, **kwargs)
+            # a restored server notified the hub when it first started
+            if self.ready_wait > 0 and not self._restored and await self._notifies_ready():
+                self._emit("Waiting for your server to start", progress=60)
+                await self._wait_ready()
+        except Exception:
+            timeline.finish('failure')
+            raise
+        asyncio.ensure_future(self._finish_timeline(timeline))
+        return ip_port
+
+    def _queued(self, ahead: int, eta: float):
+        self._emit(
+            "Waiting to start your server: %i ahead of you, about %is"
+            % (ahead, max(1, round(eta))),
+            progress=5,
+        )
+
+    async def _admitted_start(self, *args, **kwargs):
+        waiting = time.time()
+        async with self.spawn_queue.admit(self.user.name, on_wait=self._queued):
+            self.spawn_timeline.record('queue', time.time() - waiting)
+            return await self._start(*args, **kwargs)
+
+    async def _start(self, *args, **kwargs):
+        if self.placement is not None:
+            await self._place()
+            try:
+                return await self._start_container(*args, **kwargs)
+            finally:
+                # a reservation not turned into a container is released
+                self.placement.cancel(self.placed_host, self.object_name)
+        return await self._start_container(*args, **kwargs)
+
+    async def _start_container(self, *args, **kwargs):
+        obj = await self.get_object()
+        if (
+            obj is not None
+            and not self.checkpoint
+            and POOL_LABEL in (obj['Config'].get('Labels') or {})
+        ):
+            # a claimed pool container waits for a claim again when restarted,
+            # unless it is restored to the claimed state
+            await self.remove_object()
+            obj = None
+        if obj is None and self.warm_pool is not None and self._pool_eligible():
+            with self.spawn_timeline.phase('pool_claim'):
+                claimed = await self._claim_from_pool()
+            if claimed:
+                self.spawn_timeline.container_started = time.time()
+                return await self.get_ip_and_port()
+        return await super().start(*args, **kwargs)
@@ -0,0 +1,159 @@
+"""
+Verify and inspect the Keycloak JWTs kept in `auth_state`.
+
+The same module ships in the hub (`hub/djlabhub/tokens.py`) and in the
+singleuser image (`singleuser/jupyter_codeserver_proxy/tokens.py`). The two
+images are built from separate Docker contexts, so keep both copies identical.
+"""
+import hashlib
+import json
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+from urllib import request
+
+import jwt
+
+# parsed once, instead of on every decode
+_PYJWT_2 = int(jwt.__version__.split(".")[0]) >= 2
+_UNVERIFIED = (
+    dict(options=dict(verify_signature=False)) if _PYJWT_2 else dict(verify=False)
+)
+_MAX_AGE = re.compile(r"max-age=(\d+)")
+
+
+class UnknownSigningKey(jwt.InvalidTokenError):
+    """The token's `kid` is not in the cached JWKS and a re-fetch is not due."""
+
+
+def jwks_max_age(cache_control: Optional[str]) -> Optional[float]:
+    """
+    Return the `max-age` of a JWKS response's Cache-Control header, if any.
+    """
+    match = _MAX_AGE.search(cache_control or "")
+    return float(match.group(1)) if match else None
+
+
+class TokenInspector:
+    """
+    Decode JWTs, verifying signatures against the issuer's cached JWKS and
+    memoizing decoded claims in a bounded LRU keyed by the token's digest.
+
+    Expiry is not enforced here: callers read `exp` themselves, because an
+    expired access token is exactly the one that needs refreshing. Keycloak
+    signs refresh tokens with a realm secret that is not published in the
+    JWKS, so those should be inspected with `verify=False`; the token
+    endpoint validates them when they are used.
+
+    Fetching the JWKS is left to the caller (see `keys_needed` and
+    `load_jwks`), so that the hub can fetch it without blocking its event
+    loop. `fetch_jwks` is a blocking helper for synchronous callers. When a
+    fetch fails, callers keep verifying with the last keys loaded; a token
+    signed with none of them raises `UnknownSigningKey` and is never read
+    unverified instead.
+    """
+
+    def __init__(
+        self,
+        jwks_url: Optional[str] = None,
+        audience: Optional[str] = None,
+        cache_size: int = 1024,
+        jwks_max_age: float = 3600,
+        jwks_min_refresh_interval: float = 30,
+    ):
+        self.jwks_url = jwks_url
+        self.audience = audience
+        self.cache_size = cache_size
+        self.jwks_max_age = jwks_max_age
+        self.jwks_min_refresh_interval = jwks_min_refresh_interval
+        self._keys: Dict[str, jwt.PyJWK] = {}
+        self._keys_expire = 0.0
+        self._keys_fetched = 0.0
+        # token digest -> (verified, claims)
+        self._claims: "OrderedDict[str, tuple]" = OrderedDict()
+
+    @property
+    def verifies(self) -> bool:
+        return bool(self.jwks_url) and _PYJWT_2
+
+    def keys_needed(self, token: str) -> bool:
+        """
+        Whether the JWKS should be (re)fetched before verifying `token`.
+
+        True when the cached set has expired, or when the token names a `kid`
+        that is not in it, which is how key rotation shows up. Re-fetches for
+        unknown keys are limited to one per `jwks_min_refresh_interval`.
+        """
+        if not self.verifies:
+            return False
+        now = time.monotonic()
+        if now >= self._keys_expire:
+            return True
+        kid = jwt.get_unverified_header(token).get("kid")
+        return (
+            kid not in self._keys
+            and now - self._keys_fetched >= self.jwks_min_refresh_interval
+        )
+
+    def load_jwks(self, jwks: dict, max_age: Optional[float] = None):
+        """
+        Replace the cached signing keys with the keys of a JWKS document.
+        """
+        keys = {}
+        for jwk in jwks.get("keys", []):
+            if jwk.get("use", "sig") != "sig" or "kid" not in jwk:
+                continue
+            try:
+                keys[jwk["kid"]] = jwt.PyJWK(jwk)
+            except jwt.PyJWKError:
+                # e.g. an encryption-only or unsupported key type
+                continue
+        now = time.monotonic()
+        self._keys = keys
+        self._keys_fetched = now
+        self._keys_expire = now + (max_age if max_age is not None else self.jwks_max_age)
+
+    def fetch_jwks(self, timeout: float = 5):
+        """
+        Fetch and load the JWKS with a blocking request.
+        """
+        with request.urlopen(self.jwks_url, timeout=timeout) as response:
+            jwks = json.loads(response.read())
+            max_age = jwks_max_age(response.headers.get("Cache-Control"))
+        self.load_jwks(jwks, max_age)
+
+    def claims(self, token: str, verify: bool = True) -> dict:
+        """
+        Return a copy of the claims of `token`, verifying its signature if
+        `verify` and a JWKS is configured.
+        """
+        verify = verify and self.verifies
+        digest = hashlib.sha256(token.encode()).hexdigest()
+        cached = self._claims.get(digest)
+        if cached is not None and (cached[0] or not verify):
+            self._claims.move_to_end(digest)
+            return dict(cached[1])
+
+        if verify:
+            header = jwt.get_unverified_header(token)
+            jwk = self._keys.get(header.get("kid"))
+            if jwk is None:
+                raise UnknownSigningKey(f"No signing key for kid {header.get('kid')!r}")
+            # the algorithm comes from the JWKS, never from the token header
+            claims = jwt.decode(
+                token,
+                jwk.key,
+                algorithms=[jwk.algorithm_name],
+                audience=self.audience,
+                options=dict(verify_exp=False, verify_aud=self.audience is not None),
+            )
+        else:
+            claims = jwt.decode(token, algorithms=["RS256"], **_UNVERIFIED)
+
+        self._claims[digest] = (verify, claims)
+        self._claims.move_to_end(digest)
+        while len(self._claims) > self.cache_size:
+            self._claims.popitem(last=False)
+        # the cached claims are shared by every caller with the same token
+        return dict(claims)
@@ -0,0 +1,53 @@
+"""
+Traefik as the hub's proxy, with routes in a file it shares with the hub.
+
+    c.JupyterHub.proxy_class = "djlabhub.traefik.DJLabTraefikProxy"
+    c.DJLabTraefikProxy.should_start = False
+
+Traefik runs as its own container (`docker-compose.traefik.yaml`) and
+watches `dynamic_config_file`, on a volume shared with the hub, for its
+routes. The hub adds and deletes routes one at a time and the file keeps
+them, so a restarted hub reads its routes back from it instead of syncing
+them again. A restarted proxy also reads them back. Sessions keep running
+through Traefik while the hub is down.
+
+jupyterhub-traefik-proxy rewrites the whole file for every route change.
+`DJLabTraefikProxy` writes it once for the changes made in the same
+`route_batch_delay` seconds, so the thousands of updates after a restart
+are not thousands of rewrites of a growing file. Every change in a batch
+waits for its write.
+"""
+import asyncio
+from typing import Optional
+
+from jupyterhub_traefik_proxy.fileprovider import TraefikFileProviderProxy
+from traitlets import Float
+
+
+class DJLabTraefikProxy(TraefikFileProviderProxy):
+    route_batch_delay = Float(
+        0.05,
+        config=True,
+        help="Seconds route changes are collected before the routes file is written.",
+    )
+
+    _write: Optional[asyncio.Future] = None
+
+    def _persist_dynamic_config(self):
+        # called, under the mutex, after every change: write once per batch instead
+        if self._write is None:
+            self._write = asyncio.ensure_future(self._write_batch())
+
+    async def _write_batch(self):
+        await asyncio.sleep(self.route_batch_delay)
+        async with self.mutex:
+            self._write = None
+            super()._persist_dynamic_config()
+
+    async def _apply_dynamic_config(self, traefik_config, jupyterhub_config=None):
+        await super()._apply_dynamic_config(traefik_config, jupyterhub_config)
+        await asyncio.shield(self._write)
+
+    async def _delete_dynamic_config(self, traefik_keys, jupyterhub_keys):
+        await super()._delete_dynamic_config(traefik_keys, jupyterhub_keys)
+        await asyncio.shield(self._write)
@@ -0,0 +1,25 @@
+import setuptools
+
+
+setuptools.setup(
+    name="djlabhub",
+    version="0.1.0",
+    url="https://github.com/datajoint/djlabhub-docker.git",
+    author="DataJoint",
+    description="JupyterHub extensions used by the djlabhub hub image",
+    packages=setuptools.find_packages(include=["djlabhub", "djlabhub.*"]),
+    keywords=["Jupyter", "JupyterHub"],
+    classifiers=["Framework :: Jupyter"],
+    install_requires=[
+        "docker",
+        "jupyterhub",
+        "oauthenticator",
+        "prometheus_client",
+        "pyjwt[crypto]",
+        "tornado",
+    ],
+    extras_require={
+        # djlabhub.traefik
+        "traefik": ["jupyterhub-traefik-proxy>=1.1"],
+    },
+)
@@ -1,10 +1,22 @@
 #!/bin/bash
 echo "INFO::Datajoint Startup Hook"
 
+# Timings of the steps below, reported to the hub at the end (see hub/djlabhub/spawn_timing.py).
+# Each mark ends the step it names.
+export DJLABHUB_HOOK_MARKS=""
+djlabhub_mark() {
+  DJLABHUB_HOOK_MARKS="${DJLABHUB_HOOK_MARKS} $1=$(date +%s.%N)"
+}
+djlabhub_mark start
+
 # Changing Markdown Preview to preview as default
-echo "INFO::Changing Markdown Preview to preview as default"
-yq '.properties.defaultViewers.default = {"markdown":"Markdown Preview"}' \
-  /opt/conda/share/jupyter/lab/schemas/@jupyterlab/docmanager-extension/plugin.json -o json -i
+# (done at build time as well; the shared environment of thin images is read-only)
+DOCMANAGER_SCHEMA=/opt/conda/share/jupyter/lab/schemas/@jupyterlab/docmanager-extension/plugin.json
+if [ -w "$DOCMANAGER_SCHEMA" ]; then
+  echo "INFO::Changing Markdown Preview to preview as default"
+  yq '.properties.defaultViewers.default = {"markdown":"Markdown Preview"}' "$DOCMANAGER_SCHEMA" -o json -i
+fi
+djlabhub_mark markdown_preview
 
 # clone and install DJLABHUB_REPO or DJLABHUB_REPO_SUBPATH
 # for private repo, include PAT(Personal Access Token) in the https url
@@ -24,11 +36,46 @@ if [[ ! -z "${DJLABHUB_REPO}" ]]; then
   else
     echo "INFO::Directory $HOME/$REPO_NAME already exists and is not empty. Skipping clone."
     echo "INFO::Changing ownership of $HOME/$REPO_NAME to ${NB_USER}:${NB_GID}"
-    chown -R "${NB_USER}:${NB_GID}" "$HOME/$REPO_NAME"
+    # only files owned by someone else: on a copy-on-write home (hub/djlabhub/home.py),
+    # changing ownership would copy every file of the template
+    find "$HOME/$REPO_NAME" \( ! -user "${NB_USER}" -o ! -group "${NB_GID}" \) \
+      -exec chown "${NB_USER}:${NB_GID}" {} +
   fi
+  djlabhub_mark clone
 
   if [[ $DJLABHUB_REPO_INSTALL == "TRUE" ]]; then
-    echo "INFO::Installing repo"
-    pip install -e $HOME/$REPO_NAME
+    if [[ ! -z "${DJLABHUB_REPO_ENV}" && -d "${DJLABHUB_REPO_ENV}" ]]; then
+      # dependencies prebuilt by the hub (hub/djlabhub/repo_envs.py), only link the repo
+      echo "INFO::Linking repo, with dependencies from $DJLABHUB_REPO_ENV"
+      export PYTHONPATH="${DJLABHUB_REPO_ENV}${PYTHONPATH:+:$PYTHONPATH}"
+      export PATH="$PATH:$DJLABHUB_REPO_ENV/bin"
+      pip install --no-deps --no-build-isolation -e $HOME/$REPO_NAME \
+        || pip install --no-deps -e $HOME/$REPO_NAME
+    else
+      echo "INFO::Installing repo"
+      pip install -e $HOME/$REPO_NAME
+    fi
+    djlabhub_mark pip_install
   fi
+fi
+
+if [[ ! -z "${JUPYTERHUB_API_URL}" && ! -z "${JUPYTERHUB_API_TOKEN}" ]]; then
+  echo "INFO::Reporting startup hook timings"
+  python - <<'EOF' || echo "WARNING::Failed to report startup hook timings. Continuing..."
+import json
+import os
+import urllib.request
+
+marks = [mark.split("=") for mark in os.environ["DJLABHUB_HOOK_MARKS"].split()]
+request = urllib.request.Request(
+    "{}/djlabhub/users/{}/spawn-timings".format(os.environ["JUPYTERHUB_API_URL"], os.environ["JUPYTERHUB_USER"]),
+    data=json.dumps({
+        "server_name": os.environ.get("JUPYTERHUB_SERVER_NAME", ""),
+        "marks": [[step, float(ts)] for step, ts in marks],
+    }).encode(),
+    headers={"Authorization": "token " + os.environ["JUPYTERHUB_API_TOKEN"], "Content-Type": "application/json"},
+    method="POST",
+)
+urllib.request.urlopen(request, timeout=5)
+EOF
 fi
\ No newline at end of file
@@ -0,0 +1,56 @@
+"""
+Jupyter server extension that tells the hub when this server is up.
+
+Enabled in jupyter_server_config.py for servers spawned by JupyterHub. Once
+the server is listening, it posts to the hub's
+`/hub/api/djlabhub/users/<name>/ready` (see hub/djlabhub/readiness.py), so
+that the spawner returns right away instead of the hub polling the server
+until it answers.
+"""
+import asyncio
+import json
+import os
+
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.ioloop import IOLoop
+
+
+async def notify_hub(log, attempts=3):
+    url = "{}/djlabhub/users/{}/ready".format(
+        os.environ["JUPYTERHUB_API_URL"], os.environ["JUPYTERHUB_USER"]
+    )
+    body = json.dumps({"server_name": os.environ.get("JUPYTERHUB_SERVER_NAME", "")})
+    headers = {
+        "Authorization": "token " + os.environ["JUPYTERHUB_API_TOKEN"],
+        "Content-Type": "application/json",
+    }
+    for attempt in range(attempts):
+        try:
+            await AsyncHTTPClient().fetch(
+                url, method="POST", body=body, headers=headers, request_timeout=5
+            )
+            log.info("Notified the hub that the server is ready")
+            return
+        except HTTPClientError as e:
+            if e.code == 404:
+                # hub without the endpoint, or not waiting for this server
+                log.debug("Hub is not waiting for a ready notification")
+                return
+            log.warning("Failed to notify the hub that the server is ready: %s", e)
+        except Exception as e:
+            log.warning("Failed to notify the hub that the server is ready: %s", e)
+        await asyncio.sleep(2**attempt)
+
+
+def _jupyter_server_extension_points():
+    return [{"module": "djlabhub_ready"}]
+
+
+def _load_jupyter_server_extension(serverapp):
+    if not all(
+        os.getenv(name)
+        for name in ("JUPYTERHUB_API_URL", "JUPYTERHUB_API_TOKEN", "JUPYTERHUB_USER")
+    ):
+        return
+    # runs once the IOLoop starts, after the server has bound its port
+    IOLoop.current().add_callback(notify_hub, serverapp.log)
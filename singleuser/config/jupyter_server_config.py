@@ -92,3 +92,7 @@ c.FileContentsManager.root_dir = os.getenv(
 # c.YDocExtension.disable_rtc = (
 #     os.getenv("JUPYTER_YDOCEXTENSION_DISABLE_RTC", "FALSE").upper() == "TRUE"
 # )
+
+## Notify the hub when the server is up, see djlabhub_ready.py
+if os.getenv("JUPYTERHUB_API_TOKEN"):
+    c.ServerApp.jpserver_extensions.update({"djlabhub_ready": True})
@@ -0,0 +1,16 @@
+#!/bin/bash
+# Command of warm-pool containers (see hub/djlabhub/pool.py).
+# Holds the container until the hub claims it for a user by writing
+# claim.sh, then the ready marker, into $CLAIM_DIR, and runs the claim
+# script, which exports the user's environment, runs the startup hooks
+# (before_start_hook.sh) with it, removes itself and execs the server command.
+CLAIM_DIR=/tmp/djlabhub-claim
+mkdir -p "$CLAIM_DIR"
+echo "INFO::Waiting for the hub to claim this container"
+while [ ! -f "$CLAIM_DIR/ready" ]; do
+  sleep 0.1
+done
+echo "INFO::Claimed"
+cp "$CLAIM_DIR/claim.sh" /tmp/djlabhub-claim.sh
+rm -rf "$CLAIM_DIR"
+exec bash /tmp/djlabhub-claim.sh
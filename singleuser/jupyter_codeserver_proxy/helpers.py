@@ -2,16 +2,19 @@ import os
 import time
 import logging
 import requests
-import jwt
 from functools import lru_cache
 from typing import Dict, Tuple, Optional
-from packaging import version
 from datajoint.settings import config as dj_config
 from pydantic import ValidationError
 from .settings import settings, JHubConfig
+from .tokens import TokenInspector, UnknownSigningKey
 
 Token = Optional[str]
 
+token_inspector = TokenInspector(
+    jwks_url=settings.jwks_url, cache_size=settings.token_cache_size
+)
+
 @lru_cache(maxsize=1)
 def get_token_from_jhub_auth_state(
     api_url: str, token: str, user: str, logger=None, ttl_hash=None
@@ -46,22 +49,77 @@ def get_token_from_jhub_auth_state(
     auth_state = resp.json().get("auth_state", dict())
     return auth_state.get("access_token"), auth_state.get("refresh_token")
 
-def decode_token(tok: str) -> Dict:
+# last credential returned by the hub's credentials endpoint:
+# {"etag": ..., "credential": {...}, "fetched": <time.time()>}
+_credential_cache: Dict = {}
+
+def get_credential_from_jhub(
+    api_url: str, token: str, user: str, logger=None, ttl_seconds: int = 60
+) -> Optional[Dict]:
     """
-    Decode a JWT token using PyJWT.
+    Get the current access token and its expiry times from the hub's
+    `djlabhub/users/{user}/credentials` endpoint. The response is reused for
+    `ttl_seconds`, then revalidated with `If-None-Match`, which costs the hub
+    a 304 instead of a user model serialization and auth_state decryption.
+
+    Returns None if the hub does not have the endpoint, so that callers can
+    fall back to `get_token_from_jhub_auth_state`, or if the request failed.
     """
-    if version.parse(jwt.__version__) < version.parse("2.0.0"):
-        kwargs = dict(verify=False)
-    else:
-        kwargs = dict(options=dict(verify_signature=False))
-    return jwt.decode(tok, algorithms=["RS256"], **kwargs)
+    logger = logger or logging.getLogger(__name__)
+    if time.time() - _credential_cache.get("fetched", 0) < ttl_seconds:
+        return _credential_cache["credential"]
+    url = api_url + f"/djlabhub/users/{user}/credentials"
+    headers = {"Authorization": f"token {token}"}
+    if "etag" in _credential_cache:
+        headers["If-None-Match"] = _credential_cache["etag"]
+    try:
+        resp = requests.get(url, headers=headers, timeout=(0.5, 0.5), verify=False)
+    except (requests.RequestException,) as e:
+        logger.error(f"Request to {url=} failed with {e}")
+        return None
+    logger.debug(f"Request to {url=} responded with {resp=}")
+    if resp.status_code == 304:
+        _credential_cache["fetched"] = time.time()
+        return _credential_cache["credential"]
+    if resp.status_code >= 300:
+        if resp.status_code != 404:
+            logger.error(
+                f"Request to {url=} failed returning status code {resp.status_code}"
+            )
+        return None
+    _credential_cache.update(
+        etag=resp.headers.get("ETag"), credential=resp.json(), fetched=time.time()
+    )
+    return _credential_cache["credential"]
+
+def decode_token(tok: str, verify: bool = True, logger=None) -> Dict:
+    """
+    Decode a JWT token using PyJWT. The signature is verified against the
+    issuer's JWKS when `CREDS_UPDATER_JWKS_URL` is set. If the JWKS cannot
+    be fetched, the last keys fetched are used; a token signed with none of
+    them raises `UnknownSigningKey`.
+    """
+    logger = logger or logging.getLogger(__name__)
+    if verify and token_inspector.keys_needed(tok):
+        try:
+            token_inspector.fetch_jwks()
+        except (OSError, ValueError) as e:
+            # URLError and timeouts are OSErrors, a malformed JWKS a ValueError
+            logger.warning(f"Failed to fetch JWKS from {settings.jwks_url}: {e}")
+    return token_inspector.claims(tok, verify=verify)
 
 def check_token_expiry(tok: str, logger=None, token_type: str = "access") -> int:
     """
     Returns number of seconds until token expiry.
     """
     logger = logger or logging.getLogger(__name__)
-    tok: dict = decode_token(tok)
+    # Keycloak refresh tokens are not signed with a key from the JWKS
+    try:
+        tok: dict = decode_token(tok, verify=token_type != "refresh", logger=logger)
+    except UnknownSigningKey as e:
+        # unverifiable: treated as expired until the issuer's keys can be fetched
+        logger.error(f"Cannot verify {token_type} token: {e}")
+        return 0
     if "exp" not in tok:
         logger.error(f"{token_type.title()} token has no expiry time.")
         return 0
@@ -86,6 +144,29 @@ def setup_database_password(logger=None):
     except ValidationError as e:
         logger.warn(f"Invalid JHubConfig: {e}")
         return
+    credential = get_credential_from_jhub(
+        cfg.api_url,
+        cfg.token,
+        cfg.user,
+        logger=logger,
+        ttl_seconds=settings.auth_state_response_ttl_seconds,
+    )
+    if credential is not None:
+        access_token = credential["access_token"]
+        refresh_expires_at = credential.get("refresh_expires_at")
+        # without an expiry (offline_access), the refresh token stays valid
+        if refresh_expires_at is None or refresh_expires_at > time.time():
+            dj_config["database.password"] = access_token
+            os.environ['DJ_PASSWORD'] = access_token
+            if settings.debug:
+                logger.debug(
+                    f"Access token ending with {access_token[-7:]} expires at "
+                    f"{credential.get('expires_at')}"
+                )
+        elif settings.warn_on_expired_refresh:
+            logger.warn(settings.expired_refresh_warn_message)
+        return
+    # hub without the djlabhub credentials endpoint
     access_token, refresh_token = get_token_from_jhub_auth_state(
         cfg.api_url,
         cfg.token,
@@ -109,7 +190,7 @@ def setup_database_password(logger=None):
         os.environ['DJ_PASSWORD'] = access_token
         if settings.debug:
             logger.debug(
-                f"Refresh token ending with {refresh_token - 7:]} "
+                f"Refresh token ending with {refresh_token[-7:]} "
                 f"expires in {refresh_expiry} seconds"
             )
     elif settings.warn_on_expired_refresh:
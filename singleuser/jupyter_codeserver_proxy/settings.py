@@ -1,4 +1,5 @@
 import logging
+from typing import Optional
 from pydantic import Field
 from pydantic_settings import BaseSettings
 
@@ -26,6 +27,12 @@ class Settings(BaseSettings):
         ),
         validation_alias="creds_updater_expired_refresh_warn_message",
     )
+    jwks_url: Optional[str] = Field(
+        default=None, validation_alias="creds_updater_jwks_url"
+    )
+    token_cache_size: int = Field(
+        default=128, validation_alias="creds_updater_token_cache_size"
+    )
 
 
 class JHubConfig(BaseSettings):